@@ -22,4 +22,5 @@ if os.name == 'nt':
 from chevah.utils.event import EventsHandler
 events_handler = EventsHandler()
 emit = events_handler.emit
+emit_fast = events_handler.emitFast
 log = events_handler.log
@@ -17,7 +17,11 @@ from chevah.utils.constants import (
 from chevah.utils.exceptions import (
     UtilsError,
     )
-from chevah.utils.helpers import _
+from chevah.utils.helpers import (
+    _,
+    SaveLaterMixin,
+    write_file_atomically,
+    )
 from chevah.utils.interfaces import (
     IConfiguration,
     IConfigurationProxy,
@@ -26,13 +30,13 @@ from chevah.utils.interfaces import (
 from chevah.utils.property import PropertyMixin
 
 
-class FileConfigurationProxy(object):
+class FileConfigurationProxy(SaveLaterMixin):
     '''Config parser for Chevah projects.'''
 
     implements(IConfigurationProxy)
 
     def __init__(self, configuration_path=None, configuration_file=None,
-                 defaults=None):
+                 defaults=None, reactor=None):
         raw_defaults = None
         if defaults:
             raw_defaults = {}
@@ -41,6 +45,8 @@ class FileConfigurationProxy(object):
 
         self._raw_config = ConfigParser.RawConfigParser(raw_defaults)
         self._configuration_path = configuration_path
+        self._dirty = False
+        self._reactor = reactor
         if configuration_path:
             configuration_segments = local_filesystem.getSegmentsFromRealPath(
                 configuration_path)
@@ -77,17 +83,36 @@ class FileConfigurationProxy(object):
         else:
             self._configuration_file.close()
 
-    def save(self, configuration_file=None):
+    @property
+    def dirty(self):
+        """
+        True if configuration was changed since it was loaded or saved.
+        """
+        return self._dirty
+
+    def save(self, configuration_file=None, fsync=False):
         """
         Store the configuration into file.
 
-        By default, it stores the data, in the same *path* fromw
+        By default, it stores the data, in the same *path* from
         which it was loaded from.
+        When nothing was changed since last load or save, the file is
+        not written.
+
+        The data is first written into a temporary file which is then
+        renamed over the original file, so that a crash during save will
+        not leave an incomplete configuration file.
+        If `fsync` is True, the file and its parent folder are synced to
+        disk before returning.
 
         `configuration_file` argument is provided to help with testing.
         """
+        self._cancelSaveLater()
+
         if configuration_file:
             self._writeToFile(store_file=configuration_file)
+            self._dirty = False
+            self._fireSaveLaterDeferreds()
             return
 
         if not self._configuration_path:
@@ -95,31 +120,46 @@ class FileConfigurationProxy(object):
                 'Trying to save a configuration that was not loaded from '
                 ' a file from disk.')
 
+        if not self._dirty:
+            self._fireSaveLaterDeferreds()
+            return
+
         real_segments = local_filesystem.getSegmentsFromRealPath(
             self._configuration_path)
-        tmp_segments = real_segments[:]
-        tmp_segments[-1] = tmp_segments[-1] + u'.tmp'
-        store_file = local_filesystem.openFileForWriting(
-                tmp_segments, utf8=True)
-        self._writeToFile(store_file=store_file)
-        store_file.close()
-        # We delete the file first to work around windows problems.
-        local_filesystem.deleteFile(real_segments)
-        local_filesystem.rename(tmp_segments, real_segments)
+        write_file_atomically(
+            real_segments, self._serialize(), fsync=fsync)
+
+        self._dirty = False
+        self._fireSaveLaterDeferreds()
 
     def _writeToFile(self, store_file):
         """
         Write serialized configuration to a file stream.
         """
+        store_file.write(self._serialize())
+
+    def _serialize(self):
+        """
+        Return the serialized configuration.
+        """
+        lines = []
         for section in self._raw_config._sections:
-            store_file.write(u'[%s]\n' % section)
+            lines.append(u'[%s]\n' % section)
             items = self._raw_config._sections[section].items()
             for (key, value) in items:
                 if key != u'__name__':
-                    store_file.write(u'%s = %s\n' %
+                    lines.append(u'%s = %s\n' %
                              (key,
                              unicode(value).replace(u'\n', u'\n\t')))
-            store_file.write('\n')
+            lines.append(u'\n')
+        return u''.join(lines)
+
+    def _setRaw(self, section, option, value):
+        """
+        Set the raw `value` for `option` and mark configuration as changed.
+        """
+        self._raw_config.set(section, option, value)
+        self._dirty = True
 
     def get(self, section, option):
         '''Raise AssertionError if low level methods are called.'''
@@ -140,10 +180,14 @@ class FileConfigurationProxy(object):
     def addSection(self, section):
         '''See `IConfigurationProxy`.'''
         self._raw_config.add_section(section)
+        self._dirty = True
 
     def removeSection(self, section):
         '''See `IConfigurationProxy`.'''
-        return self._raw_config.remove_section(section)
+        result = self._raw_config.remove_section(section)
+        if result:
+            self._dirty = True
+        return result
 
     def hasOption(self, section, option):
         '''See `IConfigurationProxy'.'''
@@ -211,7 +255,7 @@ class FileConfigurationProxy(object):
                     'error': str(error),
                     }
                 )
-        self._raw_config.set(section, option, unicode(converted_value))
+        self._setRaw(section, option, unicode(converted_value))
 
     def getString(self, section, option):
         '''See `IConfigurationProxy`.'''
@@ -264,13 +308,13 @@ class FileConfigurationProxy(object):
 
     def setString(self, section, option, value):
         '''See `IConfigurationProxy`.'''
-        return self._raw_config.set(section, option, value)
+        return self._setRaw(section, option, value)
 
     def setStringOrNone(self, section, option, value):
         '''See `IConfigurationProxy`.'''
         if value is None:
             value = CONFIGURATION_DISABLED_VALUE
-        return self._raw_config.set(section, option, value)
+        return self._setRaw(section, option, value)
 
     def setStringOrInherit(self, section, option, value):
         '''See `IConfigurationProxy`.'''
@@ -308,7 +352,7 @@ class FileConfigurationProxy(object):
         '''See `IConfigurationProxy`.'''
         if value is None:
             value = CONFIGURATION_DISABLED_VALUE
-            return self._raw_config.set(section, option, unicode(value))
+            return self._setRaw(section, option, unicode(value))
         else:
             return self.setInteger(section, option, value)
 
@@ -413,9 +457,13 @@ class ConfigurationFileMixin(PropertyMixin):
 
     implements(IConfiguration)
 
-    def save(self):
+    def save(self, fsync=False):
         '''Store the configuration into file.'''
-        self._proxy.save()
+        self._proxy.save(fsync=fsync)
+
+    def saveLater(self, delay=None):
+        '''Schedule a coalesced save of the configuration.'''
+        return self._proxy.saveLater(delay=delay)
 
     def checkConfigurationFileAndPathArguments(
             self, configuration_path, configuration_file):
@@ -15,6 +15,21 @@ DEFAULT_PUBLIC_KEY_EXTENSION = u'.pub'
 DEFAULT_KEY_SIZE = 1024
 DEFAULT_KEY_TYPE = u'rsa'
 
+# SSL certificates.
+DEFAULT_CERTIFICATE_KEY_SIZE = 2048
+DEFAULT_CERTIFICATE_DIGEST = 'sha256'
+# 10 years in seconds.
+DEFAULT_CERTIFICATE_VALIDITY = 10 * 365 * 24 * 60 * 60
+# Order of the fields in the certificate subject.
+CERTIFICATE_SUBJECT_FIELDS = ('C', 'ST', 'L', 'O', 'OU', 'CN')
+DEFAULT_CERTIFICATE_SUBJECT = (
+    ('C', 'UN'),
+    ('ST', 'Oceania'),
+    ('L', 'Pitcairn Islands'),
+    ('O', 'ACME Inc.'),
+    ('OU', 'Henderson'),
+    )
+
 # File modes.
 DEFAULT_FILE_MODE = 0666
 DEFAULT_FOLDER_MODE = 0777
@@ -26,6 +41,14 @@ LOGGER_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
 CONFIGURATION_ALL_LOG_ENABLED_GROUPS = u'all'
 
 # Log configuration section.
+# Formats used for log entries.
+LOG_FORMAT_TEXT = u'text'
+LOG_FORMAT_JSON = u'json'
+# Values used for selecting the sampled events.
+LOG_SAMPLE_BY_COUNT = u'count'
+LOG_SAMPLE_BY_PEER = u'peer'
+LOG_SAMPLE_BY_AVATAR = u'avatar'
+
 LOG_SECTION_DEFAULTS = {
     'log_enabled': True,
     'log_file': u'',
@@ -33,9 +56,13 @@ LOG_SECTION_DEFAULTS = {
     'log_file_rotate_at_size': 0,
     'log_file_rotate_each': '0 seconds',
     'log_file_rotate_count': 0,
+    'log_file_rotate_compress': False,
+    'log_file_format': u'text',
     'log_syslog': u'',
+    'log_syslog_format': u'text',
     'log_windows_eventlog': u'',
     'log_enabled_groups': CONFIGURATION_ALL_LOG_ENABLED_GROUPS,
+    'log_sampled_groups': u'',
 }
 
 
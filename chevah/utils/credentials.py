@@ -3,7 +3,13 @@ from __future__ import with_statement
 
 __metaclass__ = type
 
-from zope.interface import implements
+from collections import namedtuple, OrderedDict
+import hashlib
+import os
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+from zope.interface import classImplements, implementedBy, implements
 
 from chevah.utils.interfaces import (
     ICredentials,
@@ -20,13 +26,47 @@ from chevah.utils.interfaces import (
     )
 
 
+# Snapshot types for each credentials class.
+_SNAPSHOT_TYPES = {}
+
+
+def _get_snapshot_type(credentials_class):
+    """
+    Return the immutable type used for snapshots of `credentials_class`.
+
+    The snapshot type has a field for each slot of the credentials and
+    provides the same interfaces.
+    """
+    try:
+        return _SNAPSHOT_TYPES[credentials_class]
+    except KeyError:
+        pass
+
+    fields = ['kind_name']
+    for klass in reversed(credentials_class.__mro__):
+        for name in klass.__dict__.get('__slots__', ()):
+            if name not in fields:
+                fields.append(name)
+
+    snapshot_type = namedtuple(
+        credentials_class.__name__ + 'Snapshot', fields)
+    classImplements(snapshot_type, *list(implementedBy(credentials_class)))
+    _SNAPSHOT_TYPES[credentials_class] = snapshot_type
+    return snapshot_type
+
+
 class CredentialsBase(object):
     """
     Base class for credentials used in the server.
+
+    Credentials are created for each authentication request so they
+    only use slots.
     """
 
     implements(ICredentials)
 
+    __slots__ = ('username', 'peer')
+
     def __init__(self, username, peer=None):
         assert type(username) is unicode
         self.username = username
@@ -36,6 +76,17 @@ class CredentialsBase(object):
     def kind_name(self):
         raise NotImplementedError()
 
+    def snapshot(self):
+        """
+        Return an immutable copy of these credentials.
+
+        Snapshots can be passed to other threads, while the credentials
+        are still changed by the protocol.
+        """
+        snapshot_type = _get_snapshot_type(type(self))
+        return snapshot_type._make(
+            [getattr(self, name) for name in snapshot_type._fields])
+
 
 class PasswordCredentials(CredentialsBase):
     """
@@ -43,16 +94,16 @@ class PasswordCredentials(CredentialsBase):
     """
     implements(IPasswordCredentials)
 
+    __slots__ = ('password',)
+
+    kind_name = u'password'
+
     def __init__(self, password=None, token=None, *args, **kwargs):
         super(PasswordCredentials, self).__init__(*args, **kwargs)
         if password:
             assert type(password) is unicode
         self.password = password
 
-    @property
-    def kind_name(self):
-        return u'password'
-
 
 class HTTPBasicAuthCredentials(PasswordCredentials):
     """
@@ -62,6 +113,8 @@ class HTTPBasicAuthCredentials(PasswordCredentials):
     """
     implements(IHTTPBasicAuthCredentials)
 
+    __slots__ = ()
+
 
 class HTTPSBasicAuthCredentials(PasswordCredentials):
     '''Marker class for password based credentials.
@@ -70,21 +123,29 @@ class HTTPSBasicAuthCredentials(PasswordCredentials):
     '''
     implements(IHTTPSBasicAuthCredentials)
 
+    __slots__ = ()
+
 
 class FTPPasswordCredentials(PasswordCredentials):
     '''Marker class for password based credentials used with FTP.'''
     implements(IFTPPasswordCredentials)
 
+    __slots__ = ()
+
 
 class FTPSPasswordCredentials(PasswordCredentials):
     '''Marker class for password based credentials used with FTPS.'''
     implements(IFTPSPasswordCredentials)
 
+    __slots__ = ()
+
 
 class SSHPasswordCredentials(PasswordCredentials):
     '''Marker class for password based credentials used with SFTP.'''
     implements(ISSHPasswordCredentials)
 
+    __slots__ = ()
+
 
 class SSHKeyCredentials(CredentialsBase):
     """
@@ -93,6 +154,11 @@ class SSHKeyCredentials(CredentialsBase):
 
     implements(ISSHKeyCredentials)
 
+    __slots__ = (
+        'key_algorithm', 'key_data', 'key_signed_data', 'key_signature')
+
+    kind_name = u'ssh key'
+
     def __init__(self,
             key_algorithm=None, key_data=None, key_signed_data=None,
             key_signature=None,
@@ -104,9 +170,39 @@ class SSHKeyCredentials(CredentialsBase):
         self.key_signed_data = key_signed_data
         self.key_signature = key_signature
 
+    def getKey(self, cache=None):
+        """
+        Return the parsed public key.
+
+        Keys are obtained from `cache`, which by default is the shared
+        `public_keys_cache`.
+        """
+        if cache is None:
+            from chevah.utils.crypto import public_keys_cache
+            cache = public_keys_cache
+        return cache.get(self.key_data)
+
     @property
-    def kind_name(self):
-        return u'ssh key'
+    def fingerprint(self):
+        """
+        Fingerprint of the public key.
+        """
+        return self.getKey().fingerprint()
+
+    def verify(self, cache=None):
+        """
+        Return `True` if `key_signature` is a valid signature for
+        `key_signed_data`, made with the private part of `key_data`.
+        """
+        if not self.key_data or not self.key_signature:
+            return False
+
+        from chevah.utils.exceptions import UtilsError
+        try:
+            key = self.getKey(cache=cache)
+        except UtilsError:
+            return False
+        return key.verify(self.key_signature, self.key_signed_data)
 
 
 class SSLCertificateCredentials(CredentialsBase):
@@ -116,14 +212,14 @@ class SSLCertificateCredentials(CredentialsBase):
 
     implements(ISSLCertificateCredentials)
 
+    __slots__ = ('certificate',)
+
+    kind_name = u'ssl certificate'
+
     def __init__(self, certificate=None, *args, **kwargs):
         super(SSLCertificateCredentials, self).__init__(*args, **kwargs)
         self.certificate = certificate
 
-    @property
-    def kind_name(self):
-        return u'ssl certificate'
-
 
 class FTPSSSLCertificateCredentials(SSLCertificateCredentials):
     """
@@ -132,6 +228,8 @@ class FTPSSSLCertificateCredentials(SSLCertificateCredentials):
 
     implements(IFTPSSSLCertificateCredentials)
 
+    __slots__ = ()
+
 
 class HTTPSSSLCertificateCredentials(SSLCertificateCredentials):
     """
@@ -139,3 +237,189 @@ class HTTPSSSLCertificateCredentials(SSLCertificateCredentials):
     """
 
     implements(IHTTPSSSLCertificateCredentials)
+
+    __slots__ = ()
+
+
+class AuthenticationCache(object):
+    """
+    Keeps the result of recent authentication requests.
+
+    Results are indexed by a salted hash of the username, kind of the
+    credentials and the secret, so that secrets are not kept in memory.
+
+    Successful results are kept for `ttl` seconds and failed results
+    for `negative_ttl` seconds. Failures are only kept when they are one
+    of `negative_errors`. At most `size` results are kept.
+
+    Results for SSH keys are not cached, as the signature is different
+    for each session and it must be verified for each request.
+    """
+
+    def __init__(self, size=1000, ttl=60, negative_ttl=None,
+            negative_errors=(), reactor=None):
+        self._size = size
+        self._ttl = ttl
+        if negative_ttl is None:
+            negative_ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._negative_errors = negative_errors
+        self._reactor = reactor
+        self._salt = os.urandom(16)
+        self._results = OrderedDict()
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def getKey(self, credentials):
+        """
+        Return the key used for `credentials` or `None` if credentials
+        can not be cached.
+        """
+        if IPasswordCredentials.providedBy(credentials):
+            secret = credentials.password
+            if secret is not None:
+                secret = secret.encode('utf-8')
+        elif ISSHKeyCredentials.providedBy(credentials):
+            # The public key alone does not prove the identity.
+            secret = None
+        elif ISSLCertificateCredentials.providedBy(credentials):
+            certificate = credentials.certificate
+            if hasattr(certificate, 'digest'):
+                secret = certificate.digest('sha1')
+            else:
+                secret = certificate
+        else:
+            secret = None
+
+        if not secret:
+            return None
+
+        digest = hashlib.sha256(self._salt)
+        digest.update(credentials.username.encode('utf-8'))
+        digest.update('\0')
+        digest.update(credentials.kind_name.encode('utf-8'))
+        digest.update('\0')
+        digest.update(secret)
+        return digest.digest()
+
+    def lookup(self, credentials):
+        """
+        Return a deferred firing with the cached result for `credentials`.
+
+        It fires with `None` when no result is cached, and errbacks when
+        a failure was cached.
+        """
+        key = self.getKey(credentials)
+        if key is None:
+            return defer.succeed(None)
+
+        entry = self._results.get(key, None)
+        if entry is not None:
+            result, expire = entry
+            if expire > self._getReactor().seconds():
+                self.hits += 1
+                if isinstance(result, Failure):
+                    return defer.fail(result)
+                return defer.succeed(result)
+            del self._results[key]
+
+        self.misses += 1
+        return defer.succeed(None)
+
+    def store(self, credentials, result):
+        """
+        Keep `result` for `credentials`.
+
+        `result` can be a value or a `Failure`. `None` results and
+        failures which are not one of the negative errors are not kept.
+        """
+        key = self.getKey(credentials)
+        if key is None or result is None:
+            return
+
+        if isinstance(result, Failure):
+            if not result.check(*self._negative_errors):
+                return
+            ttl = self._negative_ttl
+        elif result:
+            ttl = self._ttl
+        else:
+            ttl = self._negative_ttl
+
+        if ttl <= 0:
+            return
+
+        self._results.pop(key, None)
+        while len(self._results) >= self._size:
+            self._results.popitem(last=False)
+        self._results[key] = (result, self._getReactor().seconds() + ttl)
+
+    def authenticate(self, credentials, checker):
+        """
+        Return a deferred with the result of `checker(credentials)`.
+
+        The checker is not called when a result is cached. Requests for
+        the same credentials made while the checker is still running
+        receive the same result.
+        """
+        deferred = self.lookup(credentials)
+
+        def cb_lookup(result):
+            if result is not None:
+                return result
+
+            key = self.getKey(credentials)
+            if key is None:
+                return checker(credentials)
+
+            waiting = defer.Deferred()
+            pending = self._pending.get(key, None)
+            if pending is not None:
+                pending.append(waiting)
+                return waiting
+
+            self._pending[key] = [waiting]
+            checked = defer.maybeDeferred(checker, credentials)
+            checked.addBoth(self._cbChecked, credentials, key)
+            return waiting
+
+        deferred.addCallback(cb_lookup)
+        return deferred
+
+    def _cbChecked(self, result, credentials, key):
+        """
+        Called when the checker has a result for `key`.
+        """
+        self.store(credentials, result)
+        for waiting in self._pending.pop(key, []):
+            if isinstance(result, Failure):
+                waiting.errback(result)
+            else:
+                waiting.callback(result)
+
+    def remove(self, credentials):
+        """
+        Remove the result cached for `credentials`.
+        """
+        key = self.getKey(credentials)
+        if key is not None:
+            self._results.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all cached results.
+        """
+        self._results.clear()
+
+    def _getReactor(self):
+        """
+        Return the reactor used for getting the current time.
+        """
+        if self._reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+        return self._reactor
@@ -4,13 +4,31 @@
 
 __metaclass__ = type
 
+from collections import deque, OrderedDict
+from socket import gethostname
+import hashlib
+import multiprocessing
+import os
+import struct
+import sys
+
 from OpenSSL import crypto, rand
 from Crypto.PublicKey import DSA, RSA
-from twisted.conch.ssh.keys import Key as ConchSSHKey
+from twisted.conch.ssh.keys import BadKeyError, Key as ConchSSHKey
+from twisted.internet import defer, error as internet_error
+from twisted.internet.protocol import ProcessProtocol
 
-from chevah.utils.constants import DEFAULT_KEY_SIZE
+from chevah.utils.constants import (
+    CERTIFICATE_SUBJECT_FIELDS,
+    DEFAULT_CERTIFICATE_DIGEST,
+    DEFAULT_CERTIFICATE_KEY_SIZE,
+    DEFAULT_CERTIFICATE_SUBJECT,
+    DEFAULT_CERTIFICATE_VALIDITY,
+    DEFAULT_KEY_SIZE,
+    )
 from chevah.utils.helpers import _
 from chevah.utils.exceptions import UtilsError
+from chevah.utils.json_file import JSONFile
 
 __all__ = []
 KEY_CLASSES = {
@@ -24,6 +42,7 @@ class Key(ConchSSHKey):
 
     def __init__(self, keyObject=None):
         super(Key, self).__init__(keyObject)
+        self._fingerprint = None
 
     def generate(self, key_type=crypto.TYPE_RSA, key_size=DEFAULT_KEY_SIZE):
         '''Create the key data.'''
@@ -39,6 +58,16 @@ class Key(ConchSSHKey):
             raise UtilsError(u'1004',
                 _(u'Wrong key size "%d". %s.' % (key_size, unicode(error))))
         self.keyObject = key
+        self._fingerprint = None
+
+    def fingerprint(self):
+        '''Return the fingerprint for the public key part.
+
+        The fingerprint is only computed once.
+        '''
+        if self._fingerprint is None:
+            self._fingerprint = super(Key, self).fingerprint()
+        return self._fingerprint
 
     @property
     def size(self):
@@ -67,3 +96,588 @@ class Key(ConchSSHKey):
             public_file.write(public_content)
         if private_file:
             private_file.write(self.private_openssh)
+
+
+class PublicKeyCache(object):
+    """
+    Keeps the most recently used public keys, parsed from SSH key blobs.
+
+    Keys are indexed by the digest of the blob, and when more than
+    `size` keys are cached, the least recently used key is removed.
+    """
+
+    def __init__(self, size=1000):
+        self._size = size
+        self._keys = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, key_data):
+        """
+        Return the `Key` for the public key blob `key_data`.
+        """
+        digest = hashlib.sha1(key_data).digest()
+        try:
+            key = self._keys.pop(digest)
+        except KeyError:
+            self.misses += 1
+            try:
+                key = Key.fromString(key_data, type='blob')
+            except (BadKeyError, ValueError, IndexError, struct.error), error:
+                # Error messages can contain bytes from the blob.
+                details = str(error).decode('utf-8', 'replace')
+                raise UtilsError(u'1038',
+                    _(u'Invalid SSH public key. %s' % (details)))
+            if len(self._keys) >= self._size:
+                self._keys.popitem(last=False)
+        else:
+            self.hits += 1
+
+        # Keys are kept in the order of their usage.
+        self._keys[digest] = key
+        return key
+
+    def clear(self):
+        """
+        Remove all cached keys.
+        """
+        self._keys.clear()
+
+
+# Shared cache for parsing public keys received from clients.
+public_keys_cache = PublicKeyCache()
+
+
+# Script executed by the child process generating a key.
+# On success the private key is written to stdout. For known errors, the
+# event id and message are written to stderr and exit code is 2.
+_GENERATE_KEY_SCRIPT = """
+import sys
+from chevah.utils.crypto import Key
+from chevah.utils.exceptions import UtilsError
+key = Key()
+try:
+    key.generate(key_type=int(sys.argv[1]), key_size=int(sys.argv[2]))
+except UtilsError, error:
+    sys.stderr.write(
+        error.event_id.encode('utf-8') + '\\n' +
+        error.message.encode('utf-8'))
+    sys.exit(2)
+sys.stdout.write(key.private_openssh)
+"""
+
+
+class _KeyGenerationProtocol(ProcessProtocol):
+    """
+    Collects the key generated by a child process.
+    """
+
+    def __init__(self, deferred):
+        self.deferred = deferred
+        self._output = []
+        self._errors = []
+
+    def outReceived(self, data):
+        self._output.append(data)
+
+    def errReceived(self, data):
+        self._errors.append(data)
+
+    def processEnded(self, reason):
+        if self.deferred.called:
+            # Job was cancelled.
+            return
+
+        if reason.check(internet_error.ProcessDone):
+            try:
+                key = Key.fromString(''.join(self._output))
+            except Exception, error:
+                self.deferred.errback(_key_process_error(unicode(error)))
+            else:
+                self.deferred.callback(key)
+            return
+
+        errors = ''.join(self._errors).decode('utf-8', 'replace')
+        if reason.value.exitCode == 2:
+            event_id, separator, message = errors.partition(u'\n')
+            self.deferred.errback(UtilsError(event_id, message))
+        else:
+            self.deferred.errback(_key_process_error(errors))
+
+
+def _key_process_error(details):
+    """
+    Return the error for a failed key generation process.
+    """
+    return UtilsError(u'1036',
+        _(u'Key generation process failed. %s' % (details)))
+
+
+class KeyGenerationPool(object):
+    """
+    Generate keys in child processes without blocking the reactor.
+
+    Key generation is CPU bound so it is done in separate processes.
+    At most `size` keys are generated at the same time, and other
+    requests are queued.
+    """
+
+    def __init__(self, size=None, reactor=None):
+        if size is None:
+            size = multiprocessing.cpu_count()
+        self._size = size
+        self._reactor = reactor
+        self._queue = []
+        self._running = {}
+
+    @property
+    def running(self):
+        """
+        Number of keys which are currently generated.
+        """
+        return len(self._running)
+
+    @property
+    def pending(self):
+        """
+        Number of keys waiting to be generated.
+        """
+        return len(self._queue)
+
+    def generate(self, key_type=crypto.TYPE_RSA, key_size=DEFAULT_KEY_SIZE):
+        """
+        Return a deferred which is called with a new `Key`.
+
+        The generation can be stopped by cancelling the deferred.
+        """
+        if key_type not in [crypto.TYPE_RSA, crypto.TYPE_DSA]:
+            return defer.fail(UtilsError(u'1003',
+                _('Unknown key type "%s".' % (key_type))))
+
+        deferred = defer.Deferred(canceller=self._cancel)
+        self._queue.append((deferred, key_type, key_size))
+        self._startNext()
+        return deferred
+
+    def _getReactor(self):
+        """
+        Return the reactor used for starting processes.
+        """
+        if self._reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+        return self._reactor
+
+    def _startNext(self):
+        """
+        Start queued jobs while there are free slots.
+        """
+        while self._queue and len(self._running) < self._size:
+            deferred, key_type, key_size = self._queue.pop(0)
+            protocol = _KeyGenerationProtocol(deferred)
+            environment = os.environ.copy()
+            environment['PYTHONPATH'] = os.pathsep.join(sys.path)
+            transport = self._getReactor().spawnProcess(
+                protocol,
+                sys.executable,
+                args=[
+                    sys.executable, '-c', _GENERATE_KEY_SCRIPT,
+                    str(key_type), str(key_size)],
+                env=environment,
+                )
+            self._running[deferred] = transport
+            deferred.addBoth(self._jobDone, deferred)
+
+    def _jobDone(self, result, deferred):
+        """
+        Free the slot used by `deferred` and start the next job.
+        """
+        self._running.pop(deferred, None)
+        self._startNext()
+        return result
+
+    def _cancel(self, deferred):
+        """
+        Called when `deferred` is cancelled.
+        """
+        for job in self._queue:
+            if job[0] is deferred:
+                self._queue.remove(job)
+                return
+
+        transport = self._running.get(deferred, None)
+        if transport is None:
+            return
+        try:
+            transport.signalProcess('KILL')
+        except internet_error.ProcessExitedAlready:
+            pass
+
+
+class PregeneratedKeyPool(object):
+    """
+    Keeps RSA keys generated in advance, so that a new key can be
+    obtained right away.
+
+    For each key size from `key_sizes`, up to `capacity` keys are kept.
+    When the number of available keys drops to `low_watermark`, new keys
+    are generated in the background using `generator`, which is a
+    `KeyGenerationPool` by default.
+
+    When `path` is defined, the available keys are stored in that file
+    when the pool is stopped, encrypted with `passphrase`, and loaded
+    back when the pool is started.
+    """
+
+    def __init__(self, key_sizes=None, capacity=10, low_watermark=None,
+            generator=None, path=None, passphrase=None):
+        if key_sizes is None:
+            key_sizes = [DEFAULT_KEY_SIZE]
+        if low_watermark is None:
+            low_watermark = capacity // 2
+        if generator is None:
+            generator = KeyGenerationPool()
+        if path and not passphrase:
+            raise AssertionError(
+                'Stored keys must be encrypted using a passphrase.')
+
+        self._capacity = capacity
+        self._low_watermark = low_watermark
+        self._generator = generator
+        self._path = path
+        self._passphrase = passphrase
+        self._started = False
+        self._keys = {}
+        self._generating = {}
+        self._statistics = {}
+        for key_size in key_sizes:
+            self._keys[key_size] = deque()
+            self._generating[key_size] = []
+            self._statistics[key_size] = {
+                'served': 0,
+                'misses': 0,
+                'low_watermark_hits': 0,
+                }
+
+    def start(self):
+        """
+        Load stored keys and start generating the missing ones.
+        """
+        if self._path:
+            self._load()
+        self._started = True
+        for key_size in self._keys:
+            self._refill(key_size)
+
+    def stop(self):
+        """
+        Stop generating keys and store the available ones.
+        """
+        self._started = False
+        for generating in self._generating.values():
+            for deferred in generating[:]:
+                deferred.cancel()
+        if self._path:
+            self._store()
+
+    def pop(self, key_size=DEFAULT_KEY_SIZE):
+        """
+        Return a RSA key of `key_size`.
+
+        When no pre-generated key is available, the key is generated
+        right away.
+        """
+        keys = self._keys.get(key_size, None)
+        if keys is None:
+            return self._generateNow(key_size)
+
+        statistics = self._statistics[key_size]
+        statistics['served'] += 1
+
+        if keys:
+            key = keys.popleft()
+        else:
+            statistics['misses'] += 1
+            key = self._generateNow(key_size)
+
+        if len(keys) <= self._low_watermark:
+            statistics['low_watermark_hits'] += 1
+            self._refill(key_size)
+
+        return key
+
+    def getStatistics(self):
+        """
+        Return a dictionary, keyed by key size, with the number of
+        available keys, keys in generation, served keys, keys served while
+        the pool was empty and the times the low watermark was reached.
+        """
+        result = {}
+        for key_size, statistics in self._statistics.items():
+            result[key_size] = statistics.copy()
+            result[key_size].update({
+                'available': len(self._keys[key_size]),
+                'generating': len(self._generating[key_size]),
+                })
+        return result
+
+    def _generateNow(self, key_size):
+        """
+        Generate a key while blocking the caller.
+        """
+        key = Key()
+        key.generate(key_type=crypto.TYPE_RSA, key_size=key_size)
+        return key
+
+    def _refill(self, key_size):
+        """
+        Start generating keys until capacity is reached.
+        """
+        if not self._started:
+            return
+
+        generating = self._generating[key_size]
+        missing = (
+            self._capacity - len(self._keys[key_size]) - len(generating))
+        for index in xrange(missing):
+            deferred = self._generator.generate(
+                key_type=crypto.TYPE_RSA, key_size=key_size)
+            generating.append(deferred)
+            deferred.addBoth(self._cbGenerated, deferred, key_size)
+
+    def _cbGenerated(self, result, deferred, key_size):
+        """
+        Called when a background generation is done.
+        """
+        self._generating[key_size].remove(deferred)
+        if isinstance(result, Key):
+            self._keys[key_size].append(result)
+        # Failures are ignored, and the key will be generated on next
+        # refill.
+
+    def _load(self):
+        """
+        Load keys stored in file.
+
+        Keys are removed from the file so that they are never served
+        twice.
+        """
+        from chevah.compat import local_filesystem
+        segments = local_filesystem.getSegmentsFromRealPath(self._path)
+        if not local_filesystem.exists(segments):
+            return
+
+        json_file = JSONFile(path=self._path)
+        json_file.load()
+        try:
+            for key_size, keys_data in json_file.data.items():
+                keys = self._keys.get(int(key_size), None)
+                if keys is None:
+                    continue
+                for key_data in keys_data:
+                    keys.append(Key.fromString(
+                        str(key_data), passphrase=self._passphrase))
+        except Exception, error:
+            raise UtilsError(u'1037', _(
+                u'Failed to load pre-generated keys from "%s". %s' % (
+                    self._path, unicode(error))))
+
+        json_file.data.clear()
+        json_file.save(fsync=True)
+
+    def _store(self):
+        """
+        Store encrypted available keys into file.
+        """
+        json_file = JSONFile(path=self._path)
+        for key_size, keys in self._keys.items():
+            json_file.data[str(key_size)] = [
+                key.toString('openssh', extra=self._passphrase)
+                for key in keys]
+        json_file.save(fsync=True)
+
+
+class CertificateFactory(object):
+    """
+    Create X509 certificates.
+
+    Certificates are self signed or, after an issuer is defined using
+    `setIssuer` or `createCA`, signed by the issuer.
+    The issuer is parsed only once and reused for all issued certificates.
+
+    `subject` is a dictionary with X509 name fields (C, ST, L, O, OU, CN)
+    which is applied over the default subject. The fields are always
+    added in this order.
+    `alternative_names` is a list of subject alternative names, like
+    `DNS:example.com` or `IP:127.0.0.1`. Names without a type are DNS
+    names.
+    `validity` is the number of seconds for which the certificate is
+    valid.
+    """
+
+    def __init__(self, key_type=crypto.TYPE_RSA,
+            key_size=DEFAULT_CERTIFICATE_KEY_SIZE,
+            digest=DEFAULT_CERTIFICATE_DIGEST,
+            validity=DEFAULT_CERTIFICATE_VALIDITY,
+            key_pool=None,
+            ):
+        if key_type not in [crypto.TYPE_RSA, crypto.TYPE_DSA]:
+            raise UtilsError(u'1003',
+                _('Unknown key type "%s".' % (key_type)))
+        self._key_type = key_type
+        self._key_size = key_size
+        self._digest = digest
+        self._validity = validity
+        self._key_pool = key_pool
+        self._issuer_certificate = None
+        self._issuer_key = None
+
+    @property
+    def issuer(self):
+        """
+        The issuer certificate or `None` when certificates are self
+        signed.
+        """
+        return self._issuer_certificate
+
+    def setIssuer(self, certificate_pem, key_pem):
+        """
+        Sign all future certificates using the issuer certificate and key
+        from PEM data.
+        """
+        self._issuer_certificate = crypto.load_certificate(
+            crypto.FILETYPE_PEM, certificate_pem)
+        self._issuer_key = crypto.load_privatekey(
+            crypto.FILETYPE_PEM, key_pem)
+
+    def createKey(self):
+        """
+        Return a new private key.
+        """
+        if self._key_pool is not None and self._key_type == crypto.TYPE_RSA:
+            return crypto.load_privatekey(
+                crypto.FILETYPE_PEM,
+                self._key_pool.pop(self._key_size).private_openssh,
+                )
+
+        key = crypto.PKey()
+        try:
+            key.generate_key(self._key_type, self._key_size)
+        except (ValueError, crypto.Error), error:
+            raise UtilsError(u'1004',
+                _(u'Wrong key size "%d". %s.' % (
+                    self._key_size, unicode(error))))
+        return key
+
+    def createSelfSigned(self, subject=None, alternative_names=None):
+        """
+        Return a tuple of (certificate, key) for a new self signed
+        certificate.
+        """
+        key = self.createKey()
+        certificate = self._createCertificate(
+            key, subject, alternative_names)
+        certificate.set_issuer(certificate.get_subject())
+        certificate.sign(key, self._digest)
+        return (certificate, key)
+
+    def createCA(self, subject=None):
+        """
+        Return a tuple of (certificate, key) for a new self signed
+        certificate authority.
+
+        All future certificates will be signed by this CA.
+        """
+        key = self.createKey()
+        certificate = self._createCertificate(key, subject, None, ca=True)
+        certificate.set_issuer(certificate.get_subject())
+        certificate.sign(key, self._digest)
+        self._issuer_certificate = certificate
+        self._issuer_key = key
+        return (certificate, key)
+
+    def issue(self, subject=None, alternative_names=None):
+        """
+        Return a tuple of (certificate, key) for a new certificate signed
+        by the issuer.
+        """
+        if self._issuer_certificate is None:
+            raise AssertionError('Certificate issuer is not defined.')
+
+        key = self.createKey()
+        certificate = self._createCertificate(
+            key, subject, alternative_names)
+        certificate.set_issuer(self._issuer_certificate.get_subject())
+        certificate.sign(self._issuer_key, self._digest)
+        return (certificate, key)
+
+    def issueMany(self, requests):
+        """
+        Return a list of (certificate, key) tuples for all `requests`.
+
+        Each request is a tuple of (subject, alternative_names).
+        """
+        return [
+            self.issue(subject=subject, alternative_names=alternative_names)
+            for subject, alternative_names in requests]
+
+    @staticmethod
+    def dump(certificate, key):
+        """
+        Return the tuple of (certificate_pem, key_pem).
+        """
+        return (
+            crypto.dump_certificate(crypto.FILETYPE_PEM, certificate),
+            crypto.dump_privatekey(crypto.FILETYPE_PEM, key),
+            )
+
+    def _createCertificate(self, key, subject, alternative_names, ca=False):
+        """
+        Return an unsigned certificate for `key`.
+        """
+        certificate = crypto.X509()
+        # X509 version 3, required for extensions.
+        certificate.set_version(2)
+
+        fields = dict(DEFAULT_CERTIFICATE_SUBJECT)
+        fields['CN'] = gethostname()
+        if subject:
+            fields.update(subject)
+        # Fields are added in a fixed order, followed by any other fields
+        # from `subject`.
+        names = list(CERTIFICATE_SUBJECT_FIELDS) + sorted(
+            set(fields) - set(CERTIFICATE_SUBJECT_FIELDS))
+        certificate_subject = certificate.get_subject()
+        for name in names:
+            value = fields[name]
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            setattr(certificate_subject, name, value)
+
+        certificate.set_serial_number(
+            int(rand.bytes(8).encode('hex'), 16) >> 1)
+        certificate.gmtime_adj_notBefore(0)
+        certificate.gmtime_adj_notAfter(self._validity)
+        certificate.set_pubkey(key)
+
+        extensions = []
+        if ca:
+            extensions.append(crypto.X509Extension(
+                'basicConstraints', True, 'CA:TRUE'))
+        else:
+            extensions.append(crypto.X509Extension(
+                'basicConstraints', False, 'CA:FALSE'))
+        if alternative_names:
+            names = []
+            for name in alternative_names:
+                if ':' not in name:
+                    name = 'DNS:' + name
+                names.append(name.encode('utf-8'))
+            extensions.append(crypto.X509Extension(
+                'subjectAltName', False, ', '.join(names)))
+        certificate.add_extensions(extensions)
+
+        return certificate
@@ -23,14 +23,22 @@ If the event database is not available (for example at product initialization)
 an event can be emitted using emit(ID, MESSAGE). In this case, the event
 will be emitted using default configuration.
 """
-from twisted.internet import defer
+from collections import OrderedDict
+import math
+import zlib
+
+from twisted.internet import defer, task
+from twisted.python import failure
 from zope.interface import implements
 
 from chevah.utils.constants import (
     CONFIGURATION_ALL_LOG_ENABLED_GROUPS,
+    LOG_SAMPLE_BY_AVATAR,
+    LOG_SAMPLE_BY_PEER,
     )
 from chevah.utils.exceptions import UtilsError
 from chevah.utils.helpers import _
+from chevah.utils.instrumentation import instrumentation
 from chevah.utils.interfaces import (
     IEvent,
     IEventDefinition,
@@ -193,6 +201,39 @@ class EventFailedInterpolation(Event):
             id='1025', message=message, data=data)
 
 
+class EventActionFailed(Event):
+    """
+    Event raised when an action associated with an event failed.
+    """
+    def __init__(self, event, action, details):
+        data = {
+            'id': event.id,
+            'action': action.name,
+            'details': details,
+            }
+        message = (
+            'Failed to execute action "%(action)s" for event with id '
+            '"%(id)s". %(details)s' % (data))
+        super(EventActionFailed, self).__init__(
+            id='1039', message=message, data=data)
+
+
+class EventsSuppressed(Event):
+    """
+    Event raised to summarize the events dropped by rate limits.
+    """
+    def __init__(self, event_id, count):
+        data = {
+            'id': event_id,
+            'count': count,
+            }
+        message = (
+            '%(count)s similar events with id "%(id)s" were suppressed.' % (
+                data))
+        super(EventsSuppressed, self).__init__(
+            id='1040', message=message, data=data)
+
+
 EVENT_DEFAULTS = {
     'version_added': u'Disabled',
     'version_removed': u'Disabled',
@@ -337,25 +378,757 @@ class EventsDefinition(JSONFile):
             )
 
 
+class EventAction(object):
+    """
+    Base class for actions performed when an event is emitted.
+
+    `concurrency` limits the number of events for which the action runs
+    at the same time and `timeout` is the number of seconds after which
+    a running action is cancelled.
+    Both are disabled when `None`.
+    """
+
+    def __init__(self, name, concurrency=None, timeout=None):
+        self.name = name
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def __repr__(self):
+        return u'EventAction(name=%s)' % (self.name)
+
+    def run(self, event):
+        """
+        Perform the action for `event`.
+
+        Return a value or a deferred firing when action is done.
+        Actions should not block, so blocking operations should be
+        deferred to a thread or a child process.
+        """
+        raise NotImplementedError()
+
+
+class EventActionsDispatcher(object):
+    """
+    Runs the actions associated with events.
+
+    Actions are associated with event ids or event group names.
+    For each event id, the associated actions are looked up only once.
+
+    At most `size` actions are running at the same time. The other
+    actions are waiting in a queue.
+    """
+
+    def __init__(self, size=10, reactor=None):
+        self._reactor = reactor
+        self._pool = defer.DeferredSemaphore(size)
+        self._semaphores = {}
+        self._by_id = {}
+        self._by_group = {}
+        self._definitions = None
+        self._table = {}
+
+    def addAction(self, action, event_ids=(), groups=()):
+        """
+        Run `action` for events with one of `event_ids` or which are
+        part of one of `groups`.
+        """
+        for event_id in event_ids:
+            self._by_id.setdefault(unicode(event_id), []).append(action)
+        for group in groups:
+            self._by_group.setdefault(group, []).append(action)
+        if action.concurrency:
+            self._semaphores[action] = defer.DeferredSemaphore(
+                action.concurrency)
+        self._table = {}
+
+    def removeAction(self, action):
+        """
+        Stop running `action` for all events.
+        """
+        for actions in self._by_id.values() + self._by_group.values():
+            while action in actions:
+                actions.remove(action)
+        self._semaphores.pop(action, None)
+        self._table = {}
+
+    def compile(self, definitions):
+        """
+        Create the lookup table for all events from `definitions`.
+        """
+        self._definitions = definitions
+        self._table = {}
+        if definitions is None:
+            return
+        for event_id in definitions.getAllEventDefinitions():
+            self.getActions(event_id)
+
+    def getActions(self, event_id):
+        """
+        Return the list of actions associated with `event_id`.
+
+        Actions associated with the event id are first, followed by the
+        actions associated with the groups of the event, in the order of
+        the groups. Actions are in the order in which they were added
+        and are only returned once.
+        """
+        try:
+            return self._table[event_id]
+        except KeyError:
+            pass
+
+        actions = list(self._by_id.get(event_id, []))
+        group_names = []
+        if self._definitions is not None:
+            try:
+                group_names = self._definitions.getEventDefinition(
+                    event_id).group_names
+            except UtilsError:
+                pass
+        for group_name in group_names:
+            for action in self._by_group.get(group_name, []):
+                if action not in actions:
+                    actions.append(action)
+
+        actions = tuple(actions)
+        self._table[event_id] = actions
+        return actions
+
+    def dispatch(self, event):
+        """
+        Run the actions associated with `event`.
+
+        Actions are started after the current call returns.
+        Returns a deferred firing with the list of (action, result)
+        when all actions are done. The result is a `Failure` for failed
+        actions.
+        """
+        actions = self.getActions(event.id)
+        if not actions:
+            return defer.succeed([])
+
+        deferreds = []
+        for action in actions:
+            deferred = defer.Deferred()
+            deferred.addCallback(self._queueAction, action, event)
+            deferred.addBoth(lambda result, action=action: (action, result))
+            self._getReactor().callLater(0, deferred.callback, None)
+            deferreds.append(deferred)
+        return defer.gatherResults(deferreds)
+
+    def _queueAction(self, ignored, action, event):
+        """
+        Wait for a free slot for `action` and for the pool, then run it.
+        """
+        semaphore = self._semaphores.get(action, None)
+        if semaphore is None:
+            return self._pool.run(self._runAction, action, event)
+        return semaphore.run(self._pool.run, self._runAction, action, event)
+
+    def _runAction(self, action, event):
+        """
+        Run `action` and cancel it if it takes too long.
+        """
+        deferred = defer.maybeDeferred(action.run, event)
+        if not action.timeout:
+            return deferred
+
+        delayed_call = self._getReactor().callLater(
+            action.timeout, deferred.cancel)
+
+        def cb_cancel_timeout(result):
+            if delayed_call.active():
+                delayed_call.cancel()
+            return result
+
+        deferred.addBoth(cb_cancel_timeout)
+        return deferred
+
+    def _getReactor(self):
+        """
+        Return the reactor used for scheduling actions.
+        """
+        if self._reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+        return self._reactor
+
+
+class EventRateLimit(object):
+    """
+    A token bucket allowing `rate` events per second, with bursts of at
+    most `burst` events.
+
+    When `per_peer` is True, a separate bucket is used for each peer
+    host, regardless of the port. When more than `max_peers` buckets are
+    used, the least recently updated bucket is removed.
+    """
+
+    def __init__(self, rate, burst=None, per_peer=False, max_peers=10000):
+        self.rate = float(rate)
+        if burst is None:
+            burst = max(rate, 1)
+        self.burst = burst
+        self.per_peer = per_peer
+        self.max_peers = max_peers
+        # Maps a peer host to [tokens, last update time], in the order
+        # of the last update.
+        self._buckets = OrderedDict()
+
+    def consume(self, event, now):
+        """
+        Return `True` if `event` is allowed and take a token for it.
+        """
+        if self.per_peer:
+            key = event.data.get('peer', None)
+            key = getattr(key, 'host', key)
+        else:
+            key = None
+
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            if len(self._buckets) >= self.max_peers:
+                self._buckets.popitem(last=False)
+            self._buckets[key] = [self.burst - 1, now]
+            return True
+
+        self._buckets[key] = bucket
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def prune(self, now):
+        """
+        Remove the buckets which are full again.
+        """
+        for key, (tokens, last) in self._buckets.items():
+            if tokens + (now - last) * self.rate >= self.burst:
+                del self._buckets[key]
+
+
+class EventsRateLimiter(object):
+    """
+    Drops events exceeding the rate limits for their id, groups or peer.
+
+    Limits are associated with event ids or group names. Limits
+    without ids or groups are used for all events.
+
+    The number of dropped events is reported each `summary_interval`
+    seconds.
+    """
+
+    def __init__(self, summary_interval=60, reactor=None):
+        self._summary_interval = summary_interval
+        self._reactor = reactor
+        self._by_id = {}
+        self._by_group = {}
+        self._default = []
+        self._limits = []
+        self._definitions = None
+        self._table = {}
+        self._suppressed = {}
+        self._loop = None
+
+    def addLimit(self, limit, event_ids=(), groups=()):
+        """
+        Apply `limit` to events with one of `event_ids` or which are
+        part of one of `groups`.
+        """
+        for event_id in event_ids:
+            self._by_id.setdefault(unicode(event_id), []).append(limit)
+        for group in groups:
+            self._by_group.setdefault(group, []).append(limit)
+        if not event_ids and not groups:
+            self._default.append(limit)
+        self._limits.append(limit)
+        self._table = {}
+
+    def compile(self, definitions):
+        """
+        Create the lookup table for all events from `definitions`.
+        """
+        self._definitions = definitions
+        self._table = {}
+        if definitions is None:
+            return
+        for event_id in definitions.getAllEventDefinitions():
+            self.getLimits(event_id)
+
+    def getLimits(self, event_id):
+        """
+        Return the limits applied to `event_id`.
+        """
+        try:
+            return self._table[event_id]
+        except KeyError:
+            pass
+
+        limits = list(self._default)
+        limits.extend(self._by_id.get(event_id, []))
+        group_names = []
+        if self._definitions is not None:
+            try:
+                group_names = self._definitions.getEventDefinition(
+                    event_id).group_names
+            except UtilsError:
+                pass
+        for group_name in group_names:
+            for limit in self._by_group.get(group_name, []):
+                if limit not in limits:
+                    limits.append(limit)
+
+        limits = tuple(limits)
+        self._table[event_id] = limits
+        return limits
+
+    def allow(self, event):
+        """
+        Return `True` if `event` should be handled.
+        """
+        try:
+            limits = self._table[event.id]
+        except KeyError:
+            limits = self.getLimits(event.id)
+
+        if not limits:
+            return True
+
+        now = self._getReactor().seconds()
+        for limit in limits:
+            if not limit.consume(event, now):
+                self._suppressed[event.id] = (
+                    self._suppressed.get(event.id, 0) + 1)
+                return False
+        return True
+
+    def popSuppressed(self):
+        """
+        Return a dictionary with the number of suppressed events for
+        each event id, since the last call.
+        """
+        suppressed = self._suppressed
+        self._suppressed = {}
+        return suppressed
+
+    def start(self, summary_callback):
+        """
+        Call `summary_callback(event_id, count)` each summary interval
+        for the suppressed events.
+        """
+        if self._loop is not None:
+            return
+
+        def report():
+            now = self._getReactor().seconds()
+            for limit in self._limits:
+                limit.prune(now)
+            for event_id, count in sorted(self.popSuppressed().items()):
+                summary_callback(event_id, count)
+
+        self._loop = task.LoopingCall(report)
+        self._loop.clock = self._getReactor()
+        self._loop.start(self._summary_interval, now=False)
+
+    def stop(self):
+        """
+        Stop reporting suppressed events.
+        """
+        if self._loop is None:
+            return
+        self._loop.stop()
+        self._loop = None
+
+    def _getReactor(self):
+        """
+        Return the reactor used for getting the current time.
+        """
+        if self._reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+        return self._reactor
+
+
+class EventsSampler(object):
+    """
+    Keeps only a deterministic sample of the events from some groups.
+
+    `sampling` is a dictionary with group names as keys and
+    (rate, key) tuples as values, as returned by
+    `ILogConfigurationSection.sampled_groups`. Only 1 in `rate` events
+    from a group are kept.
+
+    For LOG_SAMPLE_BY_COUNT, each `rate`-th event with the same id is kept.
+    For LOG_SAMPLE_BY_PEER and LOG_SAMPLE_BY_AVATAR, all events of 1 in
+    `rate` peers or avatars are kept, based on the hash of the peer
+    address or of the avatar name. Events without a peer or avatar are
+    sampled by count.
+
+    An event is sampled only when all its groups are sampled, so events
+    which are also part of other groups, like `failure`, are always kept.
+    When multiple groups are sampled, the lowest rate is used.
+    """
+
+    def __init__(self, sampling):
+        self._sampling = sampling
+        self._table = {}
+        self._counters = {}
+        # Maps a group name to [kept, dropped].
+        self._stats = {}
+
+    def getSampling(self, event_definition):
+        """
+        Return the (rate, key, group names) used for sampling events
+        with `event_definition` or `None` when events are not sampled.
+        """
+        try:
+            return self._table[event_definition.id]
+        except KeyError:
+            pass
+
+        result = None
+        group_names = event_definition.group_names
+        samplings = [
+            self._sampling[name]
+            for name in group_names if name in self._sampling
+            ]
+        if samplings and len(samplings) == len(group_names):
+            rate, key = min(samplings)
+            result = (rate, key, tuple(group_names))
+
+        self._table[event_definition.id] = result
+        return result
+
+    def keep(self, event, event_definition):
+        """
+        Return `True` if `event` should be logged.
+        """
+        sampling = self.getSampling(event_definition)
+        if sampling is None:
+            return True
+
+        rate, key, group_names = sampling
+        value = None
+        if key == LOG_SAMPLE_BY_PEER:
+            value = getattr(event.data.get('peer', None), 'host', None)
+        elif key == LOG_SAMPLE_BY_AVATAR:
+            value = getattr(event.data.get('avatar', None), 'name', None)
+
+        if value is None:
+            count = self._counters.get(event.id, 0)
+            self._counters[event.id] = count + 1
+        else:
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            count = zlib.crc32(value) & 0xffffffff
+
+        kept = count % rate == 0
+        for name in group_names:
+            stats = self._stats.get(name, None)
+            if stats is None:
+                stats = [0, 0]
+                self._stats[name] = stats
+            if kept:
+                stats[0] += 1
+            else:
+                stats[1] += 1
+        return kept
+
+    def getStats(self):
+        """
+        Return a dictionary with the number of `kept` and `dropped` events
+        for each sampled group.
+        """
+        result = {}
+        for name, (kept, dropped) in self._stats.items():
+            result[name] = {'kept': kept, 'dropped': dropped}
+        return result
+
+
+class EventsMetrics(object):
+    """
+    Counts the emitted events and their rates, for each event id and
+    for each group.
+
+    Rates are exponentially weighted moving averages over 1, 5 and 15
+    minutes, in events per second, updated each `tick_interval` seconds.
+
+    Recording an event only increments the counter for its id. Groups
+    are aggregated from the counters of event ids when rates are
+    updated or when statistics are requested. No lock is used, as events
+    are emitted from the reactor thread.
+    """
+
+    # Window name and duration in seconds for the rates.
+    WINDOWS = (('1m', 60), ('5m', 300), ('15m', 900))
+
+    def __init__(self, tick_interval=5, reactor=None):
+        self._tick_interval = tick_interval
+        self._reactor = reactor
+        self._alphas = [
+            1 - math.exp(-float(tick_interval) / seconds)
+            for name, seconds in self.WINDOWS
+            ]
+        self._definitions = None
+        self._table = {}
+        self._counts = {}
+        self._ticked_counts = {}
+        self._rates = {}
+        self._group_rates = {}
+        self._loop = None
+
+    def compile(self, definitions):
+        """
+        Create the lookup table with the groups for all events from
+        `definitions`.
+        """
+        self._definitions = definitions
+        self._table = {}
+        if definitions is None:
+            return
+        for event_id in definitions.getAllEventDefinitions():
+            self.getGroupNames(event_id)
+
+    def getGroupNames(self, event_id):
+        """
+        Return the names of the groups for `event_id`.
+        """
+        try:
+            return self._table[event_id]
+        except KeyError:
+            pass
+
+        group_names = ()
+        if self._definitions is not None:
+            try:
+                group_names = tuple(self._definitions.getEventDefinition(
+                    event_id).group_names)
+            except UtilsError:
+                pass
+        self._table[event_id] = group_names
+        return group_names
+
+    def record(self, event_id):
+        """
+        Count an event with `event_id`.
+        """
+        counts = self._counts
+        try:
+            counts[event_id] += 1
+        except KeyError:
+            counts[event_id] = 1
+
+    def tick(self):
+        """
+        Update the rates with the events counted since the previous tick.
+        """
+        group_deltas = {}
+        for event_id, count in self._counts.items():
+            delta = count - self._ticked_counts.get(event_id, 0)
+            self._ticked_counts[event_id] = count
+            self._updateRates(self._rates, event_id, delta)
+            for name in self.getGroupNames(event_id):
+                group_deltas[name] = group_deltas.get(name, 0) + delta
+
+        for name in set(group_deltas.keys() + self._group_rates.keys()):
+            self._updateRates(
+                self._group_rates, name, group_deltas.get(name, 0))
+
+    def _updateRates(self, all_rates, key, delta):
+        """
+        Update the rates for `key` from `all_rates` with `delta` events
+        counted during the last tick.
+        """
+        instant_rate = float(delta) / self._tick_interval
+        rates = all_rates.get(key, None)
+        if rates is None:
+            all_rates[key] = [instant_rate] * len(self._alphas)
+            return
+        for index, alpha in enumerate(self._alphas):
+            rates[index] += alpha * (instant_rate - rates[index])
+
+    def getStats(self):
+        """
+        Return a dictionary with the statistics for `events` by id and
+        for `groups` by name.
+
+        Each statistic is a dictionary with the total `count` and a
+        `rate_1m`, `rate_5m` and `rate_15m` in events per second.
+        """
+        group_counts = {}
+        for event_id, count in self._counts.items():
+            for name in self.getGroupNames(event_id):
+                group_counts[name] = group_counts.get(name, 0) + count
+
+        return {
+            'events': self._getStats(self._counts, self._rates),
+            'groups': self._getStats(group_counts, self._group_rates),
+            }
+
+    def _getStats(self, counts, all_rates):
+        """
+        Return the statistics for `counts` and `all_rates`.
+        """
+        result = {}
+        for key, count in counts.items():
+            rates = all_rates.get(key, [0.0] * len(self.WINDOWS))
+            stats = {'count': count}
+            for index, (name, seconds) in enumerate(self.WINDOWS):
+                stats['rate_' + name] = rates[index]
+            result[key] = stats
+        return result
+
+    def start(self):
+        """
+        Start updating the rates each tick interval.
+        """
+        if self._loop is not None:
+            return
+        self._loop = task.LoopingCall(self.tick)
+        self._loop.clock = self._getReactor()
+        self._loop.start(self._tick_interval, now=False)
+
+    def stop(self):
+        """
+        Stop updating the rates.
+        """
+        if self._loop is None:
+            return
+        self._loop.stop()
+        self._loop = None
+
+    def _getReactor(self):
+        """
+        Return the reactor used for scheduling the rate updates.
+        """
+        if self._reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+        return self._reactor
+
+
+class EventHandle(object):
+    """
+    The resolved details for emitting events with the same id.
+
+    `id` is the unicode id shared by all events, `message_id` is the id
+    used for logging or `None` when the id is not an integer, and
+    `definition` is the EventDefinition or `None` when not defined.
+    """
+
+    def __init__(self, id, message_id, definition):
+        self.id = id
+        self.message_id = message_id
+        self.definition = definition
+
+    def __repr__(self):
+        return u'EventHandle(id=%s)' % (self.id)
+
+
 class EventsHandler(object):
 
     def __init__(self):
+        self._handles = {}
         self._definitions = None
         self._log_configuration_section = None
+        self._actions = None
+        self._rate_limiter = None
+        self._sampler = None
+        self._metrics = None
 
-    def configure(self, definitions, log_configuration_section):
+    def configure(self, definitions, log_configuration_section,
+            actions=None, rate_limiter=None, metrics=None):
         """
         Configure the events handler.
+
+        `actions` is an optional EventActionsDispatcher,
+        `rate_limiter` an optional EventsRateLimiter and
+        `metrics` an optional EventsMetrics.
+
+        Events are sampled based on the `sampled_groups` from
+        `log_configuration_section`.
         """
+        self._unsubscribeSampling()
+        self._handles = {}
         self._definitions = definitions
         self._log_configuration_section = log_configuration_section
+        self._reconfigureSampler()
+        log_configuration_section.subscribe(
+            'sampled_groups', self._reconfigureSampler)
+        self._actions = actions
+        if actions is not None:
+            actions.compile(definitions)
+        if self._rate_limiter is not None:
+            self._rate_limiter.stop()
+        self._rate_limiter = rate_limiter
+        if rate_limiter is not None:
+            rate_limiter.compile(definitions)
+            rate_limiter.start(self._logSuppressed)
+        if self._metrics is not None:
+            self._metrics.stop()
+        self._metrics = metrics
+        if metrics is not None:
+            metrics.compile(definitions)
+            metrics.start()
 
     def removeConfiguration(self):
         """
         Remove all configuration for the handler.
         """
+        self._unsubscribeSampling()
+        self._handles = {}
         self._definitions = None
         self._log_configuration_section = None
+        self._sampler = None
+        self._actions = None
+        if self._rate_limiter is not None:
+            self._rate_limiter.stop()
+        self._rate_limiter = None
+        if self._metrics is not None:
+            self._metrics.stop()
+        self._metrics = None
+
+    def _reconfigureSampler(self, signal=None):
+        """
+        Create the sampler from the log configuration.
+
+        Sampling statistics are reset.
+        """
+        sampling = self._log_configuration_section.sampled_groups
+        if sampling:
+            self._sampler = EventsSampler(sampling)
+        else:
+            self._sampler = None
+
+    def _unsubscribeSampling(self):
+        """
+        Stop following the sampling changes from the current
+        log configuration.
+        """
+        if self._log_configuration_section is None:
+            return
+        self._log_configuration_section.unsubscribe(
+            'sampled_groups', self._reconfigureSampler)
+
+    def getSamplingStats(self):
+        """
+        Return a dictionary with the number of `kept` and `dropped` events
+        for each sampled group.
+        """
+        if self._sampler is None:
+            return {}
+        return self._sampler.getStats()
+
+    def getEventsStats(self):
+        """
+        Return the counters and rates for the emitted events, as returned
+        by `EventsMetrics.getStats`.
+        """
+        if self._metrics is None:
+            return {'events': {}, 'groups': {}}
+        return self._metrics.getStats()
 
     @property
     def configured(self):
@@ -394,19 +1167,73 @@ class EventsHandler(object):
         This is here to make it easier to emit events and to not have to
         import event.Event in each file.
         """
+        try:
+            handle = self._handles[event_id]
+        except KeyError:
+            handle = self.getHandle(event_id)
 
-        if isinstance(event_id, int):
-            event_id = unicode(event_id)
+        event = Event(id=handle.id, message=message, data=data)
+        return self.emitEvent(event)
+
+    def emitFast(self, event_id, message=None, data=None):
+        """
+        Creates an event and calls emitEvent, without waiting for the
+        associated actions.
+
+        Unlike `emit`, it returns `None` and no deferred is created
+        when no actions are configured.
+        """
+        try:
+            handle = self._handles[event_id]
+        except KeyError:
+            handle = self.getHandle(event_id)
+
+        event = Event(id=handle.id, message=message, data=data)
+        self.emitEvent(event, wait=False)
+
+    def getHandle(self, event_id):
+        """
+        Return the EventHandle for `event_id`.
+
+        `event_id` can be an integer, string or unicode value.
+        Handles are created once for each id and are discarded when
+        the handler is configured.
+        """
+        try:
+            return self._handles[event_id]
+        except KeyError:
+            pass
 
-        if isinstance(event_id, str):
-            event_id = unicode(event_id)
+        if isinstance(event_id, int):
+            id = unicode(event_id)
+        elif isinstance(event_id, str):
+            id = unicode(event_id)
+        else:
+            id = event_id
 
-        assert isinstance(event_id, basestring), (
+        assert isinstance(id, basestring), (
             u'Emit id should be unicode or at least as string.')
 
-        event = Event(
-            id=event_id, message=message, data=data)
-        return self.emitEvent(event)
+        handle = self._handles.get(id, None)
+        if handle is None:
+            try:
+                message_id = int(id)
+            except ValueError:
+                message_id = None
+
+            definition = None
+            if self._definitions is not None:
+                try:
+                    definition = self._definitions.getEventDefinition(id)
+                except UtilsError:
+                    pass
+
+            handle = EventHandle(
+                id=id, message_id=message_id, definition=definition)
+            self._handles[id] = handle
+
+        self._handles[event_id] = handle
+        return handle
 
     def log(self, message_id, text, avatar=None, peer=None, data=None):
         """
@@ -423,25 +1250,59 @@ class EventsHandler(object):
         event = Event(id=str(message_id), message=text, data=data)
         return self.emitEvent(event=event)
 
-    def emitEvent(self, event):
+    def emitEvent(self, event, wait=True):
         """
         Pefroms actions associated with event.
 
         Returns a deferred that fires when actions were finalized.
+        When `wait` is False, it returns `None`.
         """
-        # When handler is not configured, we just log the message and stop.
-        if not self.configured:
-            self._logEvent(event)
-            return defer.succeed(None)
+        token = None
+        if instrumentation.enabled:
+            token = instrumentation.start(u'emitEvent %s' % (event.id,))
 
-        self.handleEventLog(event)
-        self.handleEventAction(event)
-        return defer.succeed(None)
+        try:
+            try:
+                handle = self._handles[event.id]
+            except KeyError:
+                handle = self.getHandle(event.id)
+
+            if self._metrics is not None:
+                self._metrics.record(handle.id)
+
+            result = None
+            if not self.configured:
+                # When handler is not configured, we just log the message.
+                self._logEvent(event, message_id=handle.message_id)
+            elif (self._rate_limiter is not None and
+                    not self._rate_limiter.allow(event)):
+                pass
+            else:
+                self._handleEventLog(event, handle)
+                if wait or self._actions is not None:
+                    result = self.handleEventAction(event)
+        finally:
+            if token is not None:
+                instrumentation.stop(token)
+
+        if not wait:
+            return None
+        if result is None:
+            result = defer.succeed(None)
+        return result
 
     def handleEventLog(self, event):
-        try:
-            event_definition = self.definitions.getEventDefinition(event.id)
-        except UtilsError:
+        """
+        Log `event` if its groups are enabled.
+        """
+        self._handleEventLog(event, self.getHandle(event.id))
+
+    def _handleEventLog(self, event, handle):
+        """
+        Log `event` using the definition from `handle`.
+        """
+        event_definition = handle.definition
+        if event_definition is None:
             # FIXME:864:
             # Decide how to handle unknown events.
             # Maybe use a custom exception.
@@ -449,15 +1310,31 @@ class EventsHandler(object):
             self._logEvent(EventNotFound(event=event))
             return
 
-        if self.isLogGroupEnabled(event_definition):
-            self._logEvent(event=event, event_definition=event_definition)
+        if not self.isLogGroupEnabled(event_definition):
+            return
 
-    def _logEvent(self, event, event_definition=None):
+        if (self._sampler is not None and
+                not self._sampler.keep(event, event_definition)):
+            return
+
+        self._logEvent(
+            event=event,
+            event_definition=event_definition,
+            message_id=handle.message_id,
+            )
+
+    def _logEvent(self, event, event_definition=None, message_id=None):
         """
         Log the event.
 
+        When `message_id` is `None` it is converted from the event id.
+
         This is here mostly to help with tests.
         """
+        token = None
+        if instrumentation.enabled:
+            token = instrumentation.start(u'_logEvent %s' % (event.id,))
+
         def interpolate_message(message, data):
             try:
                 result = message % data
@@ -467,38 +1344,72 @@ class EventsHandler(object):
                 result = message
             return result
 
-        if not event.message:
-            if event_definition:
-                message = event_definition.message
-            elif 'message' in event.data:
-                message = event.data['message']
-            else:
-                message = u'None'
-            event.message = interpolate_message(message, event.data)
-
         try:
-            peer = event.data['peer']
-        except KeyError:
-            peer = None
+            if not event.message:
+                if event_definition:
+                    message = event_definition.message
+                elif 'message' in event.data:
+                    message = event.data['message']
+                else:
+                    message = u'None'
+                event.message = interpolate_message(message, event.data)
 
-        try:
-            avatar = event.data['avatar']
-        except KeyError:
-            avatar = None
-
-        Logger.log(
-            message_id=int(event.id),
-            text=event.message,
-            avatar=avatar,
-            peer=peer,
-            data=event.data,
-            )
+            try:
+                peer = event.data['peer']
+            except KeyError:
+                peer = None
+
+            try:
+                avatar = event.data['avatar']
+            except KeyError:
+                avatar = None
+
+            if message_id is None:
+                message_id = int(event.id)
+
+            Logger.log(
+                message_id=message_id,
+                text=event.message,
+                avatar=avatar,
+                peer=peer,
+                data=event.data,
+                )
+        finally:
+            if token is not None:
+                instrumentation.stop(token)
 
     def handleEventAction(self, event):
         """
         Perform associate actions for `event`.
+
+        Returns a deferred that fires when all actions are done.
+        Failed actions are logged.
+        """
+        if self._actions is None:
+            return defer.succeed(None)
+
+        deferred = self._actions.dispatch(event)
+
+        def cb_log_failures(results):
+            for action, result in results:
+                if not isinstance(result, failure.Failure):
+                    continue
+                if result.check(defer.CancelledError):
+                    details = _(u'Timeout after %s seconds.' % (
+                        action.timeout))
+                else:
+                    details = result.getErrorMessage()
+                self._logEvent(EventActionFailed(
+                    event=event, action=action, details=details))
+
+        deferred.addCallback(cb_log_failures)
+        return deferred
+
+    def _logSuppressed(self, event_id, count):
+        """
+        Log the number of events dropped by rate limits.
         """
-        # Will be implemented later.
+        self._logEvent(EventsSuppressed(event_id=event_id, count=count))
 
     def isLogGroupEnabled(self, event_definition):
         """
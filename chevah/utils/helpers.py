@@ -5,7 +5,7 @@
 These code is here due to bad design. We should look for refactoring
 the products so that this code is not needed.
 '''
-from socket import gethostname
+import os
 import sys
 import threading
 import urllib
@@ -28,7 +28,7 @@ def _(string):
     return string
 
 
-def generate_ssh_key(options, key=None, open_method=None):
+def generate_ssh_key(options, key=None, open_method=None, key_pool=None):
     """
     Generate a SSH RSA or DSA key.
 
@@ -36,6 +36,9 @@ def generate_ssh_key(options, key=None, open_method=None):
 
     For success, exit_code is 0.
 
+    When `key_pool` is provided, RSA keys are obtained from this
+    `PregeneratedKeyPool`.
+
     `key` and `open_method` are helpers for dependency injection
     during tests.
     """
@@ -66,7 +69,10 @@ def generate_ssh_key(options, key=None, open_method=None):
         public_file = u'%s%s' % (
             options.key_file, DEFAULT_PUBLIC_KEY_EXTENSION)
 
-        key.generate(key_type=key_type, key_size=key_size)
+        if key_pool is not None and key_type == crypto.TYPE_RSA:
+            key = key_pool.pop(key_size)
+        else:
+            key.generate(key_type=key_type, key_size=key_size)
 
         private_file_path = LocalFilesystem.getEncodedPath(private_file)
         public_file_path = LocalFilesystem.getEncodedPath(public_file)
@@ -103,32 +109,36 @@ def generate_ssh_key(options, key=None, open_method=None):
     return (exit_code, message)
 
 
-def generate_ssl_self_signed_certificate(options=None):
+def generate_ssl_self_signed_certificate(options=None, key_pool=None):
     '''Generate a self signed SSL certificate.
 
+    `options` can define `key_type`, `key_size`, `digest`, `validity`
+    in seconds, `subject` dictionary and `alternative_names` list.
+    See `CertificateFactory`.
+
+    When `key_pool` is provided, the RSA key is obtained from this
+    `PregeneratedKeyPool`.
+
     Returns a tuple of (certificate_pem, key_pem)
     '''
-    key = crypto.PKey()
-    key.generate_key(crypto.TYPE_RSA, 1024)
-
-    # create a self-signed cert
-    cert = crypto.X509()
-    cert.get_subject().C = "UN"
-    cert.get_subject().ST = "Oceania"
-    cert.get_subject().L = "Pitcairn Islands"
-    cert.get_subject().O = "ACME Inc."
-    cert.get_subject().OU = "Henderson"
-    cert.get_subject().CN = gethostname()
-    cert.set_serial_number(1000)
-    cert.gmtime_adj_notBefore(0)
-    cert.gmtime_adj_notAfter(10 * 365 * 24 * 60 * 60)
-    cert.set_issuer(cert.get_subject())
-    cert.set_pubkey(key)
-    cert.sign(key, 'sha1')
-
-    certificate_pem = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
-    key_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM, key)
-    return (certificate_pem, key_pem)
+    from chevah.utils.crypto import CertificateFactory
+
+    arguments = {'key_pool': key_pool}
+    for name in ['key_size', 'digest', 'validity']:
+        value = getattr(options, name, None)
+        if value is not None:
+            arguments[name] = value
+
+    key_type = getattr(options, 'key_type', None)
+    if key_type is not None and key_type.lower() == u'dsa':
+        arguments['key_type'] = crypto.TYPE_DSA
+
+    factory = CertificateFactory(**arguments)
+    certificate, key = factory.createSelfSigned(
+        subject=getattr(options, 'subject', None),
+        alternative_names=getattr(options, 'alternative_names', None),
+        )
+    return factory.dump(certificate, key)
 
 
 def encode_unicode_url(url):
@@ -166,6 +176,168 @@ def encode_unicode_url(url):
     return urlparse.urlunsplit((scheme, netloc, path, query, fragment))
 
 
+def write_file_atomically(segments, content, fsync=False):
+    """
+    Write unicode `content` to the file at `segments`.
+
+    The content is first written into a temporary file which is then
+    renamed over the original file, so that a crash during the write will
+    not leave an incomplete file.
+
+    If `fsync` is True, the file and its parent folder are synced to disk
+    before returning.
+    """
+    from chevah.compat import local_filesystem
+
+    tmp_segments = segments[:]
+    tmp_segments[-1] = tmp_segments[-1] + u'.tmp'
+    store_file = local_filesystem.openFileForWriting(
+        tmp_segments, utf8=True)
+    try:
+        store_file.write(content)
+        if fsync:
+            store_file.flush()
+            os.fsync(store_file.fileno())
+    finally:
+        store_file.close()
+
+    _replace_file(local_filesystem, tmp_segments, segments)
+
+    if fsync:
+        _sync_folder(local_filesystem, segments[:-1])
+
+
+def _replace_file(filesystem, source_segments, destination_segments):
+    """
+    Replace the file at `destination_segments` with the one at
+    `source_segments`.
+    """
+    if os.name != 'nt':
+        # Rename is atomic on Unix and will overwrite the destination.
+        filesystem.rename(source_segments, destination_segments)
+        return
+
+    if not filesystem.exists(destination_segments):
+        filesystem.rename(source_segments, destination_segments)
+        return
+
+    # On Windows rename fails if destination exists, so we first move
+    # the original out of the way, keeping it until the new file is
+    # in place.
+    backup_segments = destination_segments[:]
+    backup_segments[-1] = backup_segments[-1] + u'.bak'
+    if filesystem.exists(backup_segments):
+        filesystem.deleteFile(backup_segments)
+    filesystem.rename(destination_segments, backup_segments)
+    filesystem.rename(source_segments, destination_segments)
+    filesystem.deleteFile(backup_segments)
+
+
+def _sync_folder(filesystem, segments):
+    """
+    Flush to disk the folder entries, so that a rename is persisted.
+
+    On Windows, folders can not be opened so this does nothing.
+    """
+    if os.name == 'nt':
+        return
+
+    path = filesystem.getEncodedPath(
+        filesystem.getRealPathFromSegments(segments))
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class SaveLaterMixin(object):
+    """
+    Mixin for coalescing multiple save requests into a single save.
+
+    Classes using this mixin should define a `save` method which calls
+    `_cancelSaveLater` before saving and `_fireSaveLaterDeferreds` after
+    the data was saved.
+    The reactor used for scheduling the save can be injected using the
+    `_reactor` member.
+    """
+
+    #: Default number of seconds after which a delayed save is executed.
+    SAVE_LATER_DELAY = 1
+
+    _reactor = None
+    _save_later_call = None
+    _save_later_deferreds = ()
+
+    def saveLater(self, delay=None):
+        """
+        Schedule a save after `delay` seconds.
+
+        Multiple calls done before the save is executed are coalesced into
+        a single save.
+        A direct call to `save` will execute the pending save right away.
+
+        Returns a deferred which is called after the data was saved.
+        """
+        from twisted.internet import defer
+
+        if delay is None:
+            delay = self.SAVE_LATER_DELAY
+
+        deferred = defer.Deferred()
+        self._save_later_deferreds = list(self._save_later_deferreds)
+        self._save_later_deferreds.append(deferred)
+
+        if self._save_later_call is None:
+            self._save_later_call = self._getReactor().callLater(
+                delay, self._saveLaterCallback)
+
+        return deferred
+
+    def _saveLaterCallback(self):
+        """
+        Called when a delayed save is due.
+        """
+        self._save_later_call = None
+        try:
+            self.save()
+        except:
+            from twisted.python.failure import Failure
+            failure = Failure()
+            deferreds = self._save_later_deferreds
+            self._save_later_deferreds = ()
+            for deferred in deferreds:
+                deferred.errback(failure)
+
+    def _cancelSaveLater(self):
+        """
+        Cancel the pending delayed save, if any.
+        """
+        if self._save_later_call is None:
+            return
+        if self._save_later_call.active():
+            self._save_later_call.cancel()
+        self._save_later_call = None
+
+    def _fireSaveLaterDeferreds(self):
+        """
+        Inform all callers of `saveLater` that data was saved.
+        """
+        deferreds = self._save_later_deferreds
+        self._save_later_deferreds = ()
+        for deferred in deferreds:
+            deferred.callback(None)
+
+    def _getReactor(self):
+        """
+        Return the reactor used for delayed saves.
+        """
+        if self._reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+        return self._reactor
+
+
 class TimeoutCommunicate(object):
     '''Helper class to execute the Popen.communicate using a timeout.
 
@@ -0,0 +1,291 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+"""
+Lightweight instrumentation for the logging and events code paths.
+
+While disabled, an instrumented call only checks `instrumentation.enabled`.
+While enabled, the duration of each instrumented call is recorded
+together with the stack of the instrumented calls in progress.
+
+Usage at the instrumented code::
+
+    token = None
+    if instrumentation.enabled:
+        token = instrumentation.start(u'name')
+    ...
+    if token is not None:
+        instrumentation.stop(token)
+
+The results can be dumped as a `pstats` file or as collapsed stacks for
+generating flame graphs.
+"""
+from __future__ import with_statement
+
+from timeit import default_timer
+import marshal
+import signal
+import threading
+
+# Formats supported by Instrumentation.dump.
+DUMP_FORMAT_PSTATS = u'pstats'
+DUMP_FORMAT_COLLAPSED = u'collapsed'
+
+# File name used for all pstats entries.
+_PSTATS_FILE = 'chevah.utils'
+
+
+class _ThreadState(object):
+    """
+    Instrumentation state for a single thread.
+
+    Statistics are kept as a dictionary with the stack of names as key
+    and a list of count, total, minimum and maximum duration as value.
+    """
+
+    def __init__(self):
+        self.stack = []
+        self.stats = {}
+
+
+class Instrumentation(object):
+    """
+    Records the duration of instrumented calls.
+
+    Each thread records its own statistics, so no lock is used while
+    recording. Statistics from all threads are merged when requested.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._states = []
+
+    def enable(self):
+        """
+        Start recording.
+        """
+        self.enabled = True
+
+    def disable(self):
+        """
+        Stop recording.
+
+        Already recorded statistics are kept.
+        """
+        self.enabled = False
+
+    def reset(self):
+        """
+        Remove all recorded statistics.
+        """
+        with self._lock:
+            self._local = threading.local()
+            self._states = []
+
+    def start(self, name):
+        """
+        Mark the start of the call called `name` in the current thread.
+
+        Return the token which should be passed to `stop`.
+        """
+        stack = self._getState().stack
+        stack.append(name)
+        return (default_timer(), len(stack))
+
+    def stop(self, token):
+        """
+        Record the duration of the call started with `token`.
+
+        Calls started after `token`, which were not stopped, are
+        discarded.
+        """
+        duration = default_timer() - token[0]
+        state = self._getState()
+        depth = token[1]
+        if len(state.stack) < depth:
+            # Statistics were reset during the call.
+            return
+        key = tuple(state.stack[:depth])
+        del state.stack[depth - 1:]
+
+        stats = state.stats.get(key)
+        if stats is None:
+            state.stats[key] = [1, duration, duration, duration]
+            return
+        stats[0] += 1
+        stats[1] += duration
+        if duration < stats[2]:
+            stats[2] = duration
+        if duration > stats[3]:
+            stats[3] = duration
+
+    def getStacks(self):
+        """
+        Return the statistics from all threads as a dictionary with the
+        stack of names as key and a tuple of count, total, minimum and
+        maximum duration as value.
+        """
+        with self._lock:
+            states = self._states[:]
+
+        result = {}
+        for state in states:
+            for key, stats in state.stats.items():
+                count, total, minimum, maximum = stats
+                existing = result.get(key)
+                if existing is not None:
+                    count += existing[0]
+                    total += existing[1]
+                    minimum = min(minimum, existing[2])
+                    maximum = max(maximum, existing[3])
+                result[key] = (count, total, minimum, maximum)
+        return result
+
+    def getStats(self):
+        """
+        Return the list of statistics for each name, as a dictionary
+        with `name`, `count`, `total`, `minimum`, `maximum` and
+        `average` durations, sorted by the total duration.
+        """
+        by_name = {}
+        for key, stats in self.getStacks().items():
+            count, total, minimum, maximum = stats
+            existing = by_name.get(key[-1])
+            if existing is not None:
+                count += existing[0]
+                total += existing[1]
+                minimum = min(minimum, existing[2])
+                maximum = max(maximum, existing[3])
+            by_name[key[-1]] = (count, total, minimum, maximum)
+
+        result = []
+        for name, stats in by_name.items():
+            count, total, minimum, maximum = stats
+            result.append({
+                'name': name,
+                'count': count,
+                'total': total,
+                'minimum': minimum,
+                'maximum': maximum,
+                'average': total / count,
+                })
+        result.sort(key=lambda item: item['total'], reverse=True)
+        return result
+
+    def dump(self, path, format=DUMP_FORMAT_PSTATS):
+        """
+        Write the statistics to the file at `path`.
+
+        For DUMP_FORMAT_PSTATS, the file can be loaded with `pstats.Stats`.
+        For DUMP_FORMAT_COLLAPSED, each line contains a stack and its own
+        duration in microseconds, as used by flame graph generators.
+        """
+        if format == DUMP_FORMAT_PSTATS:
+            content = marshal.dumps(self._getPstats())
+        elif format == DUMP_FORMAT_COLLAPSED:
+            content = self._getCollapsed()
+        else:
+            raise ValueError('Unknown dump format %s.' % (format,))
+
+        with open(path, 'wb') as stream:
+            stream.write(content)
+
+    def installSignalHandler(self, path, format=DUMP_FORMAT_PSTATS,
+            signal_number=None):
+        """
+        Dump the statistics to `path` each time the process receives
+        `signal_number`.
+
+        By default, SIGUSR2 is used, which is not available on Windows.
+        """
+        if signal_number is None:
+            signal_number = signal.SIGUSR2
+
+        def dump_on_signal(signal_number, frame):
+            self.dump(path, format=format)
+
+        signal.signal(signal_number, dump_on_signal)
+
+    def _getState(self):
+        """
+        Return the state for the current thread.
+        """
+        try:
+            return self._local.state
+        except AttributeError:
+            state = _ThreadState()
+            with self._lock:
+                self._local.state = state
+                self._states.append(state)
+            return state
+
+    def _getOwnTime(self, stacks):
+        """
+        Return a dictionary with the duration of each stack, without the
+        duration of the calls it made.
+        """
+        result = {}
+        for key, stats in stacks.items():
+            result[key] = result.get(key, 0) + stats[1]
+            if len(key) > 1:
+                parent = key[:-1]
+                result[parent] = result.get(parent, 0) - stats[1]
+        for key in result.keys():
+            if key not in stacks:
+                # The parent of a stack was not stopped yet.
+                del result[key]
+        return result
+
+    def _getPstats(self):
+        """
+        Return the statistics in the format used by `pstats`.
+        """
+        stacks = self.getStacks()
+        own_time = self._getOwnTime(stacks)
+
+        result = {}
+        for key, stats in stacks.items():
+            count = stats[0]
+            total = stats[1]
+            own = max(own_time[key], 0)
+            function = (_PSTATS_FILE, 0, key[-1].encode('utf-8'))
+
+            entry = result.get(function)
+            if entry is None:
+                entry = [0, 0, 0.0, 0.0, {}]
+                result[function] = entry
+            entry[0] += count
+            entry[1] += count
+            entry[2] += own
+            entry[3] += total
+
+            if len(key) > 1:
+                caller = (_PSTATS_FILE, 0, key[-2].encode('utf-8'))
+                previous = entry[4].get(caller, (0, 0, 0.0, 0.0))
+                entry[4][caller] = (
+                    previous[0] + count,
+                    previous[1] + count,
+                    previous[2] + own,
+                    previous[3] + total,
+                    )
+
+        return dict([
+            (name, tuple(values)) for name, values in result.items()])
+
+    def _getCollapsed(self):
+        """
+        Return the statistics as collapsed stacks.
+        """
+        lines = []
+        for key, own in sorted(self._getOwnTime(self.getStacks()).items()):
+            microseconds = int(own * 1000000)
+            if microseconds <= 0:
+                continue
+            stack = u';'.join([name.replace(u';', u':') for name in key])
+            lines.append(u'%s %d\n' % (stack, microseconds))
+        return u''.join(lines).encode('utf-8')
+
+
+# Export the singleton used by all instrumented code.
+instrumentation = Instrumentation()
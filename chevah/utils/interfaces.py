@@ -456,7 +456,17 @@ class ILogConfigurationSection(Interface):
         '1 hour | 2 seconds | 2 midnight | 3 Monday | Disabled')
     file_rotate_count = PublicWritableAttribute(
         'How many rotated file to be stored. 3 | 0 | Disabled')
+    file_rotate_compress = PublicWritableAttribute(
+        'Compress the rotated files in background. Yes | No')
+    file_format = PublicWritableAttribute(
+        'Format of the entries written in the log file. text | json')
     syslog = PublicWritableAttribute(
         'SysLog configuration. /path/to/syslog/pype | syslog.host:port')
+    syslog_format = PublicWritableAttribute(
+        'Format of the entries sent to SysLog. text | json')
     enabled_groups = PublicWritableAttribute(
         'List of groups for which logs are emitted.')
+    sampled_groups = PublicWritableAttribute(
+        'Dictionary with groups for which only 1 in N events are logged. '
+        'The values are tuples of N and the sampling key: '
+        'count | peer | avatar')
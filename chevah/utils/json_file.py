@@ -5,25 +5,252 @@ Module for working with JSON files.
 """
 from __future__ import with_statement
 
+import collections
+import hashlib
 import json
+import mmap
+import os
+import re
 
 from chevah.utils.constants import (
     CONFIGURATION_DISABLED_VALUES,
     )
 from chevah.utils.exceptions import UtilsError
+from chevah.utils.helpers import SaveLaterMixin, write_file_atomically
 
+# A comment line, optionally indented.
+JSON_COMMENT = re.compile(r'^[ \t]*# [^\n]*', re.MULTILINE)
+# Tokens used to delimit the values of the top level object: comments,
+# strings (including escaped quotes) and structural characters.
+JSON_TOKEN = re.compile(
+    r'(^[ \t]*# [^\n]*)|"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]:,]', re.MULTILINE)
+# Position of an error as reported by the json module.
+JSON_ERROR_POSITION = re.compile(r'line \d+ column \d+ \(char (\d+)\)$')
 
-class JSONFile(object):
+
+def _blank(match):
+    """
+    Return the replacement for a comment, keeping the same length.
+    """
+    return ' ' * len(match.group())
+
+
+def _get_digest(content):
+    """
+    Return the digest of `content`, using UTF-8 for unicode content.
+    """
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).digest()
+
+
+def _strip_comments(content):
+    """
+    Return `content` with all comment lines replaced by spaces.
+
+    Comments are replaced in a single pass and offsets, line and column
+    numbers are preserved so that parsing errors point to the original
+    content.
+    When there are no comments, `content` is returned without a copy.
+    """
+    if content.find('#') == -1:
+        return content
+    return JSON_COMMENT.sub(_blank, content)
+
+
+def _error_details(error, content=None, offset=0):
+    """
+    Return the details for the parsing `error` of a value found at
+    `offset` in `content`.
+
+    Line and column are reported relative to the whole `content`.
+    """
+    details = str(error)
+    if not offset:
+        return details
+
+    match = JSON_ERROR_POSITION.search(details)
+    if not match:
+        return details
+
+    position = offset + int(match.group(1))
+    line = 1
+    last_new_line = -1
+    new_line = content.find('\n', 0, position)
+    while new_line != -1:
+        line += 1
+        last_new_line = new_line
+        new_line = content.find('\n', new_line + 1, position)
+
+    return '%sline %d column %d (char %d)' % (
+        details[:match.start()], line, position - last_new_line, position)
+
+
+def _bad_format_error(path, details):
+    """
+    Return the error raised when JSON file from `path` is not valid.
+    """
+    data = {
+        'path': path,
+        'details': details,
+        }
+    return UtilsError(u'1028',
+        u'Bad format for JSON file "%(path)s". %(details)s' % (data),
+        data=data)
+
+
+def _index_object(content):
+    """
+    Return a dictionary with the (start, end) offsets in `content` for
+    the value of each key from the top level JSON object.
+
+    Values are not parsed.
+    """
+    index = {}
+    depth = 0
+    key = None
+    value_start = None
+    expect_key = False
+    for match in JSON_TOKEN.finditer(content):
+        if match.lastindex == 1:
+            # Ignore comments.
+            continue
+
+        token = match.group()
+        if depth == 0:
+            if token != '{':
+                raise ValueError('Top level value is not an object.')
+            depth = 1
+            expect_key = True
+            continue
+
+        if depth == 1:
+            if expect_key and token[0] == '"':
+                key = json.loads(token)
+                continue
+            if token == ':':
+                value_start = match.end()
+                expect_key = False
+                continue
+            if token == ',' or token == '}':
+                if key is not None:
+                    index[key] = (value_start, match.start())
+                    key = None
+                if token == '}':
+                    return index
+                expect_key = True
+                continue
+
+        if token == '{' or token == '[':
+            depth += 1
+        elif token == '}' or token == ']':
+            depth -= 1
+
+    raise ValueError('Unterminated top level object.')
+
+
+class LazyJSONObject(collections.MutableMapping):
+    """
+    A top level JSON object for which values are only deserialized when
+    they are first accessed.
+
+    `content` can be a string or a memory mapped file. Memory mapped
+    content is closed once all values were deserialized.
+    """
+
+    def __init__(self, content, path=None):
+        self._content = content
+        self._path = path
+        self._values = {}
+        self._index = {}
+        try:
+            self._index = _index_object(content)
+        except ValueError, error:
+            self.close()
+            raise _bad_format_error(path, str(error))
+        if not self._index:
+            self.close()
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        start, end = self._index[key]
+        try:
+            value = json.loads(_strip_comments(self._content[start:end]))
+        except ValueError, error:
+            raise _bad_format_error(
+                self._path, _error_details(error, self._content, start))
+
+        self._values[key] = value
+        del self._index[key]
+        if not self._index:
+            self.close()
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._index.pop(key, None)
+
+    def __delitem__(self, key):
+        if key in self._index:
+            del self._index[key]
+        else:
+            del self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values or key in self._index
+
+    def __iter__(self):
+        for key in self._values.keys():
+            yield key
+        for key in self._index.keys():
+            yield key
+
+    def __len__(self):
+        return len(self._values) + len(self._index)
+
+    def __repr__(self):
+        return 'LazyJSONObject(loaded=%s, pending=%s)' % (
+            self._values.keys(), self._index.keys())
+
+    def materialize(self):
+        """
+        Deserialize all pending values and return them as a dictionary.
+        """
+        for key in self._index.keys():
+            self[key]
+        return self._values.copy()
+
+    def close(self):
+        """
+        Release the memory mapped content.
+
+        Values which were not yet accessed are deserialized first.
+        """
+        if self._index:
+            self.materialize()
+            return
+
+        close = getattr(self._content, 'close', None)
+        if close:
+            close()
+        self._content = None
+
+
+class JSONFile(SaveLaterMixin):
     """
     A file containing JSON serialized data.
 
     This is a slightly modified version of JSON, which allow single line
     comments. A commented line should start with "# ", note the space after
-    the "#".
+    the "#". The "#" can be preceded by spaces or tabs.
     Inline comments are not supported.
     """
 
-    def __init__(self, path=None, file=None):
+    def __init__(self, path=None, file=None, reactor=None):
         """
         It can be initialized with a path of a file like object.
 
@@ -42,6 +269,8 @@ class JSONFile(object):
             raise AssertionError('You must specify a path or a file.')
 
         self._data = {}
+        self._saved_digest = None
+        self._reactor = reactor
 
     @property
     def data(self):
@@ -64,44 +293,111 @@ class JSONFile(object):
         """
         return self._file
 
-    def load(self):
+    def load(self, lazy=False):
         """
         Load the JSON from input file. Deserialize data.
+
+        Files loaded from a path are memory mapped.
+        When `lazy` is True, the values of the top level object are only
+        deserialized when first accessed.
         """
-        from chevah.compat import local_filesystem
         if self._segments:
-            try:
-                self._file = (
-                    local_filesystem.openFileForReading(
-                        self._segments, utf8=True))
-            except IOError, error:
-                data = {
-                    'path': self._path,
-                    'details': str(error),
-                }
-                raise UtilsError(u'1027',
-                    u'Failed to load JSON file "%(path)s". %(details)s' % (
-                        data),
-                    data=data)
+            content = self._mapFile()
+        else:
+            content = self._file.read()
+
+        if not content:
+            # We have an empty file, so just initialize an empty JSON
+            # structure.
+            self._data = {}
+            self._saved_digest = None
+            return
+
+        if lazy:
+            # Computing the digest would read the whole content.
+            self._saved_digest = None
+            self._data = LazyJSONObject(content, path=self._path)
+            return
+
+        # Saving is skipped while the serialized data is the same as the
+        # loaded content.
+        self._saved_digest = _get_digest(content)
 
         try:
-            result = json.load(self._file)
+            self._data = json.loads(_strip_comments(content)[:])
         except ValueError, error:
-            if not self._file.len:
-                # We have an empty file, so just ignore the error and
-                # initialize an empty JSON structure.
-                result = {}
-            else:
-                data = {
-                    'path': self._path,
-                    'details': str(error),
-                    }
-                raise UtilsError(u'1028',
-                    u'Bad format for JSON file "%(path)s". %(details)s' % (
-                        data),
-                    data=data)
-
-        self._data = result
+            raise _bad_format_error(self._path, str(error))
+        finally:
+            close = getattr(content, 'close', None)
+            if close:
+                close()
+
+    def _mapFile(self):
+        """
+        Return the memory mapped content of the file from path, or
+        an empty string if file is empty.
+        """
+        from chevah.compat import local_filesystem
+        try:
+            input_file = local_filesystem.openFileForReading(
+                self._segments, utf8=False)
+            try:
+                descriptor = input_file.fileno()
+                if not os.fstat(descriptor).st_size:
+                    return ''
+                return mmap.mmap(descriptor, 0, access=mmap.ACCESS_READ)
+            finally:
+                input_file.close()
+        except EnvironmentError, error:
+            data = {
+                'path': self._path,
+                'details': str(error),
+            }
+            raise UtilsError(u'1027',
+                u'Failed to load JSON file "%(path)s". %(details)s' % (
+                    data),
+                data=data)
+
+    def serialize(self):
+        """
+        Return the JSON serialization of data.
+
+        Keys are sorted so that the same data always has the same
+        serialization.
+        """
+        data = self._data
+        if isinstance(data, LazyJSONObject):
+            data = data.materialize()
+        return json.dumps(
+            data, sort_keys=True, indent=4, separators=(',', ': '))
+
+    def save(self, fsync=False):
+        """
+        Serialize data and store it into the file.
+
+        Files from a path are written to a temporary file which is then
+        renamed over the original file.
+        If `fsync` is True, the file is synced to disk before returning.
+
+        The file is not written if data was not changed since last save.
+        """
+        self._cancelSaveLater()
+
+        content = self.serialize()
+        digest = _get_digest(content)
+        if digest == self._saved_digest:
+            self._fireSaveLaterDeferreds()
+            return
+
+        if self._segments:
+            write_file_atomically(self._segments, content, fsync=fsync)
+        else:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(content)
+
+        self._saved_digest = digest
+        self._fireSaveLaterDeferreds()
 
     def getValueOrNone(self, dictionary, key):
         """
@@ -15,6 +15,8 @@ import json
 from twisted.internet import defer
 from twisted.web import resource, server
 
+from chevah.utils.instrumentation import instrumentation
+
 
 def _parseError():
     '''Parse error response.'''
@@ -73,6 +75,18 @@ class JSONRPCResource(resource.Resource, object):
 
     isLeaf = True
 
+    # RingBufferHandler used for getting the recent log entries.
+    log_buffer = None
+
+    # Whether instrumentation can be enabled and queried.
+    instrumentation_enabled = False
+
+    # Path where instrumentation statistics are dumped.
+    instrumentation_path = None
+
+    # EventsMetrics used for getting the events counters and rates.
+    events_metrics = None
+
     def __init__(self):
         super(JSONRPCResource, self).__init__()
         self.public_methods = []
@@ -248,6 +262,79 @@ class JSONRPCResource(resource.Resource, object):
             self.logInternalError(error_details, peer=request.client)
             raise JSONRPCError(error_response)
 
+    def jsonrpc_get_log_entries(self, request,
+            min_id=None, max_id=None, peer=None, avatar=None,
+            start=None, end=None, limit=100):
+        """
+        Return the recent log entries from `log_buffer`.
+
+        Each entry is a list of timestamp, message id, avatar, peer and
+        text.
+        """
+        if self.log_buffer is None:
+            raise JSONRPCError(_methodNotFound(u'Log buffer not enabled.'))
+
+        return self.log_buffer.query(
+            min_id=min_id,
+            max_id=max_id,
+            peer=peer,
+            avatar=avatar,
+            start=start,
+            end=end,
+            limit=limit,
+            )
+
+    def jsonrpc_set_instrumentation(self, request, enabled):
+        """
+        Enable or disable the instrumentation.
+        """
+        if not self.instrumentation_enabled:
+            raise JSONRPCError(
+                _methodNotFound(u'Instrumentation not enabled.'))
+
+        if enabled:
+            instrumentation.enable()
+        else:
+            instrumentation.disable()
+        return instrumentation.enabled
+
+    def jsonrpc_get_instrumentation(self, request):
+        """
+        Return the recorded instrumentation statistics.
+        """
+        if not self.instrumentation_enabled:
+            raise JSONRPCError(
+                _methodNotFound(u'Instrumentation not enabled.'))
+
+        return instrumentation.getStats()
+
+    def jsonrpc_dump_instrumentation(self, request, format=u'pstats'):
+        """
+        Dump the instrumentation statistics to `instrumentation_path`
+        using `format`.
+
+        Returns the path of the dump.
+        """
+        if self.instrumentation_path is None:
+            raise JSONRPCError(
+                _methodNotFound(u'Instrumentation dump not enabled.'))
+
+        try:
+            instrumentation.dump(self.instrumentation_path, format=format)
+        except ValueError, error:
+            raise JSONRPCError(_invalidArguments(unicode(error)))
+        return self.instrumentation_path
+
+    def jsonrpc_get_events_metrics(self, request):
+        """
+        Return the counters and rates for events from `events_metrics`.
+        """
+        if self.events_metrics is None:
+            raise JSONRPCError(
+                _methodNotFound(u'Events metrics not enabled.'))
+
+        return self.events_metrics.getStats()
+
     def logInternalError(self, details, peer=None):
         '''Log an internal error.
 
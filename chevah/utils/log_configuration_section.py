@@ -10,6 +10,11 @@ from zope.interface import implements
 from chevah.utils.configuration import ConfigurationSectionMixin
 from chevah.utils.constants import (
     CONFIGURATION_SECTION_LOG,
+    LOG_FORMAT_JSON,
+    LOG_FORMAT_TEXT,
+    LOG_SAMPLE_BY_AVATAR,
+    LOG_SAMPLE_BY_COUNT,
+    LOG_SAMPLE_BY_PEER,
     )
 from chevah.utils.exceptions import UtilsError
 from chevah.utils.interfaces import ILogConfigurationSection
@@ -27,8 +32,12 @@ class LogConfigurationSection(ConfigurationSectionMixin):
     log_file_rotate_each:
         1 hour | 2 seconds | 2 midnight | 3 Monday | Disabled
     log_file_rotate_count: 3 | 0 | Disabled
+    log_file_rotate_compress: Yes | No
+    log_file_format: text | json
     log_syslog: /path/to/syslog/pipe | syslog.host:port
+    log_syslog_format: text | json
     log_enabled_groups: all
+    log_sampled_groups: informational:10, operational:100:peer
     log_windows_eventlog: sftpplus-server
     '''
 
@@ -64,6 +73,44 @@ class LogConfigurationSection(ConfigurationSectionMixin):
         self._updateWithNotify(
             setter=self._proxy.setStringOrNone, name='syslog', value=value)
 
+    @property
+    def syslog_format(self):
+        '''Return the format of the entries sent to syslog.'''
+        return self._getFormat('syslog_format')
+
+    @syslog_format.setter
+    def syslog_format(self, value):
+        self._setFormat('syslog_format', value)
+
+    def _getFormat(self, name):
+        """
+        Return the log format stored in option `name`.
+        """
+        value = self._proxy.getStringOrNone(
+            self._section_name, self._prefix + '_' + name)
+        if not value:
+            return LOG_FORMAT_TEXT
+        value = value.strip().lower()
+        if value not in (LOG_FORMAT_TEXT, LOG_FORMAT_JSON):
+            raise self._formatError(value)
+        return value
+
+    def _setFormat(self, name, value):
+        """
+        Update the log format stored in option `name`.
+        """
+        if value is None:
+            value = LOG_FORMAT_TEXT
+        value = value.strip().lower()
+        if value not in (LOG_FORMAT_TEXT, LOG_FORMAT_JSON):
+            raise self._formatError(value)
+        self._updateWithNotify(
+            setter=self._proxy.setString, name=name, value=value)
+
+    def _formatError(self, value):
+        return UtilsError(u'1041',
+            _(u'Wrong value for log format. Got: "%s"' % (value)))
+
     def _updateWithNotify(self, setter, name, value):
         """
         Update configuration and notify changes.
@@ -95,6 +142,15 @@ class LogConfigurationSection(ConfigurationSectionMixin):
         self._updateWithNotify(
             setter=self._proxy.setStringOrNone, name='file', value=value)
 
+    @property
+    def file_format(self):
+        '''Return the format of the entries written in the log file.'''
+        return self._getFormat('file_format')
+
+    @file_format.setter
+    def file_format(self, value):
+        self._setFormat('file_format', value)
+
     @property
     def file_rotate_external(self):
         '''Return log_file_rotate_external.'''
@@ -128,6 +184,21 @@ class LogConfigurationSection(ConfigurationSectionMixin):
             value=value,
             )
 
+    @property
+    def file_rotate_compress(self):
+        '''Return log_file_rotate_compress.'''
+        return self._proxy.getBoolean(
+                self._section_name,
+                self._prefix + '_file_rotate_compress')
+
+    @file_rotate_compress.setter
+    def file_rotate_compress(self, value):
+        self._updateWithNotify(
+            setter=self._proxy.setBoolean,
+            name='file_rotate_compress',
+            value=value,
+            )
+
     @property
     def file_rotate_at_size(self):
         '''Return log_file_rotate_at_size.'''
@@ -308,6 +379,82 @@ class LogConfigurationSection(ConfigurationSectionMixin):
             ', '.join(value),
             )
 
+    @property
+    def sampled_groups(self):
+        """
+        Return the dictionary with the sampling for each group.
+
+        The configuration is a comma separated list of GROUP:N[:KEY]
+        meaning that only 1 in N events from GROUP are logged.
+        KEY is `count` by default, or `peer` or `avatar` for sampling
+        based on the hash of the peer address or the avatar name.
+
+        The values are (N, KEY) tuples.
+        """
+        value = self._proxy.getStringOrNone(
+            self._section_name, self._prefix + '_sampled_groups')
+        result = {}
+        if not value:
+            return result
+
+        for item in value.split(','):
+            tokens = [token.strip().lower() for token in item.split(':')]
+            if tokens == [u'']:
+                continue
+            if len(tokens) == 2:
+                tokens.append(LOG_SAMPLE_BY_COUNT)
+            if len(tokens) != 3:
+                raise self._samplingError(_(u'Got: "%s"' % (item.strip())))
+
+            group, rate, key = tokens
+            try:
+                rate = int(rate)
+            except ValueError:
+                raise self._samplingError(
+                    _(u'Rate is not an integer. Got: "%s"' % (rate)))
+            if rate < 1:
+                raise self._samplingError(
+                    _(u'Rate should not be less than 1'))
+            if key not in (
+                    LOG_SAMPLE_BY_COUNT,
+                    LOG_SAMPLE_BY_PEER,
+                    LOG_SAMPLE_BY_AVATAR,
+                    ):
+                raise self._samplingError(
+                    _(u'Unknown sampling key. Got: "%s"' % (key)))
+            result[group] = (rate, key)
+        return result
+
+    @sampled_groups.setter
+    def sampled_groups(self, value):
+        """
+        Set the sampling using a dictionary of (N, KEY) tuples.
+        """
+        self._updateWithNotify(
+            setter=self._setSampling, name='sampled_groups', value=value)
+
+    def _setSampling(self, section, option, value):
+        """
+        Store the sampling dictionary from `value`.
+
+        The previous value is restored if the new value is not valid.
+        """
+        items = []
+        for group, (rate, key) in sorted(value.items()):
+            items.append(u'%s:%s:%s' % (group.lower(), rate, key))
+
+        previous = self._proxy.getString(section, option)
+        self._proxy.setStringOrNone(section, option, u', '.join(items) or None)
+        try:
+            self.sampled_groups
+        except UtilsError:
+            self._proxy.setString(section, option, previous)
+            raise
+
+    def _samplingError(self, details):
+        return UtilsError(u'1042',
+            _(u'Wrong value for log sampling. %s' % (details)))
+
     @property
     def windows_eventlog(self):
         """
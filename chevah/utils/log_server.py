@@ -0,0 +1,295 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+"""
+Send log entries from multiple processes to a single writer process.
+
+Worker processes use a `LogClientHandler` which sends the entries over a
+Unix domain socket. The writer process listens using `LogServerFactory`
+and passes the received entries, in batches, to its own log handlers.
+"""
+from __future__ import with_statement
+
+from collections import deque
+from logging import Handler
+import errno
+import json
+import socket
+import struct
+import time
+
+from twisted.internet import address, protocol, task
+from twisted.protocols.basic import Int32StringReceiver
+
+from chevah.utils.logger import LogEntry
+
+# Prefix for each serialized entry, as used by Int32StringReceiver.
+_FRAME_PREFIX = struct.Struct('!I')
+
+
+class RemoteAvatar(object):
+    """
+    Stand-in for the avatar of an entry received from another process.
+    """
+
+    def __init__(self, name, peer=None):
+        self.name = name
+        self.peer = peer
+
+    def __repr__(self):
+        return u'RemoteAvatar(name=%s)' % (self.name)
+
+
+def serialize_log_entry(record):
+    """
+    Return the serialized representation of `record`.
+    """
+    avatar = None
+    if record.avatar:
+        avatar = record.avatar.name
+
+    host = port = None
+    if record.peer:
+        host = record.peer.host
+        port = record.peer.port
+
+    return json.dumps(
+        [
+            record.message_id,
+            record.timestamp,
+            record.text,
+            avatar,
+            host,
+            port,
+            record.data,
+            ],
+        separators=(',', ':'),
+        default=unicode,
+        )
+
+
+def deserialize_log_entry(content):
+    """
+    Return the `LogEntry` for `content` created by `serialize_log_entry`.
+    """
+    message_id, timestamp, text, avatar, host, port, data = json.loads(
+        content)
+
+    peer = None
+    if host is not None:
+        peer = address.IPv4Address('TCP', host, port)
+
+    if avatar is not None:
+        avatar = RemoteAvatar(avatar, peer=peer)
+
+    return LogEntry(
+        message_id, text,
+        avatar=avatar, peer=peer, data=data, timestamp=timestamp)
+
+
+class LogClientHandler(Handler, object):
+    """
+    Sends log entries to the log server listening at `path`.
+
+    While the server is not available, at most `buffer_size` entries are
+    kept and the oldest entries are dropped.
+    A new connection is tried at most once each `retry_interval` seconds.
+    """
+
+    def __init__(self, path, buffer_size=10000, retry_interval=1):
+        super(LogClientHandler, self).__init__()
+        self.name = u'Log server at %s' % (path)
+        self._path = path
+        self._retry_interval = retry_interval
+        self._buffer = deque(maxlen=buffer_size)
+        # Part of the first buffered frame which was already sent.
+        self._sent = 0
+        self._socket = None
+        self._last_connect = None
+        self.dropped = 0
+
+    @property
+    def buffered(self):
+        """
+        Number of entries waiting to be sent.
+        """
+        return len(self._buffer)
+
+    def emit(self, record):
+        """
+        Queue the entry and send all queued entries.
+        """
+        try:
+            payload = serialize_log_entry(record)
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+                if self._sent:
+                    # The oldest entry was partially sent and is kept.
+                    self.flush()
+                    return
+            self._buffer.append(_FRAME_PREFIX.pack(len(payload)) + payload)
+            self.flush()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def flush(self):
+        """
+        Send as much as possible from the queued entries, without
+        blocking.
+        """
+        if not self._buffer:
+            return
+
+        if self._socket is None and not self._connect():
+            return
+
+        while self._buffer:
+            frame = self._buffer[0]
+            try:
+                sent = self._socket.send(frame[self._sent:])
+            except socket.error, error:
+                if error.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._disconnect()
+                return
+
+            self._sent += sent
+            if self._sent < len(frame):
+                return
+            self._buffer.popleft()
+            self._sent = 0
+
+    def close(self):
+        """
+        Try to send the queued entries and close the connection.
+        """
+        self.acquire()
+        try:
+            self.flush()
+            self._disconnect()
+        finally:
+            self.release()
+        super(LogClientHandler, self).close()
+
+    def _connect(self):
+        """
+        Connect to the server.
+
+        Return `True` on success.
+        """
+        now = time.time()
+        if (self._last_connect is not None and
+                now - self._last_connect < self._retry_interval):
+            return False
+        self._last_connect = now
+
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self._path)
+        except socket.error:
+            client.close()
+            return False
+
+        client.setblocking(False)
+        self._socket = client
+        # A partially sent frame is sent again on the new connection.
+        self._sent = 0
+        return True
+
+    def _disconnect(self):
+        """
+        Close the connection to the server.
+        """
+        if self._socket is None:
+            return
+        try:
+            self._socket.close()
+        except socket.error:
+            pass
+        self._socket = None
+
+
+class LogServerProtocol(Int32StringReceiver):
+    """
+    Receives serialized log entries from a worker process.
+    """
+
+    MAX_LENGTH = 1024 * 1024
+
+    def stringReceived(self, content):
+        try:
+            entry = deserialize_log_entry(content)
+        except (ValueError, TypeError):
+            self.factory.bad_entries += 1
+            return
+        self.factory.addEntry(entry)
+
+
+class LogServerFactory(protocol.ServerFactory):
+    """
+    Receives log entries from worker processes and sends them to the
+    handlers of `logger`.
+
+    Entries are handled each `batch_interval` seconds or as soon as
+    `batch_size` entries were received.
+
+    Usage::
+
+        factory = LogServerFactory()
+        factory.start()
+        reactor.listenUNIX(path, factory)
+    """
+
+    protocol = LogServerProtocol
+
+    def __init__(self, logger=None, batch_size=100, batch_interval=0.1,
+            reactor=None):
+        if logger is None:
+            from chevah.utils.logger import Logger
+            logger = Logger
+        self._logger = logger
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._reactor = reactor
+        self._batch = []
+        self._loop = None
+        self.bad_entries = 0
+
+    def start(self):
+        """
+        Start handling entries periodically.
+        """
+        if self._loop is not None:
+            return
+        self._loop = task.LoopingCall(self.flush)
+        if self._reactor is not None:
+            self._loop.clock = self._reactor
+        self._loop.start(self._batch_interval, now=False)
+
+    def stop(self):
+        """
+        Handle the pending entries and stop the periodic handling.
+        """
+        if self._loop is not None:
+            self._loop.stop()
+            self._loop = None
+        self.flush()
+
+    def addEntry(self, entry):
+        """
+        Queue `entry` for the next batch.
+        """
+        self._batch.append(entry)
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Send all queued entries to the logger handlers.
+        """
+        if not self._batch:
+            return
+        batch = self._batch
+        self._batch = []
+        for entry in batch:
+            self._logger.handle(entry)
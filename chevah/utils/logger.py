@@ -14,6 +14,7 @@ from __future__ import with_statement
 from logging import (
     FileHandler,
     getLogger,
+    Handler,
     INFO,
     LogRecord,
     shutdown,
@@ -26,15 +27,22 @@ from logging.handlers import (
     )
 
 from stat import ST_DEV, ST_INO
+import gzip
+import json
 import os
+import Queue
 import sys
+import threading
 import time
+import traceback
 import types
 
 from chevah.compat.exceptions import (
     ChangeUserException,
     )
 from chevah.utils.constants import (
+    LOG_FORMAT_JSON,
+    LOG_FORMAT_TEXT,
     LOGGER_NAME,
     LOGGER_TIMESTAMP_FORMAT,
     )
@@ -42,6 +50,7 @@ from chevah.utils.exceptions import (
     UtilsError,
     )
 from chevah.utils.helpers import _
+from chevah.utils.instrumentation import instrumentation
 from chevah.utils.observer import ObserverMixin, Signal
 
 if os.name == 'nt':
@@ -129,6 +138,111 @@ class LogEntry(LogRecord, object):
             return u'None'
 
 
+def format_log_entry(record):
+    '''Return the string representation of a LogEntry.'''
+    return u'%d %s %s %s %s %s' % (
+        record.message_id,
+        record.timestamp_hr,
+        record.service_hr,
+        record.avatar_hr,
+        record.peer_hr,
+        record.text,
+        )
+
+
+def _json_default(value):
+    """
+    Return the JSON representation for values which are not native
+    JSON types.
+    """
+    try:
+        return unicode(value)
+    except Exception:
+        return repr(value)
+
+
+def _error_text(error):
+    """
+    Return the text for `error`, even when its message contains
+    non-ASCII bytes.
+    """
+    try:
+        return unicode(error)
+    except Exception:
+        pass
+    try:
+        return str(error).decode('utf-8', 'replace')
+    except Exception:
+        return repr(error)
+
+
+def _decode_json_value(value):
+    """
+    Return `value` with all byte strings decoded as UTF-8, replacing
+    the invalid bytes.
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, dict):
+        return dict([
+            (_decode_json_value(key), _decode_json_value(item))
+            for key, item in value.items()])
+    if isinstance(value, (list, tuple)):
+        return [_decode_json_value(item) for item in value]
+    return value
+
+
+# Encoder reused for all JSON log lines.
+# The output is ASCII so that byte strings from the entry, decoded as
+# UTF-8 by the encoder, can be mixed with unicode values.
+_JSON_LOG_ENCODER = json.JSONEncoder(
+    ensure_ascii=True,
+    check_circular=False,
+    separators=(',', ':'),
+    default=_json_default,
+    )
+_JSON_LOG_TEMPLATE = (
+    u'{"message_id":%d,"timestamp":"%s.%03dZ","service":%s,'
+    u'"avatar":%s,"peer":%s,"text":%s,"data":%s}')
+
+
+def format_log_entry_json(record):
+    """
+    Return the JSON representation of a LogEntry, as a single line.
+    """
+    try:
+        return _format_log_entry_json(record, _JSON_LOG_ENCODER.encode)
+    except UnicodeDecodeError:
+        # Some byte strings are not valid UTF-8.
+        return _format_log_entry_json(
+            record,
+            lambda value: _JSON_LOG_ENCODER.encode(_decode_json_value(value)),
+            )
+
+
+def _format_log_entry_json(record, encode):
+    """
+    Return the JSON line for `record`, encoding the values with `encode`.
+    """
+    timestamp = record.timestamp
+    return _JSON_LOG_TEMPLATE % (
+        record.message_id,
+        time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)),
+        int((timestamp % 1) * 1000),
+        encode(record.service_hr),
+        encode(record.avatar_hr),
+        encode(record.peer_hr),
+        encode(record.text),
+        encode(record.data),
+        )
+
+
+LOG_FORMATTERS = {
+    LOG_FORMAT_TEXT: format_log_entry,
+    LOG_FORMAT_JSON: format_log_entry_json,
+    }
+
+
 class StdOutHandler(StreamHandler, object):
     """
     Prints all logs to standard output.
@@ -170,6 +284,101 @@ class StdOutHandler(StreamHandler, object):
         except:
             self.handleError(record)
 
+
+class RingBufferHandler(Handler, object):
+    """
+    Keeps the last `capacity` log entries in memory.
+
+    Entries are stored as (timestamp, message_id, avatar, peer, text)
+    tuples, using the human readable avatar and peer.
+    Logs are not persisted.
+    """
+
+    def __init__(self, capacity=10000):
+        super(RingBufferHandler, self).__init__()
+        self.name = u'Memory buffer for %d entries' % (capacity)
+        self._capacity = capacity
+        self._entries = [None] * capacity
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def emit(self, record):
+        """
+        Store the log entry, overwriting the oldest entry when full.
+        """
+        self._entries[self._next] = (
+            record.timestamp,
+            record.message_id,
+            record.avatar_hr,
+            record.peer_hr,
+            record.text,
+            )
+        self._next = (self._next + 1) % self._capacity
+        if self._count < self._capacity:
+            self._count += 1
+
+    def query(self, min_id=None, max_id=None, peer=None, avatar=None,
+            start=None, end=None, limit=None):
+        """
+        Return the list of stored entries matching all filters, from the
+        oldest to the newest.
+
+        `peer` matches the peer address with or without the port.
+        `start` and `end` are timestamps limiting the time window.
+        When `limit` is defined only the newest `limit` entries are
+        returned.
+        """
+        result = []
+        self.acquire()
+        try:
+            index = self._next
+            for position in xrange(self._count):
+                index -= 1
+                if index < 0:
+                    index = self._capacity - 1
+                entry = self._entries[index]
+                timestamp, message_id, entry_avatar, entry_peer, text = entry
+
+                if end is not None and timestamp > end:
+                    continue
+                if start is not None and timestamp < start:
+                    # Entries are stored in chronological order.
+                    break
+                if min_id is not None and message_id < min_id:
+                    continue
+                if max_id is not None and message_id > max_id:
+                    continue
+                if avatar is not None and entry_avatar != avatar:
+                    continue
+                if peer is not None and entry_peer != peer:
+                    if entry_peer.rsplit(u':', 1)[0] != peer:
+                        continue
+
+                result.append(entry)
+                if limit is not None and len(result) >= limit:
+                    break
+        finally:
+            self.release()
+
+        result.reverse()
+        return result
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        self.acquire()
+        try:
+            self._entries = [None] * self._capacity
+            self._next = 0
+            self._count = 0
+        finally:
+            self.release()
+
+
 if os.name == 'nt':
     from logging.handlers import NTEventLogHandler
 
@@ -189,6 +398,727 @@ else:
     WindowsEventLogHandler = None
 
 
+class ArchiveCompressor(object):
+    """
+    Compresses rotated log files using a background thread.
+
+    The thread is started when the first file is queued.
+    """
+
+    # Size of the chunks read when compressing a file.
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def compress(self, path, callback=None):
+        """
+        Queue `path` for compression.
+
+        `callback` is called from the compression thread, after the
+        file was compressed.
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.isAlive():
+                self._thread = threading.Thread(
+                    target=self._run, name='log-archive-compressor')
+                self._thread.setDaemon(True)
+                self._thread.start()
+        self._queue.put((path, callback))
+
+    def wait(self):
+        """
+        Block until all queued files were compressed.
+        """
+        self._queue.join()
+
+    def _run(self):
+        """
+        Compress the queued files.
+        """
+        while True:
+            path, callback = self._queue.get()
+            try:
+                self._compressFile(path)
+                if callback is not None:
+                    callback()
+            except:
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
+    def _compressFile(self, path):
+        """
+        Replace `path` with its gzip compressed version.
+        """
+        compressed_path = path + '.gz'
+        partial_path = compressed_path + '.part'
+        source = open(path, 'rb')
+        try:
+            destination = gzip.open(partial_path, 'wb')
+            try:
+                while True:
+                    chunk = source.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    destination.write(chunk)
+            finally:
+                destination.close()
+        finally:
+            source.close()
+        os.rename(partial_path, compressed_path)
+        os.remove(path)
+
+
+# Shared compressor for all rotating handlers.
+archive_compressor = ArchiveCompressor()
+
+
+class CompressedArchivesMixin(object):
+    """
+    Rotation which only renames the log file, while the archive is
+    compressed and old archives are removed in background.
+
+    Archives are stored as `baseFilename.SUFFIX.gz` and sorting their
+    names should sort them by age.
+    """
+
+    compressor = None
+
+    def _archive(self, archive_path):
+        """
+        Rename the current log file to `archive_path` and open a new one.
+        """
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, archive_path)
+            compressor = self.compressor
+            if compressor is None:
+                compressor = archive_compressor
+            compressor.compress(archive_path, self.removeOldArchives)
+        self.stream = self._open()
+
+    def _getArchivePath(self, suffix):
+        """
+        Return a new path for an archive using `suffix`.
+        """
+        path = '%s.%s' % (self.baseFilename, suffix)
+        index = 0
+        candidate = path
+        while (os.path.exists(candidate) or
+                os.path.exists(candidate + '.gz')):
+            index += 1
+            candidate = '%s.%d' % (path, index)
+        return candidate
+
+    def getArchives(self):
+        """
+        Return the list of paths for the compressed archives, from the
+        oldest to the newest.
+        """
+        folder, name = os.path.split(self.baseFilename)
+        prefix = name + '.'
+        result = []
+        for member in os.listdir(folder):
+            if member.startswith(prefix) and member.endswith('.gz'):
+                result.append(os.path.join(folder, member))
+        result.sort()
+        return result
+
+    def removeOldArchives(self):
+        """
+        Keep only the newest `backupCount` compressed archives.
+        """
+        if self.backupCount <= 0:
+            return
+        archives = self.getArchives()
+        for path in archives[:-self.backupCount]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class CompressedRotatingFileHandler(
+        CompressedArchivesMixin, RotatingFileHandler):
+    """
+    A file rotated at size, which keeps compressed archives.
+    """
+
+    def __init__(self, filename, maxBytes=0, backupCount=0, encoding=None,
+            compressor=None):
+        RotatingFileHandler.__init__(
+            self, filename, mode='a', maxBytes=maxBytes,
+            backupCount=backupCount, encoding=encoding)
+        self.compressor = compressor
+
+    def doRollover(self):
+        """
+        Rename the log file using the current time.
+        """
+        now = time.time()
+        suffix = '%s-%06d' % (
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+            int((now % 1) * 1000000),
+            )
+        self._archive(self._getArchivePath(suffix))
+
+
+class ScheduledTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    A file rotated at time intervals, using a timer.
+
+    The timer only marks that a rotation is pending, and the rotation is
+    done by the next emitted record. Emitting a record does not check the
+    current time.
+
+    Rotation times are computed from the previous rotation time, using
+    the local calendar for `midnight` and `w0` to `w6`. `interval` counts
+    the number of midnights or weeks. Weekly rotation is done at the
+    start of the day.
+
+    The timer is scheduled using `reactor` or, when no reactor is
+    used, using a thread.
+    """
+
+    def __init__(self, filename, when='h', interval=1, backupCount=0,
+            encoding=None, reactor=None):
+        TimedRotatingFileHandler.__init__(
+            self, filename, when=when, interval=interval,
+            backupCount=backupCount, encoding=encoding)
+        self._count = interval
+        self._reactor = reactor
+        self._timer = None
+        self._rollover_lock = threading.Lock()
+        self.rollover_pending = False
+
+        now = self._now()
+        self._period_start = now
+        self._pending_start = now
+        self.rolloverAt = self._computeFirstRollover(now)
+        self._scheduleRollover()
+
+    def emit(self, record):
+        """
+        Emit a record, after rotating the file when the rotation time
+        has passed.
+        """
+        try:
+            if self.rollover_pending:
+                self.doRollover()
+            FileHandler.emit(self, record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def shouldRollover(self, record):
+        """
+        Return `True` when the rotation time has passed.
+        """
+        return self.rollover_pending
+
+    def doRollover(self):
+        """
+        Rename the log file using the start time of the rotated interval.
+        """
+        with self._rollover_lock:
+            self.rollover_pending = False
+            start = self._pending_start
+        self._rotate(time.strftime(self.suffix, time.localtime(start)))
+
+    def close(self):
+        """
+        Stop the timer and close the file.
+        """
+        self._cancelTimer()
+        TimedRotatingFileHandler.close(self)
+
+    def _rotate(self, suffix):
+        """
+        Rename the log file using `suffix` and remove the old archives.
+        """
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        archive_path = '%s.%s' % (self.baseFilename, suffix)
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, archive_path)
+        if self.backupCount > 0:
+            for path in self.getFilesToDelete():
+                os.remove(path)
+        self.stream = self._open()
+
+    def _now(self):
+        """
+        Return the current time.
+        """
+        if self._reactor is not None:
+            return self._reactor.seconds()
+        return time.time()
+
+    def _computeFirstRollover(self, now):
+        """
+        Return the first rotation time after `now`.
+        """
+        if self.when == 'MIDNIGHT':
+            return self._addDays(now, 1)
+
+        if self.when.startswith('W'):
+            days = (self.dayOfWeek - time.localtime(now).tm_wday) % 7
+            if days == 0:
+                days = 7
+            return self._addDays(now, days)
+
+        return now + self.interval
+
+    def _computeNextRollover(self, previous, now):
+        """
+        Return the first rotation time after `now`, counting intervals
+        from the `previous` rotation time.
+        """
+        rollover_at = previous
+        while rollover_at <= now:
+            if self.when == 'MIDNIGHT':
+                rollover_at = self._addDays(rollover_at, self._count)
+            elif self.when.startswith('W'):
+                rollover_at = self._addDays(rollover_at, 7 * self._count)
+            else:
+                missed = int((now - rollover_at) // self.interval)
+                rollover_at += (missed + 1) * self.interval
+        return rollover_at
+
+    def _addDays(self, timestamp, days):
+        """
+        Return the local midnight `days` days after `timestamp`.
+        """
+        local = time.localtime(timestamp)
+        return time.mktime((
+            local.tm_year, local.tm_mon, local.tm_mday + days,
+            0, 0, 0, 0, 0, -1))
+
+    def _scheduleRollover(self):
+        """
+        Schedule the timer for the next rotation time.
+        """
+        delay = max(self.rolloverAt - self._now(), 0)
+        if self._reactor is not None:
+            self._timer = self._reactor.callLater(delay, self._onTimer)
+        else:
+            self._timer = threading.Timer(delay, self._onTimer)
+            self._timer.setDaemon(True)
+            self._timer.start()
+
+    def _cancelTimer(self):
+        """
+        Stop the timer.
+        """
+        with self._rollover_lock:
+            timer = self._timer
+            self._timer = None
+        if timer is None:
+            return
+        if self._reactor is not None:
+            if timer.active():
+                timer.cancel()
+        else:
+            timer.cancel()
+
+    def _onTimer(self):
+        """
+        Called when the rotation time was reached.
+        """
+        with self._rollover_lock:
+            if self._timer is None:
+                # Handler was closed.
+                return
+
+            now = self._now()
+            if now >= self.rolloverAt:
+                if not self.rollover_pending:
+                    self._pending_start = self._period_start
+                    self.rollover_pending = True
+                self._period_start = self.rolloverAt
+                self.rolloverAt = self._computeNextRollover(
+                    self.rolloverAt, now)
+            # When the clock was changed, the timer can fire too early,
+            # and it is scheduled again.
+            self._scheduleRollover()
+
+
+class CompressedScheduledTimedRotatingFileHandler(
+        CompressedArchivesMixin, ScheduledTimedRotatingFileHandler):
+    """
+    A file rotated at time intervals using a timer, which keeps
+    compressed archives.
+    """
+
+    def __init__(self, filename, when='h', interval=1, backupCount=0,
+            encoding=None, reactor=None, compressor=None):
+        ScheduledTimedRotatingFileHandler.__init__(
+            self, filename, when=when, interval=interval,
+            backupCount=backupCount, encoding=encoding, reactor=reactor)
+        self.compressor = compressor
+
+    def _rotate(self, suffix):
+        """
+        Rename the log file using `suffix` and compress it.
+        """
+        self._archive(self._getArchivePath(suffix))
+
+
+class SizeAndTimeRotatingFileHandler(
+        CompressedArchivesMixin, ScheduledTimedRotatingFileHandler):
+    """
+    A file rotated at time intervals or when reaching `maxBytes`, which
+    ever comes first.
+
+    The size is tracked from the written bytes. After each rotation, the
+    next log file is opened in background using a temporary name, so
+    that the rotation only renames the files. When `compress` is True,
+    archives are compressed in background.
+
+    Archives are named using the time when the file was started, so that
+    they are sorted by age.
+    """
+
+    def __init__(self, filename, when='h', interval=1, maxBytes=0,
+            backupCount=0, encoding=None, reactor=None, compress=False,
+            compressor=None):
+        self.maxBytes = maxBytes
+        self.compress = compress
+        self.compressor = compressor
+        self._next_path = os.path.abspath(filename) + '.next'
+        self._next_stream = None
+        self._next_lock = threading.Lock()
+        self._closed = False
+        self._prepare_thread = None
+        ScheduledTimedRotatingFileHandler.__init__(
+            self, filename, when=when, interval=interval,
+            backupCount=backupCount, encoding=encoding, reactor=reactor)
+        self._size = os.fstat(self.stream.fileno()).st_size
+        self._file_start = self._now()
+        self._prepareLater()
+
+    def emit(self, record):
+        """
+        Emit a record, after rotating the file when the rotation time
+        has passed or the file would become larger than `maxBytes`.
+        """
+        try:
+            data = self.format(record)
+            if isinstance(data, unicode):
+                data = data.encode(self.encoding or 'utf-8')
+            data += END_OF_LINE
+
+            if self.rollover_pending or (
+                    self.maxBytes > 0 and self._size > 0 and
+                    self._size + len(data) > self.maxBytes):
+                self.doRollover()
+
+            self.stream.write(data)
+            self.stream.flush()
+            self._size += len(data)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def doRollover(self):
+        """
+        Rename the log file using the time when it was started.
+        """
+        with self._rollover_lock:
+            self.rollover_pending = False
+        start = self._file_start
+        self._rotate('%s-%06d' % (
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(start)),
+            int((start % 1) * 1000000),
+            ))
+
+    def close(self):
+        """
+        Close the current and the prepared log file.
+        """
+        with self._next_lock:
+            self._closed = True
+            next_stream = self._next_stream
+            self._next_stream = None
+        if next_stream is not None:
+            next_stream.close()
+            os.remove(self._next_path)
+        ScheduledTimedRotatingFileHandler.close(self)
+
+    def getArchives(self):
+        """
+        Return the list of paths for the archives, from the oldest to the
+        newest.
+        """
+        folder, name = os.path.split(self.baseFilename)
+        prefix = name + '.'
+        next_name = os.path.basename(self._next_path)
+        result = []
+        for member in os.listdir(folder):
+            if not member.startswith(prefix) or member == next_name:
+                continue
+            if member.endswith('.part'):
+                continue
+            if self.compress != member.endswith('.gz'):
+                continue
+            result.append(os.path.join(folder, member))
+        result.sort()
+        return result
+
+    def _open(self):
+        """
+        Open the log file for appending bytes.
+        """
+        return open(self.baseFilename, 'ab')
+
+    def _rotate(self, suffix):
+        """
+        Rename the log file using `suffix` and use the prepared file.
+        """
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+        archive_path = self._getArchivePath(suffix)
+        if os.path.exists(self.baseFilename):
+            os.rename(self.baseFilename, archive_path)
+        else:
+            archive_path = None
+
+        with self._next_lock:
+            next_stream = self._next_stream
+            self._next_stream = None
+        if next_stream is not None:
+            try:
+                os.rename(self._next_path, self.baseFilename)
+            except OSError:
+                next_stream.close()
+                next_stream = None
+        if next_stream is None:
+            next_stream = self._open()
+
+        self.stream = next_stream
+        self._size = 0
+        self._file_start = self._now()
+        self._prepareLater(archive_path)
+
+    def _prepareLater(self, archive_path=None):
+        """
+        Handle the archive and open the next file in background.
+        """
+        thread = threading.Thread(
+            target=self._prepare, args=(archive_path,),
+            name='log-file-prepare')
+        thread.setDaemon(True)
+        thread.start()
+        self._prepare_thread = thread
+
+    def wait(self):
+        """
+        Block until the background work for the last rotation is done.
+        """
+        if self._prepare_thread is not None:
+            self._prepare_thread.join()
+
+    def _prepare(self, archive_path):
+        """
+        Compress or remove old archives and open the next log file.
+        """
+        try:
+            if archive_path is not None:
+                if self.compress:
+                    compressor = self.compressor
+                    if compressor is None:
+                        compressor = archive_compressor
+                    compressor.compress(archive_path, self.removeOldArchives)
+                else:
+                    self.removeOldArchives()
+
+            if os.name == 'nt':
+                # Open files can not be renamed on Windows.
+                return
+
+            with self._next_lock:
+                if self._next_stream is None and not self._closed:
+                    self._next_stream = open(self._next_path, 'wb')
+        except:
+            traceback.print_exc(file=sys.stderr)
+
+
+class QueuedHandler(Handler, object):
+    """
+    Sends log entries to `handler` from a separate thread, so that a slow
+    or failing handler does not delay the other handlers.
+
+    At most `queue_size` entries are waiting, and new entries are dropped
+    when the queue is full.
+
+    After `failure_threshold` consecutive failures, the handler is
+    disabled for `recovery_time` seconds and entries are dropped.
+    """
+
+    # Marker for stopping the worker thread.
+    _STOP = object()
+
+    def __init__(self, handler, queue_size=10000, failure_threshold=5,
+            recovery_time=30):
+        super(QueuedHandler, self).__init__()
+        self.handler = handler
+        self.name = handler.name
+        self._queue = Queue.Queue(queue_size)
+        self._failure_threshold = failure_threshold
+        self._recovery_time = recovery_time
+        self._consecutive_failures = 0
+        self._disabled_until = None
+        self._failed = False
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_error = None
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+        # Failures are reported by handlers using handleError.
+        handler.handleError = self._handleTargetError
+
+        self._thread = threading.Thread(
+            target=self._run, name='log-handler %s' % (self.name))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    @property
+    def disabled(self):
+        """
+        `True` while the handler is disabled after consecutive failures.
+        """
+        return (
+            self._disabled_until is not None and
+            self._disabled_until > time.time()
+            )
+
+    def handle(self, record):
+        """
+        Queue the entry, without locking.
+        """
+        self.emit(record)
+
+    def emit(self, record):
+        """
+        Queue the entry, or drop it when queue is full or handler is
+        disabled.
+        """
+        if self.disabled:
+            self.dropped += 1
+            return
+        try:
+            self._queue.put_nowait((record, time.time()))
+        except Queue.Full:
+            self.dropped += 1
+
+    def getStats(self):
+        """
+        Return a dictionary with the statistics for this handler.
+        """
+        attempts = self.handled + self.errors
+        if attempts:
+            latency_average = self._latency_total / attempts
+        else:
+            latency_average = 0.0
+        return {
+            'name': self.name,
+            'queued': self._queue.qsize(),
+            'handled': self.handled,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'last_error': self.last_error,
+            'latency_average': latency_average,
+            'latency_max': self._latency_max,
+            'disabled': self.disabled,
+            }
+
+    def join(self):
+        """
+        Block until all queued entries were handled.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Handle the queued entries, stop the thread and close the handler.
+        """
+        if self._thread.isAlive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+        self.handler.close()
+        super(QueuedHandler, self).close()
+
+    def _run(self):
+        """
+        Handle the queued entries.
+        """
+        while True:
+            item = self._queue.get()
+            try:
+                if item is self._STOP:
+                    return
+                record, queued = item
+                if self.disabled:
+                    self.dropped += 1
+                    continue
+                try:
+                    self._handleRecord(record, queued)
+                except:
+                    # The worker thread should never stop, as no entries
+                    # would be handled after that.
+                    self.errors += 1
+            finally:
+                self._queue.task_done()
+
+    def _handleRecord(self, record, queued):
+        """
+        Send `record` to the handler and update the statistics.
+        """
+        self._failed = False
+        try:
+            self.handler.handle(record)
+        except Exception, error:
+            self._failed = True
+            self.last_error = _error_text(error)
+
+        latency = time.time() - queued
+        self._latency_total += latency
+        if latency > self._latency_max:
+            self._latency_max = latency
+
+        if not self._failed:
+            self.handled += 1
+            self._consecutive_failures = 0
+            self._disabled_until = None
+            return
+
+        self.errors += 1
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= self._failure_threshold:
+            self._disabled_until = time.time() + self._recovery_time
+
+    def _handleTargetError(self, record):
+        """
+        Called by the handler when it failed to emit `record`.
+        """
+        self._failed = True
+        self.last_error = _error_text(sys.exc_info()[1])
+
+
 class _Logger(ObserverMixin):
     '''This class is supposed to be a singleton logger.'''
 
@@ -207,6 +1137,8 @@ class _Logger(ObserverMixin):
         self._log_ntevent_handler = None
         self._new_handler_added = False
         self._configuration = None
+        self._queue_options = None
+        self._queued_handlers = {}
         self._active_handlers = {
             'file': None,
             'syslog': None,
@@ -260,9 +1192,14 @@ class _Logger(ObserverMixin):
             'file_rotate_at_size', self._reconfigureFile)
         self._configuration.subscribe(
             'file_rotate_each', self._reconfigureFile)
+        self._configuration.subscribe(
+            'file_rotate_compress', self._reconfigureFile)
+        self._configuration.subscribe('file_format', self._reconfigureFile)
         self._active_handlers['file'] = self._addFile()
 
         self._configuration.subscribe('syslog', self._reconfigureSyslog)
+        self._configuration.subscribe(
+            'syslog_format', self._reconfigureSyslog)
         self._active_handlers['syslog'] = self._addSyslog()
 
         self._configuration.subscribe(
@@ -326,7 +1263,11 @@ class _Logger(ObserverMixin):
             raise UtilsError(u'1013',
                 _(u'Failed to start the Syslog logger. %s' % (error)))
 
-        self.addHandler(handler, patch_format=True)
+        self.addHandler(
+            handler,
+            patch_format=True,
+            log_format=self._configuration.syslog_format,
+            )
 
         return handler
 
@@ -374,15 +1315,36 @@ class _Logger(ObserverMixin):
             count = self._configuration.file_rotate_count
             bytes = self._configuration.file_rotate_at_size
             each = self._configuration.file_rotate_each
+            compress = self._configuration.file_rotate_compress
 
             if self._configuration.file_rotate_external:
                 handler = WatchedFileHandler(
                     log_path, encoding='utf-8')
                 handler.name = u'External rotated file %s' % (
                     self._configuration.file)
+            elif each and each[0] > 0 and bytes:
+                interval_count, interval_type = each
+                handler = SizeAndTimeRotatingFileHandler(
+                    log_path,
+                    when=interval_type,
+                    interval=interval_count,
+                    maxBytes=bytes,
+                    backupCount=count,
+                    encoding='utf-8',
+                    compress=compress,
+                    )
+                handler.name = (
+                    u'Size and time base rotated file %s at %s or %s bytes '
+                    u'keeping %s rotated archives' % (
+                        self._configuration.file, each, bytes, count))
             elif each and each[0] > 0:
                 interval_count, interval_type = each
-                handler = TimedRotatingFileHandler(
+                if compress:
+                    handler_class = (
+                        CompressedScheduledTimedRotatingFileHandler)
+                else:
+                    handler_class = ScheduledTimedRotatingFileHandler
+                handler = handler_class(
                     log_path,
                     when=interval_type,
                     interval=interval_count,
@@ -394,7 +1356,11 @@ class _Logger(ObserverMixin):
                     u'rotated archives' % (
                         self._configuration.file, each, count))
             elif bytes:
-                handler = RotatingFileHandler(
+                if compress:
+                    handler_class = CompressedRotatingFileHandler
+                else:
+                    handler_class = RotatingFileHandler
+                handler = handler_class(
                     log_path,
                     maxBytes=bytes,
                     backupCount=count,
@@ -408,7 +1374,11 @@ class _Logger(ObserverMixin):
                 handler = FileHandler(log_path, encoding='utf-8')
                 handler.name = u'File %s' % (self._configuration.file)
 
-            self.addHandler(handler, patch_format=True)
+            self.addHandler(
+                handler,
+                patch_format=True,
+                log_format=self._configuration.file_format,
+                )
         except Exception, error:
             raise UtilsError(u'1010',
                 _(u'Failed to start the log file. %s' % (
@@ -450,9 +1420,55 @@ class _Logger(ObserverMixin):
             data=None):
         '''This is here to help with testing, since log method is imported
         directly in all modules and we can not patch it.'''
+        token = None
+        if instrumentation.enabled:
+            token = instrumentation.start(u'Logger.log')
+
         if avatar:
             peer = avatar.peer
         record = LogEntry(message_id, text, avatar, peer, data)
+
+        if token is None:
+            self._log.handle(record)
+            return
+
+        try:
+            self._handleInstrumented(record)
+        finally:
+            instrumentation.stop(token)
+
+    def _handleInstrumented(self, record):
+        """
+        Send `record` to all handlers, recording the duration for each
+        handler.
+
+        Handlers of the parent loggers are called as done by
+        logging.Logger.handle.
+        """
+        logger = self._log
+        if logger.disabled or not logger.filter(record):
+            return
+
+        while logger:
+            for handler in logger.handlers:
+                if record.levelno < handler.level:
+                    continue
+                name = handler.name
+                if not name:
+                    name = handler.__class__.__name__
+                token = instrumentation.start(u'%s.emit' % (name,))
+                try:
+                    handler.handle(record)
+                finally:
+                    instrumentation.stop(token)
+            if not logger.propagate:
+                break
+            logger = logger.parent
+
+    def handle(self, record):
+        """
+        Send an existing LogEntry to all handlers.
+        """
         self._log.handle(record)
 
     def debug(self, message):
@@ -463,30 +1479,26 @@ class _Logger(ObserverMixin):
         record = LogEntry(100, message)
         self._log.handle(record)
 
-    def addHandler(self, handler, patch_format=False):
+    def addHandler(self, handler, patch_format=False, log_format=None):
         """
         Add handler to the logger.
 
         If `patch_format` is True, the handler format logger, will be
-        overwritten with the `format_log_entry` which converts an LogEntry
-        into the string representation.
-        """
-
-        def format_log_entry(record):
-            '''Return the string representation of a LogEntry.'''
-            return u'%d %s %s %s %s %s' % (
-                record.message_id,
-                record.timestamp_hr,
-                record.service_hr,
-                record.avatar_hr,
-                record.peer_hr,
-                record.text,
-                )
-
+        overwritten with the formatter for `log_format` which converts an
+        LogEntry into the string representation.
+        By default, the text format is used.
+        """
         if patch_format:
-            handler.format = format_log_entry
-
-        self._log.addHandler(handler)
+            if log_format is None:
+                log_format = LOG_FORMAT_TEXT
+            handler.format = LOG_FORMATTERS[log_format]
+
+        if self._queue_options is not None:
+            queued_handler = QueuedHandler(handler, **self._queue_options)
+            self._queued_handlers[handler] = queued_handler
+            self._log.addHandler(queued_handler)
+        else:
+            self._log.addHandler(handler)
         self._new_handler_added = True
         if handler.name:
             self.notify('add-handler', Signal(self, name=handler._name))
@@ -497,8 +1509,15 @@ class _Logger(ObserverMixin):
         """
         if not handler:
             return
-        self._log.removeHandler(handler)
-        handler.close()
+        if isinstance(handler, QueuedHandler):
+            handler = handler.handler
+        queued_handler = self._queued_handlers.pop(handler, None)
+        if queued_handler is not None:
+            self._log.removeHandler(queued_handler)
+            queued_handler.close()
+        else:
+            self._log.removeHandler(handler)
+            handler.close()
         if handler.name:
             self.notify('remove-handler', Signal(self, name=handler._name))
 
@@ -517,6 +1536,28 @@ class _Logger(ObserverMixin):
         """
         return self._log.handlers
 
+    def enableHandlerQueues(self, queue_size=10000, failure_threshold=5,
+            recovery_time=30):
+        """
+        Send entries to each handler added from now on using a separate
+        queue and thread.
+
+        See `QueuedHandler` for the arguments.
+        """
+        self._queue_options = {
+            'queue_size': queue_size,
+            'failure_threshold': failure_threshold,
+            'recovery_time': recovery_time,
+            }
+
+    def getHandlerStats(self):
+        """
+        Return the list of statistics for each queued handler.
+        """
+        return [
+            queued_handler.getStats()
+            for queued_handler in self._queued_handlers.values()]
+
     @staticmethod
     def shutdown():
         '''Inform the main logging framework that we are going down.'''
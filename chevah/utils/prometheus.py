@@ -0,0 +1,64 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+'''Twisted Web Resource exporting the events metrics for Prometheus.
+
+The metrics are rendered using the Prometheus text exposition format.
+'''
+
+__metaclass__ = type
+
+__all__ = []
+
+from twisted.web import resource
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escapeLabel(value):
+    '''Return `value` escaped as a label value.'''
+    return unicode(value).replace(
+        u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')
+
+
+class EventsMetricsResource(resource.Resource, object):
+    '''Resource rendering the statistics of an EventsMetrics.'''
+
+    isLeaf = True
+
+    def __init__(self, metrics, prefix=u'chevah'):
+        super(EventsMetricsResource, self).__init__()
+        self.metrics = metrics
+        self.prefix = prefix
+
+    def render_GET(self, request):
+        '''Return the metrics in the Prometheus text format.'''
+        stats = self.metrics.getStats()
+        lines = []
+        self._addMetrics(lines, u'events', u'id', stats['events'])
+        self._addMetrics(lines, u'event_groups', u'group', stats['groups'])
+        content = u''.join(lines).encode('utf-8')
+
+        request.setHeader('content-type', CONTENT_TYPE)
+        request.setHeader('content-length', str(len(content)))
+        return content
+
+    def _addMetrics(self, lines, name, label, stats):
+        '''Add to `lines` the count and rates from `stats` by `label`.'''
+        total_name = u'%s_%s_total' % (self.prefix, name)
+        rate_name = u'%s_%s_rate' % (self.prefix, name)
+
+        lines.append(u'# HELP %s Number of emitted events.\n' % (total_name))
+        lines.append(u'# TYPE %s counter\n' % (total_name))
+        for key, values in sorted(stats.items()):
+            lines.append(u'%s{%s="%s"} %d\n' % (
+                total_name, label, _escapeLabel(key), values['count']))
+
+        lines.append(
+            u'# HELP %s Moving average of emitted events per second.\n' % (
+                rate_name))
+        lines.append(u'# TYPE %s gauge\n' % (rate_name))
+        for key, values in sorted(stats.items()):
+            for window in [u'1m', u'5m', u'15m']:
+                lines.append(u'%s{%s="%s",window="%s"} %r\n' % (
+                    rate_name, label, _escapeLabel(key), window,
+                    values['rate_' + window]))
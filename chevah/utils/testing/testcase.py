@@ -158,7 +158,7 @@ class EventTestCase(UtilsTestCase):
         """
         super(EventTestCase, self).setUp()
 
-        def emitEvent_test(event):
+        def emitEvent_test(event, wait=True):
             """
             Push the logging message into the log testing queue.
             """
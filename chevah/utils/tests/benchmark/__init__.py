@@ -0,0 +1,11 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+"""
+Performance benchmarks for the logger and the events handler.
+
+Run all benchmarks and compare them with the stored baseline using::
+
+    python -m chevah.utils.tests.benchmark
+
+See `chevah.utils.tests.benchmark.runner` for the available options.
+"""
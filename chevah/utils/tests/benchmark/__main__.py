@@ -0,0 +1,10 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+"""
+Run the benchmarks using `python -m chevah.utils.tests.benchmark`.
+"""
+import sys
+
+from chevah.utils.tests.benchmark.runner import main
+
+sys.exit(main())
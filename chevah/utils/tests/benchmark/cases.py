@@ -0,0 +1,312 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+"""
+Benchmarks for the logger and the events handler.
+"""
+from __future__ import with_statement
+
+from logging import NullHandler
+from StringIO import StringIO
+import os
+import shutil
+import socket
+import tempfile
+
+from chevah.utils import events_handler
+from chevah.utils.constants import LOG_SECTION_DEFAULTS
+from chevah.utils.event import EventsDefinition
+from chevah.utils.logger import (
+    archive_compressor,
+    format_log_entry,
+    format_log_entry_json,
+    LogEntry,
+    Logger,
+    )
+from chevah.utils.testing import manufacture
+
+# Events used by the benchmarks, with one enabled and one disabled group.
+EVENTS_DEFINITION = u'''{
+    "groups": {
+        "informational": {"description": "Enabled group."},
+        "debug": {"description": "Disabled group."}
+        },
+    "events": {
+        "20000": {
+            "message": "File %(path)s opened.",
+            "groups": ["informational"],
+            "description": "",
+            "version_added": "",
+            "version_removed": "",
+            "data": {"path": "Path to the file."}
+            },
+        "20001": {
+            "message": "Debug details for %(path)s.",
+            "groups": ["debug"],
+            "description": "",
+            "version_added": "",
+            "version_removed": "",
+            "data": {"path": "Path to the file."}
+            }
+        }
+    }'''
+
+
+def make_events_definition():
+    """
+    Return the loaded events definition used by the benchmarks.
+    """
+    definitions = EventsDefinition(file=StringIO(EVENTS_DEFINITION))
+    definitions.load()
+    return definitions
+
+
+def make_log_configuration(**options):
+    """
+    Return a LogConfigurationSection having the log `options`.
+
+    By default, file and syslog logging are disabled and only the
+    `informational` group is enabled.
+    """
+    values = {
+        'log_file': u'Disabled',
+        'log_syslog': u'Disabled',
+        'log_enabled_groups': u'informational',
+        }
+    values.update(options)
+    content = u'[log]\n' + u''.join([
+        u'%s: %s\n' % (name, value)
+        for name, value in sorted(values.items())])
+    proxy = manufacture.makeFileConfigurationProxy(
+        content=content, defaults=LOG_SECTION_DEFAULTS)
+    return manufacture.makeLogConfigurationSection(proxy=proxy)
+
+
+class Benchmark(object):
+    """
+    A benchmarked operation.
+
+    `run` is called once for each measured operation, between `setUp`
+    and `tearDown`.
+    """
+
+    name = None
+
+    def setUp(self):
+        """
+        Prepare the benchmark.
+        """
+
+    def run(self):
+        """
+        Execute the benchmarked operation.
+        """
+        raise NotImplementedError()
+
+    def tearDown(self):
+        """
+        Release the resources used by the benchmark.
+        """
+
+
+class LogEntryBenchmark(Benchmark):
+    """
+    Create a LogEntry with avatar and peer.
+    """
+
+    name = 'log_entry'
+
+    def setUp(self):
+        self._avatar = manufacture.makeFilesystemApplicationAvatar()
+        self._peer = manufacture.makeIPv4Address()
+
+    def run(self):
+        LogEntry(100, u'Some text.', avatar=self._avatar, peer=self._peer)
+
+
+class FormatLogEntryBenchmark(Benchmark):
+    """
+    Format a LogEntry using a log formatter.
+    """
+
+    def __init__(self, name, formatter):
+        self.name = name
+        self._formatter = formatter
+
+    def setUp(self):
+        self._entry = manufacture.makeLogEntry()
+
+    def run(self):
+        self._formatter(self._entry)
+
+
+class LoggerLogBenchmark(Benchmark):
+    """
+    Call Logger.log on a logger configured with `options`.
+
+    The handlers are created by the logger itself, from the
+    configuration. When `syslog` is True, entries are sent to a local
+    UDP server.
+    """
+
+    def __init__(self, name, syslog=False, **options):
+        self.name = name
+        self._use_syslog = syslog
+        self._options = options
+        self._folder = None
+        self._syslog = None
+
+    def setUp(self):
+        self._folder = tempfile.mkdtemp(prefix='chevah-benchmark-')
+        self._avatar = manufacture.makeFilesystemApplicationAvatar()
+
+        options = self._options.copy()
+        if 'log_file' in options:
+            options['log_file'] = os.path.join(
+                self._folder, options['log_file'])
+        if self._use_syslog:
+            options['log_syslog'] = self._startSyslog()
+
+        self._logger = manufacture.makeLogger()
+        self._logger.configure(make_log_configuration(**options))
+        if not self._logger.getHandlers():
+            self._logger.addHandler(NullHandler())
+
+    def run(self):
+        self._logger.log(100, u'Some text.', avatar=self._avatar)
+
+    def tearDown(self):
+        self._logger.removeAllHandlers()
+        archive_compressor.wait()
+        if self._syslog is not None:
+            self._syslog.close()
+        shutil.rmtree(self._folder, ignore_errors=True)
+
+    def _startSyslog(self):
+        """
+        Start a local UDP server standing in for syslog.
+
+        Datagrams are not read and are dropped by the OS once the
+        receive buffer is full.
+
+        Return the address of the server.
+        """
+        self._syslog = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._syslog.bind(('127.0.0.1', 0))
+        return u'127.0.0.1:%d' % self._syslog.getsockname()[1]
+
+
+class EventsHandlerBenchmark(Benchmark):
+    """
+    Base class for benchmarking the configured `events_handler`.
+
+    Log entries are sent to a handler which discards them.
+    """
+
+    def setUp(self):
+        events_handler.configure(
+            definitions=make_events_definition(),
+            log_configuration_section=make_log_configuration(),
+            )
+        self._handler = NullHandler()
+        Logger.addHandler(self._handler)
+
+    def tearDown(self):
+        Logger.removeHandler(self._handler)
+        events_handler.removeConfiguration()
+
+
+class EmitBenchmark(EventsHandlerBenchmark):
+    """
+    Emit an event using `events_handler.emit`.
+    """
+
+    def __init__(self, name, event_id):
+        self.name = name
+        self._event_id = event_id
+
+    def run(self):
+        events_handler.emit(self._event_id, data={'path': u'/some/path'})
+
+
+class EmitFastBenchmark(EmitBenchmark):
+    """
+    Emit an event using `events_handler.emitFast`.
+    """
+
+    def run(self):
+        events_handler.emitFast(self._event_id, data={'path': u'/some/path'})
+
+
+class IsLogGroupEnabledBenchmark(EventsHandlerBenchmark):
+    """
+    Check if the groups of an event definition are enabled.
+    """
+
+    def __init__(self, name, event_id):
+        self.name = name
+        self._event_id = event_id
+
+    def setUp(self):
+        super(IsLogGroupEnabledBenchmark, self).setUp()
+        self._definition = events_handler.definitions.getEventDefinition(
+            self._event_id)
+
+    def run(self):
+        events_handler.isLogGroupEnabled(self._definition)
+
+
+def get_benchmarks():
+    """
+    Return the list with all benchmarks.
+    """
+    return [
+        LogEntryBenchmark(),
+        FormatLogEntryBenchmark('format_log_entry', format_log_entry),
+        FormatLogEntryBenchmark(
+            'format_log_entry_json', format_log_entry_json),
+        LoggerLogBenchmark('logger_log_null'),
+        LoggerLogBenchmark('logger_log_file', log_file=u'server.log'),
+        LoggerLogBenchmark(
+            'logger_log_file_json',
+            log_file=u'server.log',
+            log_file_format=u'json',
+            ),
+        LoggerLogBenchmark(
+            'logger_log_file_external',
+            log_file=u'server.log',
+            log_file_rotate_external=u'Yes',
+            ),
+        LoggerLogBenchmark(
+            'logger_log_file_size',
+            log_file=u'server.log',
+            log_file_rotate_at_size=u'1048576',
+            log_file_rotate_count=u'3',
+            ),
+        LoggerLogBenchmark(
+            'logger_log_file_size_compress',
+            log_file=u'server.log',
+            log_file_rotate_at_size=u'1048576',
+            log_file_rotate_count=u'3',
+            log_file_rotate_compress=u'Yes',
+            ),
+        LoggerLogBenchmark(
+            'logger_log_file_time',
+            log_file=u'server.log',
+            log_file_rotate_each=u'1 hour',
+            log_file_rotate_count=u'3',
+            ),
+        LoggerLogBenchmark(
+            'logger_log_file_time_compress',
+            log_file=u'server.log',
+            log_file_rotate_each=u'1 hour',
+            log_file_rotate_count=u'3',
+            log_file_rotate_compress=u'Yes',
+            ),
+        LoggerLogBenchmark('logger_log_syslog', syslog=True),
+        EmitBenchmark('emit_enabled', 20000),
+        EmitBenchmark('emit_disabled', 20001),
+        EmitFastBenchmark('emit_fast_enabled', 20000),
+        EmitFastBenchmark('emit_fast_disabled', 20001),
+        IsLogGroupEnabledBenchmark('is_log_group_enabled', u'20000'),
+        IsLogGroupEnabledBenchmark('is_log_group_disabled', u'20001'),
+        ]
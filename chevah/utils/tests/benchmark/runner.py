@@ -0,0 +1,199 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+"""
+Run the benchmarks and compare the results with a stored baseline.
+
+For each benchmark it reports:
+
+* operations per second.
+* median (p50) and 99th percentile (p99) latency for a single call.
+* allocations per call, as the number of objects tracked by the garbage
+  collector which were created by a call and not released by reference
+  counting.
+
+The baseline should be saved using `--save-baseline` on the machine used
+for building the release, as the results depend on the hardware.
+"""
+from __future__ import with_statement
+
+from timeit import default_timer
+import gc
+import json
+import optparse
+import os
+import sys
+
+from chevah.utils.tests.benchmark.cases import get_benchmarks
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def get_percentile(durations, percentile):
+    """
+    Return the `percentile` from the sorted list of `durations`.
+    """
+    index = int(round(percentile / 100.0 * (len(durations) - 1)))
+    return durations[index]
+
+
+def measure(benchmark, iterations=10000, warmup=1000):
+    """
+    Run `benchmark` and return a dictionary with the results.
+
+    Latencies are in microseconds.
+    """
+    benchmark.setUp()
+    try:
+        run = benchmark.run
+        for index in xrange(warmup):
+            run()
+
+        durations = [0.0] * iterations
+        timer = default_timer
+        gc.collect()
+        gc.disable()
+        try:
+            objects_before = len(gc.get_objects())
+            start = timer()
+            for index in xrange(iterations):
+                call_start = timer()
+                run()
+                durations[index] = timer() - call_start
+            total = timer() - start
+            objects_after = len(gc.get_objects())
+        finally:
+            gc.enable()
+    finally:
+        benchmark.tearDown()
+
+    durations.sort()
+    return {
+        'ops': iterations / total,
+        'p50': get_percentile(durations, 50) * 1000000,
+        'p99': get_percentile(durations, 99) * 1000000,
+        'allocations': float(objects_after - objects_before) / iterations,
+        }
+
+
+def compare(name, result, baseline, tolerance):
+    """
+    Return the list of regressions for the `result` of benchmark `name`
+    when compared with `baseline`.
+
+    A result is a regression when it is worse than the baseline by more
+    than `tolerance` as a fraction of the baseline.
+    Allocations are compared with an absolute tolerance of one object
+    per call.
+    """
+    expected = baseline.get(name)
+    if not expected:
+        return []
+
+    regressions = []
+    if result['ops'] < expected['ops'] * (1 - tolerance):
+        regressions.append(
+            u'%s: %.0f ops/sec, baseline %.0f ops/sec.' % (
+                name, result['ops'], expected['ops']))
+    if result['p99'] > expected['p99'] * (1 + tolerance):
+        regressions.append(
+            u'%s: p99 %.2f us, baseline %.2f us.' % (
+                name, result['p99'], expected['p99']))
+    if result['allocations'] > expected['allocations'] + 1:
+        regressions.append(
+            u'%s: %.2f allocations per call, baseline %.2f.' % (
+                name, result['allocations'], expected['allocations']))
+    return regressions
+
+
+def load_baseline(path):
+    """
+    Return the results stored at `path` or an empty dictionary when no
+    baseline was saved.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as stream:
+        return json.load(stream)
+
+
+def save_baseline(path, results):
+    """
+    Store `results` at `path`.
+    """
+    with open(path, 'wb') as stream:
+        json.dump(results, stream, indent=4, sort_keys=True)
+        stream.write('\n')
+
+
+def main(argv=sys.argv):
+    """
+    Run the benchmarks and return the exit code.
+
+    The exit code is 1 when a regression was found.
+    """
+    parser = optparse.OptionParser(
+        usage="""\
+usage: %prog [options] [name, ...]
+
+Run the benchmarks having a name containing any of the `name` arguments,
+or all benchmarks when no name is given.""")
+
+    parser.add_option('-n', '--iterations', action='store', type='int',
+                      dest='iterations', default=10000,
+                      help='Number of measured calls (default: 10000)')
+    parser.add_option('-w', '--warmup', action='store', type='int',
+                      dest='warmup', default=1000,
+                      help='Number of calls before measuring (default: 1000)')
+    parser.add_option('-b', '--baseline', action='store', dest='baseline',
+                      default=DEFAULT_BASELINE,
+                      help='Path to the baseline results')
+    parser.add_option('-s', '--save-baseline', action='store_true',
+                      dest='save', help='Save the results as the baseline')
+    parser.add_option('-t', '--tolerance', action='store', type='float',
+                      dest='tolerance', default=0.2,
+                      help='Accepted slowdown as a fraction of the baseline '
+                      '(default: 0.2)')
+
+    (opts, names) = parser.parse_args(argv[1:])
+
+    baseline = load_baseline(opts.baseline)
+    results = {}
+    regressions = []
+
+    print '%-32s %12s %10s %10s %8s %9s' % (
+        'Benchmark', 'ops/sec', 'p50 (us)', 'p99 (us)', 'allocs', 'baseline')
+    for benchmark in get_benchmarks():
+        if names and not [
+                name for name in names if name in benchmark.name]:
+            continue
+
+        result = measure(
+            benchmark, iterations=opts.iterations, warmup=opts.warmup)
+        results[benchmark.name] = result
+
+        change = ''
+        expected = baseline.get(benchmark.name)
+        if expected:
+            change = '%+.1f%%' % (
+                (result['ops'] / expected['ops'] - 1) * 100)
+        print '%-32s %12.0f %10.2f %10.2f %8.2f %9s' % (
+            benchmark.name, result['ops'], result['p50'], result['p99'],
+            result['allocations'], change)
+
+        regressions.extend(
+            compare(benchmark.name, result, baseline, opts.tolerance))
+
+    if opts.save:
+        baseline.update(results)
+        save_baseline(opts.baseline, baseline)
+        print 'Baseline saved to %s' % (opts.baseline)
+        return 0
+
+    if regressions:
+        print
+        print 'Regressions:'
+        for regression in regressions:
+            print '  ' + regression.encode('utf-8')
+        return 1
+
+    return 0
@@ -0,0 +1,119 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+"""
+Tests for the benchmarks runner.
+"""
+from chevah.utils.testing import manufacture, UtilsTestCase
+from chevah.utils.tests.benchmark.cases import Benchmark, get_benchmarks
+from chevah.utils.tests.benchmark.runner import (
+    compare,
+    get_percentile,
+    load_baseline,
+    measure,
+    save_baseline,
+    )
+
+
+class CountingBenchmark(Benchmark):
+    """
+    A benchmark recording the calls.
+    """
+
+    name = 'counting'
+
+    def __init__(self):
+        self.calls = []
+
+    def setUp(self):
+        self.calls.append('setUp')
+
+    def run(self):
+        self.calls.append('run')
+
+    def tearDown(self):
+        self.calls.append('tearDown')
+
+
+class TestRunner(UtilsTestCase):
+    """
+    Tests for the benchmarks runner.
+    """
+
+    def test_get_percentile(self):
+        """
+        The value for the percentile is returned from the sorted list.
+        """
+        durations = range(101)
+
+        self.assertEqual(50, get_percentile(durations, 50))
+        self.assertEqual(99, get_percentile(durations, 99))
+
+    def test_measure(self):
+        """
+        The benchmark is called after warm up and the results are
+        returned.
+        """
+        benchmark = CountingBenchmark()
+
+        result = measure(benchmark, iterations=3, warmup=2)
+
+        self.assertEqual(
+            ['setUp'] + ['run'] * 5 + ['tearDown'], benchmark.calls)
+        self.assertEqual(
+            ['allocations', 'ops', 'p50', 'p99'], sorted(result.keys()))
+        self.assertTrue(result['ops'] > 0)
+
+    def test_compare_no_baseline(self):
+        """
+        Without a baseline, there are no regressions.
+        """
+        result = {'ops': 1, 'p99': 100, 'allocations': 10}
+
+        self.assertEqual([], compare('name', result, {}, 0.2))
+
+    def test_compare(self):
+        """
+        Results worse than the baseline by more than the tolerance are
+        reported as regressions.
+        """
+        baseline = {'name': {'ops': 1000, 'p99': 10, 'allocations': 0}}
+        good = {'ops': 900, 'p99': 11, 'allocations': 1}
+        bad = {'ops': 700, 'p99': 13, 'allocations': 2}
+
+        self.assertEqual([], compare('name', good, baseline, 0.2))
+        self.assertEqual(3, len(compare('name', bad, baseline, 0.2)))
+
+    def test_baseline_save_load(self):
+        """
+        Saved results can be loaded as the baseline.
+        """
+        path, segments = manufacture.fs.makePathInTemp()
+        results = {'name': {'ops': 1.5, 'p99': 2.5, 'allocations': 0.0}}
+        try:
+            self.assertEqual({}, load_baseline(path))
+
+            save_baseline(path, results)
+
+            self.assertEqual(results, load_baseline(path))
+        finally:
+            manufacture.fs.deleteFile(segments, ignore_errors=True)
+
+    def test_get_benchmarks(self):
+        """
+        All benchmarks have an unique name.
+        """
+        names = [benchmark.name for benchmark in get_benchmarks()]
+
+        self.assertEqual(len(names), len(set(names)))
+        self.assertTrue('logger_log_syslog' in names)
+
+    def test_get_benchmarks_run(self):
+        """
+        All benchmarks can be set up, run and torn down.
+        """
+        for benchmark in get_benchmarks():
+            benchmark.setUp()
+            try:
+                benchmark.run()
+            finally:
+                benchmark.tearDown()
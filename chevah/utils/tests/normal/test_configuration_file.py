@@ -8,6 +8,8 @@ from __future__ import with_statement
 import os
 from StringIO import StringIO
 
+from twisted.internet.task import Clock
+
 from chevah.utils.testing import manufacture, UtilsTestCase
 from chevah.utils.configuration import ConfigurationSectionMixin
 from chevah.utils.configuration_file import (
@@ -202,6 +204,134 @@ class TestFileConfigurationProxy(UtilsTestCase):
             if test_segments:
                 test_filesystem.deleteFile(test_segments, ignore_errors=True)
 
+    def test_dirty(self):
+        """
+        Configuration is marked as changed only after a value is set.
+        """
+        config = self.makeFileConfiguration(u'[section]\nsome: value\n')
+
+        self.assertFalse(config.dirty)
+
+        config.setString(u'section', u'some', u'other')
+
+        self.assertTrue(config.dirty)
+
+    def test_save_configuration_file(self):
+        """
+        When saving to a file object, the whole payload is written with a
+        single call and configuration is no longer marked as changed.
+        """
+        config = self.makeFileConfiguration(u'[section]\nsome: value\n')
+        config.addSection(u'other')
+        config.setInteger(u'other', u'number', 3)
+        writes = []
+
+        class WriteRecorder(object):
+            def write(self, data):
+                writes.append(data)
+
+        config.save(configuration_file=WriteRecorder())
+
+        self.assertEqual(1, len(writes))
+        self.assertEqual(
+            u'[section]\nsome = value\n\n[other]\nnumber = 3\n\n',
+            writes[0])
+        self.assertFalse(config.dirty)
+
+    def test_save_not_dirty(self):
+        """
+        When nothing was changed, the file is not written.
+        """
+        test_filesystem = manufacture.fs
+        test_segments = test_filesystem.createFileInTemp(
+            content=u'[section]\nsome: value\n')
+        try:
+            config_path = test_filesystem.getRealPathFromSegments(
+                test_segments)
+            config = FileConfigurationProxy(configuration_path=config_path)
+            config.load()
+            test_filesystem.deleteFile(test_segments)
+
+            config.save()
+
+            self.assertFalse(test_filesystem.exists(test_segments))
+        finally:
+            test_filesystem.deleteFile(test_segments, ignore_errors=True)
+
+    def test_save_fsync(self):
+        """
+        Configuration can be synced to disk while saving, and the
+        temporary file is not left behind.
+        """
+        test_filesystem = manufacture.fs
+        test_segments = test_filesystem.createFileInTemp(
+            content=u'[section]\nsome: value\n')
+        tmp_segments = test_segments[:]
+        tmp_segments[-1] = tmp_segments[-1] + u'.tmp'
+        try:
+            config_path = test_filesystem.getRealPathFromSegments(
+                test_segments)
+            config = FileConfigurationProxy(configuration_path=config_path)
+            config.load()
+            config.setString(u'section', u'some', u'other')
+
+            config.save(fsync=True)
+
+            self.assertFalse(test_filesystem.exists(tmp_segments))
+            config = FileConfigurationProxy(configuration_path=config_path)
+            config.load()
+            self.assertEqual(
+                u'other', config.getString(u'section', u'some'))
+        finally:
+            test_filesystem.deleteFile(test_segments, ignore_errors=True)
+
+    def test_saveLater(self):
+        """
+        Multiple calls to saveLater are coalesced into a single save,
+        executed after the delay.
+        """
+        clock = Clock()
+        test_filesystem = manufacture.fs
+        test_segments = test_filesystem.createFileInTemp(
+            content=u'[section]\nsome: value\n')
+        try:
+            config_path = test_filesystem.getRealPathFromSegments(
+                test_segments)
+            config = FileConfigurationProxy(
+                configuration_path=config_path, reactor=clock)
+            config.load()
+            config.setString(u'section', u'some', u'other')
+
+            results = []
+            config.saveLater(delay=2).addCallback(results.append)
+            config.saveLater(delay=2).addCallback(results.append)
+
+            self.assertEqual(1, len(clock.getDelayedCalls()))
+            self.assertTrue(config.dirty)
+
+            clock.advance(2)
+
+            self.assertFalse(config.dirty)
+            self.assertEqual([None, None], results)
+        finally:
+            test_filesystem.deleteFile(test_segments, ignore_errors=True)
+
+    def test_save_cancels_saveLater(self):
+        """
+        A direct save executes right away the pending delayed save.
+        """
+        clock = Clock()
+        config = FileConfigurationProxy(
+            configuration_file=StringIO(u'[section]\n'), reactor=clock)
+        config.load()
+
+        results = []
+        config.saveLater().addCallback(results.append)
+        config.save(configuration_file=StringIO())
+
+        self.assertEqual([], clock.getDelayedCalls())
+        self.assertEqual([None], results)
+
     def test_sections(self):
         """
         Check sections property.
@@ -5,13 +5,23 @@ Tests for credentials used by Chevah project.
 """
 from __future__ import with_statement
 
+from twisted.cred.error import UnauthorizedLogin
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
 from chevah.utils.testing import UtilsTestCase, manufacture
 from chevah.utils.credentials import (
+    AuthenticationCache,
     CredentialsBase,
+    FTPPasswordCredentials,
     PasswordCredentials,
     SSHKeyCredentials,
     SSLCertificateCredentials,
     )
+from chevah.utils.crypto import Key, PublicKeyCache
+from chevah.utils.interfaces import IFTPPasswordCredentials
+from chevah.utils.tests.normal.test_crypto import RSA_PRIVATE_KEY
 
 
 class TestCredentialsBase(UtilsTestCase):
@@ -51,6 +61,67 @@ class TestCredentialsBase(UtilsTestCase):
         with self.assertRaises(NotImplementedError):
             credentials.kind_name
 
+    def test_no_instance_dictionary(self):
+        """
+        Credentials only use slots, so new attributes can not be added.
+        """
+        credentials = PasswordCredentials(
+            username=manufacture.getUniqueString())
+
+        with self.assertRaises(AttributeError):
+            credentials.other_attribute = 1
+
+        self.assertFalse(hasattr(credentials, '__dict__'))
+        self.assertFalse(
+            hasattr(FTPPasswordCredentials(
+                username=manufacture.getUniqueString()), '__dict__'))
+
+    def test_kind_name_class_constant(self):
+        """
+        All credentials of a kind share the same kind name.
+        """
+        credentials = PasswordCredentials(
+            username=manufacture.getUniqueString())
+
+        self.assertIs(PasswordCredentials.kind_name, credentials.kind_name)
+        self.assertIs(
+            PasswordCredentials.kind_name,
+            FTPPasswordCredentials.kind_name)
+
+    def test_snapshot(self):
+        """
+        The snapshot contains the kind name and all credentials values.
+        """
+        username = manufacture.getUniqueString()
+        password = manufacture.getUniqueString()
+        peer = manufacture.getUniqueString()
+        credentials = FTPPasswordCredentials(
+            username=username, password=password, peer=peer)
+
+        snapshot = credentials.snapshot()
+
+        self.assertEqual(u'password', snapshot.kind_name)
+        self.assertEqual(username, snapshot.username)
+        self.assertEqual(password, snapshot.password)
+        self.assertEqual(peer, snapshot.peer)
+        self.assertTrue(IFTPPasswordCredentials.providedBy(snapshot))
+
+    def test_snapshot_immutable(self):
+        """
+        The snapshot can not be changed and is not changed together with
+        the credentials.
+        """
+        username = manufacture.getUniqueString()
+        credentials = SSHKeyCredentials(username=username)
+        snapshot = credentials.snapshot()
+
+        credentials.username = manufacture.getUniqueString()
+
+        self.assertEqual(username, snapshot.username)
+        with self.assertRaises(AttributeError):
+            snapshot.username = manufacture.getUniqueString()
+        self.assertIs(type(snapshot), type(credentials.snapshot()))
+
 
 class TestPasswordCredentials(UtilsTestCase):
     """
@@ -131,6 +202,87 @@ class TestSSHKeyCredentials(UtilsTestCase):
         self.assertEqual(key_signature, credentials.key_signature)
         self.assertEqual(key_signed_data, credentials.key_signed_data)
 
+    def getSignedCredentials(self, signed_data=None):
+        """
+        Return credentials signed with the test RSA key.
+        """
+        private_key = Key.fromString(data=RSA_PRIVATE_KEY)
+        if signed_data is None:
+            signed_data = manufacture.getUniqueString().encode('utf-8')
+        return SSHKeyCredentials(
+            username=manufacture.getUniqueString(),
+            key_algorithm='ssh-rsa',
+            key_data=private_key.public().blob(),
+            key_signed_data=signed_data,
+            key_signature=private_key.sign(signed_data),
+            )
+
+    def test_fingerprint(self):
+        """
+        The fingerprint is the one of the public key.
+        """
+        credentials = self.getSignedCredentials()
+        public_key = Key.fromString(data=RSA_PRIVATE_KEY).public()
+
+        self.assertEqual(public_key.fingerprint(), credentials.fingerprint)
+
+    def test_getKey_cache(self):
+        """
+        Keys are parsed only once when obtained from the same cache.
+        """
+        cache = PublicKeyCache()
+        credentials = self.getSignedCredentials()
+
+        key = credentials.getKey(cache=cache)
+
+        self.assertIs(key, credentials.getKey(cache=cache))
+        self.assertEqual(1, cache.misses)
+        self.assertEqual(1, cache.hits)
+
+    def test_verify_valid(self):
+        """
+        Returns True when the signature was created with the private key.
+        """
+        credentials = self.getSignedCredentials()
+
+        self.assertTrue(credentials.verify(cache=PublicKeyCache()))
+
+    def test_verify_bad_signature(self):
+        """
+        Returns False when the signature is not for the signed data.
+        """
+        credentials = self.getSignedCredentials()
+        credentials.key_signed_data = 'other data'
+
+        self.assertFalse(credentials.verify(cache=PublicKeyCache()))
+
+    def test_verify_no_signature(self):
+        """
+        Returns False when no signature was provided.
+        """
+        credentials = self.getSignedCredentials()
+        credentials.key_signature = None
+
+        self.assertFalse(credentials.verify())
+
+    def test_verify_bad_key(self):
+        """
+        Returns False when the key data is not a valid key.
+        """
+        credentials = self.getSignedCredentials()
+        credentials.key_data = 'bad key'
+
+        self.assertFalse(credentials.verify(cache=PublicKeyCache()))
+
+    def test_verify_bad_key_non_ascii(self):
+        """
+        Returns False when the key data has a non-ASCII key type.
+        """
+        credentials = self.getSignedCredentials()
+        credentials.key_data = '\x00\x00\x00\x04\xff\xfe\xfd\xfc'
+
+        self.assertFalse(credentials.verify(cache=PublicKeyCache()))
+
 
 class TestSSLCertificateCredentials(UtilsTestCase):
     """
@@ -157,3 +309,237 @@ class TestSSLCertificateCredentials(UtilsTestCase):
             )
 
         self.assertEqual(certificate, credentials.certificate)
+
+
+class TestAuthenticationCache(UtilsTestCase):
+    """
+    Tests for AuthenticationCache.
+    """
+
+    def setUp(self):
+        super(TestAuthenticationCache, self).setUp()
+        self.clock = Clock()
+        self.cache = AuthenticationCache(
+            size=2, ttl=10, negative_ttl=5,
+            negative_errors=(UnauthorizedLogin,),
+            reactor=self.clock,
+            )
+
+    def getCredentials(self, username=None, password=None):
+        """
+        Return password credentials.
+        """
+        if username is None:
+            username = manufacture.getUniqueString()
+        if password is None:
+            password = manufacture.getUniqueString()
+        return PasswordCredentials(username=username, password=password)
+
+    def getLookupResult(self, credentials):
+        """
+        Return the result of the cache lookup.
+        """
+        results = []
+        self.cache.lookup(credentials).addBoth(results.append)
+        return results[0]
+
+    def test_getKey_secret(self):
+        """
+        The key depends on username, kind and secret, without containing
+        the secret.
+        """
+        credentials = self.getCredentials()
+        other_password = self.getCredentials(
+            username=credentials.username)
+        ssl_credentials = SSLCertificateCredentials(
+            username=credentials.username,
+            certificate=credentials.password.encode('utf-8'))
+
+        key = self.cache.getKey(credentials)
+
+        self.assertEqual(key, self.cache.getKey(credentials.snapshot()))
+        self.assertNotEqual(key, self.cache.getKey(other_password))
+        self.assertNotEqual(key, self.cache.getKey(ssl_credentials))
+        self.assertFalse(credentials.password.encode('utf-8') in key)
+
+    def test_getKey_salted(self):
+        """
+        Each cache uses a different salt.
+        """
+        credentials = self.getCredentials()
+        other_cache = AuthenticationCache()
+
+        self.assertNotEqual(
+            self.cache.getKey(credentials), other_cache.getKey(credentials))
+
+    def test_getKey_no_secret(self):
+        """
+        Credentials without a secret are not cached.
+        """
+        credentials = PasswordCredentials(
+            username=manufacture.getUniqueString())
+
+        self.assertIsNone(self.cache.getKey(credentials))
+        self.cache.store(credentials, True)
+        self.assertEqual(0, len(self.cache))
+
+    def test_lookup_miss(self):
+        """
+        The lookup fires with None when nothing is cached.
+        """
+        self.assertIsNone(self.getLookupResult(self.getCredentials()))
+        self.assertEqual(1, self.cache.misses)
+
+    def test_lookup_expired(self):
+        """
+        Successful results expire after the ttl.
+        """
+        credentials = self.getCredentials()
+        self.cache.store(credentials, True)
+
+        self.clock.advance(9)
+        self.assertTrue(self.getLookupResult(credentials))
+        self.assertEqual(1, self.cache.hits)
+
+        self.clock.advance(1)
+        self.assertIsNone(self.getLookupResult(credentials))
+        self.assertEqual(0, len(self.cache))
+
+    def test_lookup_negative(self):
+        """
+        Failed results are returned as failures and expire after the
+        negative ttl.
+        """
+        credentials = self.getCredentials()
+        self.cache.store(credentials, Failure(UnauthorizedLogin()))
+
+        result = self.getLookupResult(credentials)
+        self.assertIsInstance(Failure, result)
+        self.assertTrue(result.check(UnauthorizedLogin))
+
+        self.clock.advance(5)
+        self.assertIsNone(self.getLookupResult(credentials))
+
+    def test_store_other_failures(self):
+        """
+        Failures which are not negative errors are not cached.
+        """
+        credentials = self.getCredentials()
+
+        self.cache.store(credentials, Failure(RuntimeError()))
+
+        self.assertEqual(0, len(self.cache))
+
+    def test_store_size(self):
+        """
+        When the cache is full, the oldest result is removed.
+        """
+        first = self.getCredentials()
+        second = self.getCredentials()
+        third = self.getCredentials()
+        self.cache.store(first, True)
+        self.cache.store(second, True)
+
+        self.cache.store(third, True)
+
+        self.assertEqual(2, len(self.cache))
+        self.assertIsNone(self.getLookupResult(first))
+        self.assertTrue(self.getLookupResult(third))
+
+    def test_authenticate_cached(self):
+        """
+        The checker is only called when no result is cached.
+        """
+        credentials = self.getCredentials()
+        calls = []
+
+        def checker(credentials):
+            calls.append(credentials)
+            return True
+
+        results = []
+        self.cache.authenticate(credentials, checker).addCallback(
+            results.append)
+        self.cache.authenticate(credentials, checker).addCallback(
+            results.append)
+
+        self.assertEqual([True, True], results)
+        self.assertEqual([credentials], calls)
+
+    def test_authenticate_ssh_key_not_cached(self):
+        """
+        The checker is called for each SSH key request, so a wrong
+        signature is rejected after a successful authentication with
+        the same key.
+        """
+        private_key = Key.fromString(data=RSA_PRIVATE_KEY)
+        username = manufacture.getUniqueString()
+        valid = SSHKeyCredentials(
+            username=username,
+            key_algorithm='ssh-rsa',
+            key_data=private_key.public().blob(),
+            key_signed_data='session data',
+            key_signature=private_key.sign('session data'),
+            )
+        forged = SSHKeyCredentials(
+            username=username,
+            key_algorithm='ssh-rsa',
+            key_data=private_key.public().blob(),
+            key_signed_data='other session data',
+            key_signature=private_key.sign('session data'),
+            )
+        calls = []
+
+        def checker(credentials):
+            calls.append(credentials)
+            if not credentials.verify():
+                raise UnauthorizedLogin()
+            return True
+
+        results = []
+        self.cache.authenticate(valid, checker).addBoth(results.append)
+        self.cache.authenticate(forged, checker).addBoth(results.append)
+
+        self.assertEqual([valid, forged], calls)
+        self.assertTrue(results[0])
+        self.assertIsInstance(Failure, results[1])
+        self.assertTrue(results[1].check(UnauthorizedLogin))
+        self.assertEqual(0, len(self.cache))
+
+    def test_authenticate_pending(self):
+        """
+        Requests made while the checker is running receive the same
+        result.
+        """
+        credentials = self.getCredentials()
+        checked = Deferred()
+        calls = []
+
+        def checker(credentials):
+            calls.append(credentials)
+            return checked
+
+        results = []
+        self.cache.authenticate(credentials, checker).addErrback(
+            results.append)
+        self.cache.authenticate(credentials, checker).addErrback(
+            results.append)
+        self.assertEqual([], results)
+
+        checked.errback(UnauthorizedLogin())
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(2, len(results))
+        self.assertTrue(results[1].check(UnauthorizedLogin))
+        self.assertEqual(1, len(self.cache))
+
+    def test_remove(self):
+        """
+        The result for the credentials is removed.
+        """
+        credentials = self.getCredentials()
+        self.cache.store(credentials, True)
+
+        self.cache.remove(credentials)
+
+        self.assertIsNone(self.getLookupResult(credentials))
@@ -3,12 +3,23 @@
 '''Test module for crypto.'''
 from __future__ import with_statement
 
+from Crypto.PublicKey import RSA
 from OpenSSL import crypto
 from StringIO import StringIO
 
+from mock import patch
 from nose.plugins.attrib import attr
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.python.failure import Failure
 
-from chevah.utils.crypto import Key
+from chevah.utils.crypto import (
+    CertificateFactory,
+    Key,
+    KeyGenerationPool,
+    PregeneratedKeyPool,
+    PublicKeyCache,
+    )
 from chevah.utils.exceptions import UtilsError
 from chevah.utils.testing import LogTestCase, mk
 
@@ -141,3 +152,530 @@ class TestKey(LogTestCase):
         self.assertEqual(key.data, result_key.data)
         self.assertEqual(
             public_file.getvalue().decode('utf-8'), public_key_serialization)
+
+    def test_fingerprint_memoized(self):
+        """
+        The fingerprint is only computed once.
+        """
+        key = Key.fromString(data=RSA_PUBLIC_KEY_OPENSSH)
+
+        fingerprint = key.fingerprint()
+
+        self.assertEqual(fingerprint, key._fingerprint)
+        with patch.object(key, 'blob') as mock_blob:
+            self.assertEqual(fingerprint, key.fingerprint())
+            self.assertFalse(mock_blob.called)
+
+
+class TestPublicKeyCache(LogTestCase):
+    """
+    Tests for PublicKeyCache.
+    """
+
+    def test_get_miss(self):
+        """
+        On first usage the key is parsed from the blob.
+        """
+        cache = PublicKeyCache()
+        blob = Key.fromString(data=RSA_PUBLIC_KEY_OPENSSH).blob()
+
+        key = cache.get(blob)
+
+        self.assertIsInstance(Key, key)
+        self.assertEqual(blob, key.blob())
+        self.assertEqual(1, len(cache))
+        self.assertEqual(0, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_get_hit(self):
+        """
+        The same key object is returned for the same blob.
+        """
+        cache = PublicKeyCache()
+        blob = Key.fromString(data=RSA_PUBLIC_KEY_OPENSSH).blob()
+        key = cache.get(blob)
+
+        result = cache.get(blob)
+
+        self.assertIs(key, result)
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_get_evict_least_recently_used(self):
+        """
+        When the cache is full, the least recently used key is removed.
+        """
+        cache = PublicKeyCache(size=2)
+        rsa_blob = Key.fromString(data=RSA_PUBLIC_KEY_OPENSSH).blob()
+        dsa_blob = Key.fromString(data=DSA_PUBLIC_KEY_OPENSSH).blob()
+        rsa_object = Key.fromString(data=RSA_PUBLIC_KEY_OPENSSH).keyObject
+        other_blob = Key(RSA.construct((rsa_object.n, 3L))).blob()
+        rsa_key = cache.get(rsa_blob)
+        cache.get(dsa_blob)
+        # Use the RSA key so that the DSA key is the oldest one.
+        cache.get(rsa_blob)
+
+        cache.get(other_blob)
+
+        self.assertEqual(2, len(cache))
+        self.assertIs(rsa_key, cache.get(rsa_blob))
+        misses = cache.misses
+        cache.get(dsa_blob)
+        self.assertEqual(misses + 1, cache.misses)
+
+    def test_get_invalid(self):
+        """
+        An error is raised when the blob is not a valid key.
+        """
+        cache = PublicKeyCache()
+
+        with self.assertRaises(UtilsError) as context:
+            cache.get(mk.string().encode('utf-8'))
+
+        self.assertEqual(u'1038', context.exception.event_id)
+        self.assertEqual(0, len(cache))
+
+    def test_get_invalid_non_ascii(self):
+        """
+        An error is raised when the blob has a non-ASCII key type.
+        """
+        cache = PublicKeyCache()
+
+        with self.assertRaises(UtilsError) as context:
+            cache.get('\x00\x00\x00\x04\xff\xfe\xfd\xfc')
+
+        self.assertEqual(u'1038', context.exception.event_id)
+        self.assertStartsWith(
+            u'Invalid SSH public key.', context.exception.message)
+
+    def test_clear(self):
+        """
+        All keys are removed from the cache.
+        """
+        cache = PublicKeyCache()
+        cache.get(Key.fromString(data=RSA_PUBLIC_KEY_OPENSSH).blob())
+
+        cache.clear()
+
+        self.assertEqual(0, len(cache))
+
+
+class DummyProcessTransport(object):
+    """
+    A process transport which records sent signals.
+    """
+
+    def __init__(self):
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+
+class DummyProcessReactor(object):
+    """
+    A reactor which records spawned processes without starting them.
+    """
+
+    def __init__(self):
+        self.processes = []
+
+    def spawnProcess(self, protocol, executable, args, env):
+        transport = DummyProcessTransport()
+        self.processes.append((protocol, args, transport))
+        return transport
+
+
+class TestKeyGenerationPool(LogTestCase):
+    """
+    Tests for KeyGenerationPool.
+    """
+
+    def setUp(self):
+        super(TestKeyGenerationPool, self).setUp()
+        self.reactor = DummyProcessReactor()
+        self.pool = KeyGenerationPool(size=1, reactor=self.reactor)
+
+    def test_generate_unknown_type(self):
+        """
+        The deferred fails right away for an unknown key type.
+        """
+        failures = []
+
+        self.pool.generate(key_type=0).addErrback(failures.append)
+
+        self.assertEqual(u'1003', failures[0].value.event_id)
+        self.assertEqual([], self.reactor.processes)
+
+    def test_generate_success(self):
+        """
+        The deferred is called with the key generated by the child
+        process.
+        """
+        results = []
+
+        self.pool.generate(
+            key_type=crypto.TYPE_RSA, key_size=2048).addCallback(
+                results.append)
+
+        protocol, args, transport = self.reactor.processes[0]
+        self.assertEqual([str(crypto.TYPE_RSA), '2048'], args[-2:])
+        protocol.outReceived(RSA_PRIVATE_KEY[:10])
+        protocol.outReceived(RSA_PRIVATE_KEY[10:])
+        protocol.processEnded(Failure(ProcessDone(0)))
+
+        self.assertIsInstance(Key, results[0])
+        self.assertEqual(RSA_PRIVATE_KEY, results[0].private_openssh)
+        self.assertEqual(0, self.pool.running)
+
+    def test_generate_known_error(self):
+        """
+        Errors raised by the child process are forwarded.
+        """
+        failures = []
+        self.pool.generate(key_size=1).addErrback(failures.append)
+        protocol, args, transport = self.reactor.processes[0]
+
+        protocol.errReceived('1004\nWrong key size "1".')
+        protocol.processEnded(Failure(ProcessTerminated(exitCode=2)))
+
+        self.assertEqual(u'1004', failures[0].value.event_id)
+        self.assertEqual(u'Wrong key size "1".', failures[0].value.message)
+
+    def test_generate_process_failure(self):
+        """
+        An error is raised when the child process fails.
+        """
+        failures = []
+        self.pool.generate().addErrback(failures.append)
+        protocol, args, transport = self.reactor.processes[0]
+
+        protocol.errReceived('Some traceback')
+        protocol.processEnded(Failure(ProcessTerminated(exitCode=1)))
+
+        self.assertEqual(u'1036', failures[0].value.event_id)
+        self.assertContains(u'Some traceback', failures[0].value.message)
+
+    def test_generate_bounded(self):
+        """
+        Only `size` keys are generated at the same time and the next key
+        is started when a slot is free.
+        """
+        self.pool.generate()
+        self.pool.generate()
+
+        self.assertEqual(1, len(self.reactor.processes))
+        self.assertEqual(1, self.pool.running)
+        self.assertEqual(1, self.pool.pending)
+
+        protocol, args, transport = self.reactor.processes[0]
+        protocol.outReceived(RSA_PRIVATE_KEY)
+        protocol.processEnded(Failure(ProcessDone(0)))
+
+        self.assertEqual(2, len(self.reactor.processes))
+        self.assertEqual(1, self.pool.running)
+        self.assertEqual(0, self.pool.pending)
+
+    def test_cancel_pending(self):
+        """
+        A pending job is removed from the queue when cancelled.
+        """
+        self.pool.generate()
+        deferred = self.pool.generate()
+        failures = []
+        deferred.addErrback(failures.append)
+
+        deferred.cancel()
+
+        self.assertTrue(failures[0].check(CancelledError))
+        self.assertEqual(0, self.pool.pending)
+        self.assertEqual(1, len(self.reactor.processes))
+
+    def test_cancel_running(self):
+        """
+        The child process is killed when a running job is cancelled and the
+        next job is started.
+        """
+        deferred = self.pool.generate()
+        self.pool.generate()
+        failures = []
+        deferred.addErrback(failures.append)
+        protocol, args, transport = self.reactor.processes[0]
+
+        deferred.cancel()
+        protocol.processEnded(Failure(ProcessTerminated(signal=9)))
+
+        self.assertTrue(failures[0].check(CancelledError))
+        self.assertEqual(['KILL'], transport.signals)
+        self.assertEqual(2, len(self.reactor.processes))
+
+
+class DummyKeyGenerator(object):
+    """
+    A key generator which records the requests.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def generate(self, key_type, key_size):
+        deferred = Deferred()
+        self.requests.append((deferred, key_type, key_size))
+        return deferred
+
+
+class TestPregeneratedKeyPool(LogTestCase):
+    """
+    Tests for PregeneratedKeyPool.
+    """
+
+    def setUp(self):
+        super(TestPregeneratedKeyPool, self).setUp()
+        self.generator = DummyKeyGenerator()
+
+    def makePool(self, **kwargs):
+        """
+        Return a started pool using the dummy generator.
+        """
+        pool = PregeneratedKeyPool(generator=self.generator, **kwargs)
+        pool.start()
+        return pool
+
+    def test_start(self):
+        """
+        When started, keys are generated until capacity is reached.
+        """
+        self.makePool(key_sizes=[1024, 2048], capacity=2)
+
+        self.assertEqual(4, len(self.generator.requests))
+        self.assertEqual(
+            [1024, 1024, 2048, 2048],
+            sorted([request[2] for request in self.generator.requests]))
+
+    def test_pop_available(self):
+        """
+        A pre-generated key is returned when available, and no new key
+        is generated while above low watermark.
+        """
+        pool = self.makePool(capacity=3, low_watermark=1)
+        key = Key.fromString(RSA_PRIVATE_KEY)
+        for request in self.generator.requests:
+            request[0].callback(key)
+
+        result = pool.pop()
+
+        self.assertIs(key, result)
+        self.assertEqual(3, len(self.generator.requests))
+        self.assertEqual(
+            {1024: {
+                'available': 2,
+                'generating': 0,
+                'served': 1,
+                'misses': 0,
+                'low_watermark_hits': 0,
+                }},
+            pool.getStatistics(),
+            )
+
+    def test_pop_low_watermark(self):
+        """
+        Keys are generated in background when low watermark is reached.
+        """
+        pool = self.makePool(capacity=2, low_watermark=1)
+        key = Key.fromString(RSA_PRIVATE_KEY)
+        for request in self.generator.requests:
+            request[0].callback(key)
+
+        pool.pop()
+
+        self.assertEqual(3, len(self.generator.requests))
+        statistics = pool.getStatistics()[1024]
+        self.assertEqual(1, statistics['low_watermark_hits'])
+        self.assertEqual(1, statistics['generating'])
+
+    def test_pop_empty(self):
+        """
+        When no key is available, the key is generated right away.
+        """
+        pool = self.makePool(capacity=1)
+        key = Key.fromString(RSA_PRIVATE_KEY)
+
+        with patch.object(pool, '_generateNow', return_value=key) as patched:
+            result = pool.pop(1024)
+
+        self.assertIs(key, result)
+        patched.assert_called_once_with(1024)
+        self.assertEqual(1, pool.getStatistics()[1024]['misses'])
+
+    def test_stop(self):
+        """
+        Background generation is cancelled when the pool is stopped.
+        """
+        pool = self.makePool(capacity=2)
+
+        pool.stop()
+
+        self.assertEqual(0, pool.getStatistics()[1024]['generating'])
+
+    def test_init_path_without_passphrase(self):
+        """
+        Keys can not be stored without encryption.
+        """
+        with self.assertRaises(AssertionError):
+            PregeneratedKeyPool(path=mk.string(), generator=self.generator)
+
+    def test_store_and_load(self):
+        """
+        Available keys are stored encrypted when stopped and loaded when
+        started. Loaded keys are removed from the file.
+        """
+        path, segments = mk.fs.makePathInTemp()
+        try:
+            pool = self.makePool(
+                capacity=1, path=path, passphrase='secret')
+            self.generator.requests[0][0].callback(
+                Key.fromString(RSA_PRIVATE_KEY))
+
+            pool.stop()
+
+            with open(path) as stream:
+                content = stream.read()
+            self.assertContains('ENCRYPTED', content)
+            self.assertFalse(RSA_PRIVATE_KEY in content)
+
+            other_pool = self.makePool(
+                capacity=1, path=path, passphrase='secret')
+            self.assertEqual(
+                RSA_PRIVATE_KEY, other_pool.pop().private_openssh)
+            with open(path) as stream:
+                self.assertEqual('{}', stream.read())
+        finally:
+            mk.fs.deleteFile(segments, ignore_errors=True)
+
+    def test_load_bad_passphrase(self):
+        """
+        An error is raised when stored keys can not be decrypted.
+        """
+        path, segments = mk.fs.makePathInTemp()
+        try:
+            pool = self.makePool(
+                capacity=1, path=path, passphrase='secret')
+            self.generator.requests[0][0].callback(
+                Key.fromString(RSA_PRIVATE_KEY))
+            pool.stop()
+
+            with self.assertRaises(UtilsError) as context:
+                self.makePool(capacity=1, path=path, passphrase='other')
+
+            self.assertEqual(u'1037', context.exception.event_id)
+        finally:
+            mk.fs.deleteFile(segments, ignore_errors=True)
+
+
+class TestCertificateFactory(LogTestCase):
+    """
+    Tests for CertificateFactory.
+    """
+
+    def getExtensions(self, certificate):
+        """
+        Return a dictionary with the text of all certificate extensions.
+        """
+        result = {}
+        for index in range(certificate.get_extension_count()):
+            extension = certificate.get_extension(index)
+            result[extension.get_short_name()] = str(extension)
+        return result
+
+    def test_init_unknown_type(self):
+        """
+        An error is raised for unknown key types.
+        """
+        with self.assertRaises(UtilsError) as context:
+            CertificateFactory(key_type=0)
+
+        self.assertEqual(u'1003', context.exception.event_id)
+
+    def test_createSelfSigned(self):
+        """
+        Self signed certificates are created using the configured key,
+        digest, subject and alternative names.
+        """
+        factory = CertificateFactory(
+            key_type=crypto.TYPE_DSA, key_size=1024, digest='sha1')
+
+        certificate, key = factory.createSelfSigned(
+            subject={'CN': u'example.com', 'O': u'Chevah'},
+            alternative_names=['www.example.com', 'IP:127.0.0.1'],
+            )
+
+        self.assertEqual(crypto.TYPE_DSA, key.type())
+        self.assertEqual(1024, key.bits())
+        self.assertEqual('example.com', certificate.get_subject().CN)
+        self.assertEqual('Chevah', certificate.get_subject().O)
+        self.assertEqual('UN', certificate.get_subject().C)
+        components = certificate.get_subject().get_components()
+        self.assertEqual(
+            ['C', 'ST', 'L', 'O', 'OU', 'CN'],
+            [name for name, value in components])
+        self.assertEqual(certificate.get_subject(), certificate.get_issuer())
+        self.assertEqual(
+            'dsaWithSHA1', certificate.get_signature_algorithm())
+        extensions = self.getExtensions(certificate)
+        self.assertEqual(
+            'DNS:www.example.com, IP Address:127.0.0.1',
+            extensions['subjectAltName'])
+        self.assertEqual('CA:FALSE', extensions['basicConstraints'])
+
+    def test_issue_without_issuer(self):
+        """
+        Certificates can not be issued without an issuer.
+        """
+        factory = CertificateFactory(key_size=1024)
+
+        with self.assertRaises(AssertionError):
+            factory.issue()
+
+    def test_createCA_issueMany(self):
+        """
+        After a CA is created, all issued certificates are signed by the
+        CA.
+        """
+        factory = CertificateFactory(key_size=1024)
+
+        ca_certificate, ca_key = factory.createCA(subject={'CN': 'CA'})
+        results = factory.issueMany([
+            ({'CN': 'first'}, None),
+            ({'CN': 'second'}, ['second.example.com']),
+            ])
+
+        self.assertIs(ca_certificate, factory.issuer)
+        self.assertEqual(
+            'CA:TRUE', self.getExtensions(ca_certificate)['basicConstraints'])
+        self.assertEqual(2, len(results))
+        self.assertEqual('first', results[0][0].get_subject().CN)
+        self.assertEqual('second', results[1][0].get_subject().CN)
+        for certificate, key in results:
+            self.assertEqual(
+                ca_certificate.get_subject(), certificate.get_issuer())
+            self.assertEqual(
+                'sha256WithRSAEncryption',
+                certificate.get_signature_algorithm())
+        self.assertNotEqual(
+            results[0][0].get_serial_number(),
+            results[1][0].get_serial_number())
+
+    def test_setIssuer(self):
+        """
+        The issuer can be loaded from PEM data.
+        """
+        factory = CertificateFactory(key_size=1024)
+        ca_certificate, ca_key = factory.createCA(subject={'CN': 'CA'})
+        certificate_pem, key_pem = factory.dump(ca_certificate, ca_key)
+        other_factory = CertificateFactory(key_size=1024)
+
+        other_factory.setIssuer(certificate_pem, key_pem)
+        certificate, key = other_factory.issue(subject={'CN': 'leaf'})
+
+        self.assertEqual(
+            ca_certificate.get_subject(), certificate.get_issuer())
@@ -8,6 +8,9 @@ import os
 
 from jinja2 import DictLoader, Environment
 from mock import patch
+from twisted.internet.address import IPv4Address
+from twisted.internet.defer import CancelledError, Deferred
+from twisted.internet.task import Clock
 
 from chevah.utils import MODULE_PATH
 from chevah.utils.testing import (
@@ -20,6 +23,12 @@ from chevah.utils.constants import (
     )
 from chevah.utils.event import (
     Event,
+    EventAction,
+    EventActionsDispatcher,
+    EventRateLimit,
+    EventsMetrics,
+    EventsRateLimiter,
+    EventsSampler,
     EventDefinition,
     EventGroupDefinition,
     EventsDefinition,
@@ -471,6 +480,512 @@ class TestEventsDefinition(UtilsTestCase):
         self.assertTrue('groups: group-1, group-2' in result)
 
 
+ACTIONS_DEFINITIONS = '''
+    {
+    "groups" : {
+        "enabled": { "description": ""},
+        "disabled": { "description": ""}
+        },
+    "events" : {
+        "100": {
+            "message": "some message",
+            "groups": ["enabled"],
+            "description": "",
+            "version_removed": "",
+            "version_added": "",
+            "details": "",
+            "data": ""
+            },
+        "101": {
+            "message": "other message",
+            "groups": ["disabled"],
+            "description": "",
+            "version_removed": "",
+            "version_added": "",
+            "details": "",
+            "data": ""
+            }
+        }
+    }
+    '''
+
+
+class DummyEventAction(EventAction):
+    """
+    An action which is done when its deferred is fired.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(DummyEventAction, self).__init__(*args, **kwargs)
+        self.calls = []
+
+    def run(self, event):
+        deferred = Deferred()
+        self.calls.append((event, deferred))
+        return deferred
+
+
+class TestEventActionsDispatcher(UtilsTestCase):
+    """
+    Unit tests for EventActionsDispatcher.
+    """
+
+    def setUp(self):
+        super(TestEventActionsDispatcher, self).setUp()
+        self.clock = Clock()
+        self.dispatcher = EventActionsDispatcher(size=2, reactor=self.clock)
+        self.dispatcher.compile(manufacture.makeEventsDefinition(
+            content=ACTIONS_DEFINITIONS))
+
+    def test_getActions(self):
+        """
+        Actions are associated using event ids and group names, with
+        the actions for the event id first.
+        """
+        by_id = DummyEventAction(u'by id')
+        by_group = DummyEventAction(u'by group')
+        both = DummyEventAction(u'both')
+        self.dispatcher.addAction(by_id, event_ids=[101])
+        self.dispatcher.addAction(by_group, groups=[u'enabled'])
+        self.dispatcher.addAction(
+            both, event_ids=[u'100'], groups=[u'enabled'])
+
+        self.assertEqual((both, by_group), self.dispatcher.getActions(u'100'))
+        self.assertEqual((by_id,), self.dispatcher.getActions(u'101'))
+        self.assertEqual((), self.dispatcher.getActions(u'102'))
+
+    def test_removeAction(self):
+        """
+        Removed actions are no longer returned for events.
+        """
+        action = DummyEventAction(u'action')
+        self.dispatcher.addAction(action, groups=[u'enabled'])
+        self.assertEqual((action,), self.dispatcher.getActions(u'100'))
+
+        self.dispatcher.removeAction(action)
+
+        self.assertEqual((), self.dispatcher.getActions(u'100'))
+
+    def test_dispatch_no_actions(self):
+        """
+        When no action is associated, the deferred fires right away.
+        """
+        results = []
+
+        self.dispatcher.dispatch(Event(id=u'100')).addCallback(
+            results.append)
+
+        self.assertEqual([[]], results)
+
+    def test_dispatch_later(self):
+        """
+        Actions are not started by the emitting call, and the deferred
+        fires when all actions are done.
+        """
+        first = DummyEventAction(u'first')
+        second = DummyEventAction(u'second')
+        self.dispatcher.addAction(first, event_ids=[u'100'])
+        self.dispatcher.addAction(second, groups=[u'enabled'])
+        event = Event(id=u'100')
+        results = []
+
+        self.dispatcher.dispatch(event).addCallback(results.append)
+
+        self.assertEqual([], first.calls)
+        self.clock.advance(0)
+        self.assertEqual(event, first.calls[0][0])
+        self.assertEqual(event, second.calls[0][0])
+
+        first.calls[0][1].callback(u'first result')
+        self.assertEqual([], results)
+        second.calls[0][1].errback(RuntimeError(u'error'))
+
+        self.assertEqual(first, results[0][0][0])
+        self.assertEqual(u'first result', results[0][0][1])
+        self.assertTrue(results[0][1][1].check(RuntimeError))
+
+    def test_dispatch_pool_size(self):
+        """
+        At most `size` actions are running at the same time.
+        """
+        action = DummyEventAction(u'action')
+        self.dispatcher.addAction(action, event_ids=[u'100'])
+
+        for index in range(3):
+            self.dispatcher.dispatch(Event(id=u'100'))
+        self.clock.advance(0)
+
+        self.assertEqual(2, len(action.calls))
+        action.calls[0][1].callback(None)
+        self.assertEqual(3, len(action.calls))
+
+    def test_dispatch_action_concurrency(self):
+        """
+        An action is only running for `concurrency` events at the same
+        time.
+        """
+        action = DummyEventAction(u'action', concurrency=1)
+        self.dispatcher.addAction(action, event_ids=[u'100'])
+
+        self.dispatcher.dispatch(Event(id=u'100'))
+        self.dispatcher.dispatch(Event(id=u'100'))
+        self.clock.advance(0)
+
+        self.assertEqual(1, len(action.calls))
+        action.calls[0][1].callback(None)
+        self.assertEqual(2, len(action.calls))
+
+    def test_dispatch_timeout(self):
+        """
+        Actions are cancelled after the timeout.
+        """
+        action = DummyEventAction(u'action', timeout=5)
+        self.dispatcher.addAction(action, event_ids=[u'100'])
+        results = []
+        self.dispatcher.dispatch(Event(id=u'100')).addCallback(
+            results.append)
+        self.clock.advance(0)
+
+        self.clock.advance(4)
+        self.assertEqual([], results)
+        self.clock.advance(1)
+
+        self.assertTrue(results[0][0][1].check(CancelledError))
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
+class TestEventRateLimit(UtilsTestCase):
+    """
+    Unit tests for EventRateLimit.
+    """
+
+    def test_consume_burst(self):
+        """
+        At most `burst` events are allowed at once, and tokens are added
+        back based on the rate.
+        """
+        limit = EventRateLimit(rate=2, burst=3)
+        event = Event(id=u'100')
+
+        results = [limit.consume(event, 0) for index in range(4)]
+
+        self.assertEqual([True, True, True, False], results)
+        self.assertFalse(limit.consume(event, 0.4))
+        self.assertTrue(limit.consume(event, 0.5))
+        self.assertFalse(limit.consume(event, 0.5))
+
+    def test_consume_per_peer(self):
+        """
+        Each peer host has its own bucket, shared by all its connections.
+        """
+        limit = EventRateLimit(rate=1, per_peer=True)
+        first = Event(
+            id=u'100', data={'peer': IPv4Address('TCP', '10.0.0.1', 1000)})
+        reconnected = Event(
+            id=u'100', data={'peer': IPv4Address('TCP', '10.0.0.1', 1001)})
+        second = Event(
+            id=u'100', data={'peer': IPv4Address('TCP', '10.0.0.2', 1000)})
+
+        self.assertTrue(limit.consume(first, 0))
+        self.assertFalse(limit.consume(reconnected, 0))
+        self.assertTrue(limit.consume(second, 0))
+        self.assertEqual(2, len(limit._buckets))
+
+    def test_consume_max_peers(self):
+        """
+        When there are too many buckets, the least recently updated
+        bucket is removed.
+        """
+        limit = EventRateLimit(rate=1, per_peer=True, max_peers=2)
+
+        def consume(host, now):
+            return limit.consume(Event(
+                id=u'100', data={'peer': IPv4Address('TCP', host, 22)}), now)
+
+        consume('10.0.0.1', 0)
+        consume('10.0.0.2', 0.5)
+        consume('10.0.0.3', 0.6)
+
+        self.assertEqual(['10.0.0.2', '10.0.0.3'], limit._buckets.keys())
+
+        consume('10.0.0.2', 0.7)
+        consume('10.0.0.4', 0.8)
+
+        self.assertEqual(['10.0.0.2', '10.0.0.4'], limit._buckets.keys())
+
+    def test_prune(self):
+        """
+        Full buckets are removed.
+        """
+        limit = EventRateLimit(rate=1, per_peer=True)
+        limit.consume(Event(id=u'100', data={'peer': u'first'}), 0)
+        limit.consume(Event(id=u'100', data={'peer': u'second'}), 5)
+
+        limit.prune(5.5)
+
+        self.assertEqual([u'second'], limit._buckets.keys())
+
+
+class TestEventsRateLimiter(UtilsTestCase):
+    """
+    Unit tests for EventsRateLimiter.
+    """
+
+    def setUp(self):
+        super(TestEventsRateLimiter, self).setUp()
+        self.clock = Clock()
+        self.limiter = EventsRateLimiter(
+            summary_interval=10, reactor=self.clock)
+        self.limiter.compile(manufacture.makeEventsDefinition(
+            content=ACTIONS_DEFINITIONS))
+
+    def tearDown(self):
+        self.limiter.stop()
+        super(TestEventsRateLimiter, self).tearDown()
+
+    def test_getLimits(self):
+        """
+        Limits are associated using event ids, group names or with all
+        events.
+        """
+        by_id = EventRateLimit(rate=1)
+        by_group = EventRateLimit(rate=1)
+        default = EventRateLimit(rate=1)
+        self.limiter.addLimit(by_id, event_ids=[101])
+        self.limiter.addLimit(by_group, groups=[u'enabled'])
+        self.limiter.addLimit(default)
+
+        self.assertEqual(
+            (default, by_group), self.limiter.getLimits(u'100'))
+        self.assertEqual((default, by_id), self.limiter.getLimits(u'101'))
+        self.assertEqual((default,), self.limiter.getLimits(u'102'))
+
+    def test_allow_no_limits(self):
+        """
+        Events without limits are always allowed.
+        """
+        for index in range(10):
+            self.assertTrue(self.limiter.allow(Event(id=u'100')))
+
+        self.assertEqual({}, self.limiter.popSuppressed())
+
+    def test_allow_suppressed(self):
+        """
+        Events over the limit are not allowed and are counted.
+        """
+        self.limiter.addLimit(EventRateLimit(rate=1), event_ids=[u'100'])
+
+        self.assertTrue(self.limiter.allow(Event(id=u'100')))
+        self.assertFalse(self.limiter.allow(Event(id=u'100')))
+        self.assertFalse(self.limiter.allow(Event(id=u'100')))
+        self.assertTrue(self.limiter.allow(Event(id=u'101')))
+
+        self.assertEqual({u'100': 2}, self.limiter.popSuppressed())
+        self.assertEqual({}, self.limiter.popSuppressed())
+
+    def test_start_summary(self):
+        """
+        The suppressed events are reported each summary interval.
+        """
+        self.limiter.addLimit(EventRateLimit(rate=1), groups=[u'enabled'])
+        summaries = []
+        self.limiter.start(
+            lambda event_id, count: summaries.append((event_id, count)))
+        for index in range(3):
+            self.limiter.allow(Event(id=u'100'))
+
+        self.clock.advance(9)
+        self.assertEqual([], summaries)
+        self.clock.advance(1)
+
+        self.assertEqual([(u'100', 2)], summaries)
+
+
+class TestEventsSampler(UtilsTestCase):
+    """
+    Unit tests for EventsSampler.
+    """
+
+    def makeEventDefinition(self, *group_names):
+        """
+        Return an event definition for `group_names`.
+        """
+        return EventDefinition(
+            id=u'100',
+            message=u'some message',
+            groups=[EventGroupDefinition(name=name) for name in group_names],
+            )
+
+    def keepAll(self, sampler, event_definition, events):
+        """
+        Return the list of results for `events`.
+        """
+        return [sampler.keep(event, event_definition) for event in events]
+
+    def test_keep_not_sampled(self):
+        """
+        Events are kept when at least one of their groups is not
+        sampled.
+        """
+        sampler = EventsSampler({u'informational': (10, u'count')})
+        event = Event(id=u'100')
+
+        self.assertEqual(
+            [True] * 3,
+            self.keepAll(
+                sampler,
+                self.makeEventDefinition(u'informational', u'failure'),
+                [event] * 3,
+                ))
+        self.assertEqual({}, sampler.getStats())
+
+    def test_keep_count(self):
+        """
+        With the count key, the first event and then each N-th event
+        is kept.
+        """
+        sampler = EventsSampler({u'informational': (3, u'count')})
+
+        results = self.keepAll(
+            sampler,
+            self.makeEventDefinition(u'informational'),
+            [Event(id=u'100')] * 7,
+            )
+
+        self.assertEqual(
+            [True, False, False, True, False, False, True], results)
+        self.assertEqual(
+            {u'informational': {'kept': 3, 'dropped': 4}},
+            sampler.getStats())
+
+    def test_keep_lowest_rate(self):
+        """
+        When all groups are sampled, the lowest rate is used and the
+        statistics are updated for all groups.
+        """
+        sampler = EventsSampler({
+            u'informational': (3, u'count'),
+            u'operational': (2, u'count'),
+            })
+
+        results = self.keepAll(
+            sampler,
+            self.makeEventDefinition(u'informational', u'operational'),
+            [Event(id=u'100')] * 4,
+            )
+
+        self.assertEqual([True, False, True, False], results)
+        self.assertEqual({'kept': 2, 'dropped': 2},
+            sampler.getStats()[u'operational'])
+        self.assertEqual({'kept': 2, 'dropped': 2},
+            sampler.getStats()[u'informational'])
+
+    def test_keep_peer(self):
+        """
+        With the peer key, all events from the same peer are kept or
+        dropped.
+        """
+        sampler = EventsSampler({u'informational': (2, u'peer')})
+        event_definition = self.makeEventDefinition(u'informational')
+        dropped = Event(
+            id=u'100', data={'peer': IPv4Address('TCP', '10.0.0.1', 22)})
+        kept = Event(
+            id=u'100', data={'peer': IPv4Address('TCP', '10.0.0.4', 22)})
+
+        self.assertEqual(
+            [False, True, False, True],
+            self.keepAll(
+                sampler, event_definition, [dropped, kept, dropped, kept]))
+
+    def test_keep_avatar(self):
+        """
+        With the avatar key, all events from the same avatar are kept or
+        dropped. Events without an avatar are sampled by count.
+        """
+        sampler = EventsSampler({u'informational': (2, u'avatar')})
+        event_definition = self.makeEventDefinition(u'informational')
+        kept_avatar = self.Mock()
+        kept_avatar.name = u'john'
+        dropped_avatar = self.Mock()
+        dropped_avatar.name = u'mary'
+        kept = Event(id=u'100', data={'avatar': kept_avatar})
+        dropped = Event(id=u'100', data={'avatar': dropped_avatar})
+        anonymous = Event(id=u'100', data={'avatar': None})
+
+        self.assertEqual(
+            [True, False, True, False, True],
+            self.keepAll(
+                sampler,
+                event_definition,
+                [kept, dropped, anonymous, anonymous, anonymous],
+                ))
+
+
+class TestEventsMetrics(UtilsTestCase):
+    """
+    Unit tests for EventsMetrics.
+    """
+
+    def setUp(self):
+        super(TestEventsMetrics, self).setUp()
+        self.clock = Clock()
+        self.metrics = EventsMetrics(tick_interval=5, reactor=self.clock)
+        self.metrics.compile(
+            manufacture.makeEventsDefinition(content=ACTIONS_DEFINITIONS))
+
+    def test_getStats_empty(self):
+        """
+        Without events, there are no statistics.
+        """
+        self.assertEqual(
+            {'events': {}, 'groups': {}}, self.metrics.getStats())
+
+    def test_record(self):
+        """
+        Events are counted by id and by group, including the events
+        without a definition.
+        """
+        for event_id in [u'100', u'100', u'101', u'999']:
+            self.metrics.record(event_id)
+
+        stats = self.metrics.getStats()
+
+        self.assertEqual(2, stats['events'][u'100']['count'])
+        self.assertEqual(1, stats['events'][u'999']['count'])
+        self.assertEqual(0.0, stats['events'][u'100']['rate_1m'])
+        self.assertEqual(
+            [u'disabled', u'enabled'], sorted(stats['groups'].keys()))
+        self.assertEqual(2, stats['groups'][u'enabled']['count'])
+
+    def test_tick(self):
+        """
+        The first tick sets the rates and the next ticks update the rates
+        as moving averages, with shorter windows changing faster.
+        """
+        self.metrics.start()
+        try:
+            for index in range(10):
+                self.metrics.record(u'100')
+            self.clock.advance(5)
+
+            stats = self.metrics.getStats()['events'][u'100']
+            self.assertEqual(2.0, stats['rate_1m'])
+            self.assertEqual(2.0, stats['rate_15m'])
+
+            self.clock.advance(5)
+
+            stats = self.metrics.getStats()['events'][u'100']
+            self.assertTrue(0 < stats['rate_1m'] < stats['rate_5m'])
+            self.assertTrue(stats['rate_5m'] < stats['rate_15m'] < 2.0)
+            self.assertEqual(
+                stats['rate_1m'],
+                self.metrics.getStats()['groups'][u'enabled']['rate_1m'])
+        finally:
+            self.metrics.stop()
+
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+
 class TestEventsHandler(LogTestCase):
     """
     Unit tests for EventsHandler.
@@ -594,6 +1109,73 @@ class TestEventsHandler(LogTestCase):
         event = patched.call_args[0][0]
         self.assertEqual(u'100', event.id)
 
+    def test_getHandle(self):
+        """
+        The same handle is returned for integer, string and unicode ids
+        and handles are created again when the handler is configured.
+        """
+        handler = EventsHandler()
+        handle = handler.getHandle(100)
+
+        self.assertIs(handle, handler.getHandle('100'))
+        self.assertIs(handle, handler.getHandle(u'100'))
+        self.assertEqual(u'100', handle.id)
+        self.assertEqual(100, handle.message_id)
+        self.assertIsNone(handle.definition)
+
+        handler.configure(
+            definitions=manufacture.makeEventsDefinition(
+                content=ACTIONS_DEFINITIONS),
+            log_configuration_section=(
+                manufacture.makeLogConfigurationSection()),
+            )
+        try:
+            handle = handler.getHandle(100)
+
+            self.assertEqual(u'100', handle.definition.id)
+            self.assertIsNone(handler.getHandle(u'other').message_id)
+        finally:
+            handler.removeConfiguration()
+
+    def test_emitFast(self):
+        """
+        emitFast logs the event and runs the associated actions, without
+        returning a deferred.
+        """
+        clock = Clock()
+        actions = EventActionsDispatcher(reactor=clock)
+        action = DummyEventAction(u'dummy action')
+        actions.addAction(action, event_ids=[u'100'])
+        handler = EventsHandler()
+        handler.configure(
+            definitions=manufacture.makeEventsDefinition(
+                content=ACTIONS_DEFINITIONS),
+            log_configuration_section=(
+                manufacture.makeLogConfigurationSection()),
+            actions=actions,
+            )
+
+        result = handler.emitFast(100, data={'other': u'value'})
+
+        self.assertIsNone(result)
+        self.assertLog(100, regex=u'some message')
+        clock.advance(0)
+        event = action.calls[0][0]
+        self.assertEqual(u'100', event.id)
+        self.assertEqual({'other': u'value'}, event.data)
+        action.calls[0][1].callback(None)
+
+    def test_emitFast_without_configuration(self):
+        """
+        When handler is not configured, the event is logged.
+        """
+        handler = EventsHandler()
+
+        result = handler.emitFast('100', message=u'100 message')
+
+        self.assertIsNone(result)
+        self.assertLog(100, regex=u'100 message')
+
     def test_emit_unknown_id(self):
         """
         Emitting an event with unknown ID will log an error containing
@@ -810,3 +1392,123 @@ class TestEventsHandler(LogTestCase):
 
         self.assertLog(1025)
         self.assertLog(100, regex='100 %\(unknown_data\)s some message')
+
+    def test_emit_with_actions(self):
+        """
+        The deferred returned by emit fires when the associated actions
+        are done, and failed actions are logged.
+        """
+        clock = Clock()
+        actions = EventActionsDispatcher(reactor=clock)
+        action = DummyEventAction(u'dummy action')
+        actions.addAction(action, groups=[u'disabled'])
+        handler = EventsHandler()
+        log_configuration_section = manufacture.makeLogConfigurationSection()
+        log_configuration_section.enabled_groups = [u'enabled']
+        handler.configure(
+            definitions=manufacture.makeEventsDefinition(
+                content=ACTIONS_DEFINITIONS),
+            log_configuration_section=log_configuration_section,
+            actions=actions,
+            )
+        results = []
+
+        handler.emit(u'101', message=u'101 message').addCallback(
+            results.append)
+        clock.advance(0)
+        self.assertEqual([], results)
+        action.calls[0][1].errback(RuntimeError(u'action error'))
+
+        self.assertEqual([None], results)
+        self.assertLog(
+            1039, regex=u'"dummy action" for event with id "101"')
+
+    def test_emit_rate_limited(self):
+        """
+        Events over the rate limit are not logged and a summary is logged
+        later.
+        """
+        clock = Clock()
+        rate_limiter = EventsRateLimiter(summary_interval=1, reactor=clock)
+        rate_limiter.addLimit(EventRateLimit(rate=1), event_ids=[u'100'])
+        handler = EventsHandler()
+        handler.configure(
+            definitions=manufacture.makeEventsDefinition(
+                content=ACTIONS_DEFINITIONS),
+            log_configuration_section=(
+                manufacture.makeLogConfigurationSection()),
+            rate_limiter=rate_limiter,
+            )
+        try:
+            for index in range(4):
+                handler.emit(u'100', message=u'100 message')
+            self.assertLog(100, regex=u'100 message')
+
+            clock.advance(1)
+
+            self.assertLog(
+                1040, regex=u'3 similar events with id "100" were')
+        finally:
+            handler.removeConfiguration()
+
+    def test_emit_sampled(self):
+        """
+        Only the sampled events are logged and sampling can be changed
+        at runtime.
+        """
+        handler = EventsHandler()
+        log_configuration_section = manufacture.makeLogConfigurationSection()
+        log_configuration_section.sampled_groups = {u'enabled': (2, u'count')}
+        handler.configure(
+            definitions=manufacture.makeEventsDefinition(
+                content=ACTIONS_DEFINITIONS),
+            log_configuration_section=log_configuration_section,
+            )
+        try:
+            for index in range(3):
+                handler.emit(u'100', message=u'100 message %d' % (index))
+
+            self.assertLog(100, regex=u'100 message 0')
+            self.assertLog(100, regex=u'100 message 2')
+            self.assertEqual(
+                {u'enabled': {'kept': 2, 'dropped': 1}},
+                handler.getSamplingStats())
+
+            log_configuration_section.sampled_groups = {}
+            handler.emit(u'100', message=u'100 message 3')
+
+            self.assertLog(100, regex=u'100 message 3')
+            self.assertEqual({}, handler.getSamplingStats())
+        finally:
+            handler.removeConfiguration()
+
+    def test_emit_metrics(self):
+        """
+        All emitted events are counted, including the events which are
+        not logged.
+        """
+        clock = Clock()
+        metrics = EventsMetrics(reactor=clock)
+        handler = EventsHandler()
+        log_configuration_section = manufacture.makeLogConfigurationSection()
+        log_configuration_section.enabled_groups = [u'enabled']
+        handler.configure(
+            definitions=manufacture.makeEventsDefinition(
+                content=ACTIONS_DEFINITIONS),
+            log_configuration_section=log_configuration_section,
+            metrics=metrics,
+            )
+        try:
+            handler.emit(u'100', message=u'100 message')
+            handler.emit(u'101', message=u'101 message')
+
+            self.assertLog(100, regex=u'100 message')
+            stats = handler.getEventsStats()
+            self.assertEqual(1, stats['events'][u'101']['count'])
+            self.assertEqual(1, stats['groups'][u'enabled']['count'])
+        finally:
+            handler.removeConfiguration()
+
+        self.assertEqual(
+            {'events': {}, 'groups': {}}, handler.getEventsStats())
+        self.assertEqual([], clock.getDelayedCalls())
@@ -136,3 +136,22 @@ class TestHelpers(UtilsTestCase):
             u'a comment.',
             message,
             )
+
+    def test_generate_ssh_key_key_pool(self):
+        """
+        When a key pool is provided, RSA keys are obtained from the pool.
+        """
+        options = self.Bunch(key_size=2048, key_type=u'RSA')
+        key = DummyKey()
+        pool_key = DummyKey()
+        key_pool = self.Mock()
+        key_pool.pop.return_value = pool_key
+        open_method = DummyOpenContext()
+
+        exit_code, message = generate_ssh_key(
+            options, key=key, open_method=open_method, key_pool=key_pool)
+
+        key_pool.pop.assert_called_once_with(2048)
+        self.assertFalse(key.generate.called)
+        self.assertEqual(2, pool_key.store.call_count)
+        self.assertEqual(0, exit_code)
@@ -0,0 +1,199 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+"""
+Tests for the instrumentation of logging and events.
+"""
+from __future__ import with_statement
+
+import pstats
+import threading
+
+from chevah.utils.event import EventsHandler
+from chevah.utils.instrumentation import (
+    DUMP_FORMAT_COLLAPSED,
+    Instrumentation,
+    instrumentation,
+    )
+from chevah.utils.testing import LogTestCase, manufacture, UtilsTestCase
+from chevah.utils.tests.normal.test_logger import InMemoryHandler
+
+
+class TestInstrumentation(UtilsTestCase):
+    """
+    Tests for Instrumentation.
+    """
+
+    def setUp(self):
+        super(TestInstrumentation, self).setUp()
+        self.instrumentation = Instrumentation()
+
+    def record(self, *names):
+        """
+        Record a call for each name, with each call made by the previous
+        one.
+        """
+        tokens = [self.instrumentation.start(name) for name in names]
+        for token in reversed(tokens):
+            self.instrumentation.stop(token)
+
+    def test_init(self):
+        """
+        By default the instrumentation is disabled and has no statistics.
+        """
+        self.assertFalse(self.instrumentation.enabled)
+        self.assertEqual({}, self.instrumentation.getStacks())
+
+    def test_stop(self):
+        """
+        The count and durations are recorded for the stack of calls.
+        """
+        self.record(u'parent', u'child')
+        self.record(u'parent')
+
+        stacks = self.instrumentation.getStacks()
+
+        self.assertEqual(
+            [(u'parent',), (u'parent', u'child')], sorted(stacks.keys()))
+        count, total, minimum, maximum = stacks[(u'parent',)]
+        self.assertEqual(2, count)
+        self.assertTrue(minimum <= maximum <= total)
+
+    def test_stop_not_stopped_child(self):
+        """
+        Calls which were not stopped are discarded when their parent
+        is stopped.
+        """
+        parent = self.instrumentation.start(u'parent')
+        self.instrumentation.start(u'child')
+
+        self.instrumentation.stop(parent)
+        self.record(u'other')
+
+        self.assertEqual(
+            [(u'other',), (u'parent',)],
+            sorted(self.instrumentation.getStacks().keys()))
+
+    def test_getStacks_threads(self):
+        """
+        Statistics from all threads are merged.
+        """
+        thread = threading.Thread(target=self.record, args=(u'call',))
+        thread.start()
+        thread.join()
+        self.record(u'call')
+
+        stacks = self.instrumentation.getStacks()
+
+        self.assertEqual(2, stacks[(u'call',)][0])
+
+    def test_getStats(self):
+        """
+        Statistics are aggregated by name.
+        """
+        self.record(u'first', u'common')
+        self.record(u'second', u'common')
+
+        stats = self.instrumentation.getStats()
+
+        common = [item for item in stats if item['name'] == u'common'][0]
+        self.assertEqual(2, common['count'])
+        self.assertEqual(common['total'] / 2, common['average'])
+
+    def test_reset(self):
+        """
+        All statistics are removed on reset.
+        """
+        self.record(u'call')
+
+        self.instrumentation.reset()
+
+        self.assertEqual({}, self.instrumentation.getStacks())
+
+    def test_dump_pstats(self):
+        """
+        The pstats dump can be loaded by pstats.
+        """
+        self.record(u'parent', u'child')
+        path, segments = manufacture.fs.makePathInTemp()
+        try:
+            self.instrumentation.dump(path)
+
+            stats = pstats.Stats(path).stats
+        finally:
+            manufacture.fs.deleteFile(segments, ignore_errors=True)
+
+        child = stats[('chevah.utils', 0, 'child')]
+        self.assertEqual(1, child[1])
+        self.assertEqual([('chevah.utils', 0, 'parent')], child[4].keys())
+
+    def test_dump_collapsed(self):
+        """
+        The collapsed dump contains the stacks and their own duration.
+        """
+        tokens = [self.instrumentation.start(u'parent')]
+        tokens.append(self.instrumentation.start(u'child'))
+        # Make sure durations are longer than a microsecond.
+        sum(range(10000))
+        for token in reversed(tokens):
+            self.instrumentation.stop(token)
+        path, segments = manufacture.fs.makePathInTemp()
+        try:
+            self.instrumentation.dump(path, format=DUMP_FORMAT_COLLAPSED)
+
+            lines = manufacture.fs.getFileLines(segments)
+        finally:
+            manufacture.fs.deleteFile(segments, ignore_errors=True)
+
+        self.assertStartsWith(u'parent;child ', lines[-1])
+
+    def test_dump_unknown_format(self):
+        """
+        An error is raised for unknown formats.
+        """
+        with self.assertRaises(ValueError):
+            self.instrumentation.dump('path', format=u'bad')
+
+
+class TestInstrumentedCalls(LogTestCase):
+    """
+    Tests for the instrumented logger and events handler.
+    """
+
+    def setUp(self):
+        super(TestInstrumentedCalls, self).setUp()
+        instrumentation.reset()
+        instrumentation.enable()
+
+    def tearDown(self):
+        instrumentation.disable()
+        instrumentation.reset()
+        super(TestInstrumentedCalls, self).tearDown()
+
+    def test_emitEvent(self):
+        """
+        Emitted events are recorded by event id.
+        """
+        handler = EventsHandler()
+
+        handler.emit(u'100', message=u'some message')
+
+        self.assertLog(100, regex=u'some message')
+        stacks = instrumentation.getStacks()
+        self.assertTrue(
+            (u'emitEvent 100', u'_logEvent 100') in stacks)
+
+    def test_log_handlers(self):
+        """
+        The log call is recorded together with each handler.
+        """
+        logger = manufacture.makeLogger()
+        handler = InMemoryHandler()
+        logger.addHandler(handler)
+        try:
+            logger._log_helper(100, u'some text')
+        finally:
+            logger.removeHandler(handler)
+
+        self.assertEqual(1, len(handler.history))
+        stacks = instrumentation.getStacks()
+        self.assertTrue((u'Logger.log', u'in-memory.emit') in stacks)
@@ -6,10 +6,12 @@ Tests for JSON file handling.
 from __future__ import with_statement
 from StringIO import StringIO
 
+from twisted.internet.task import Clock
+
 from chevah.utils.testing import EventTestCase, manufacture
 
 from chevah.utils.exceptions import UtilsError
-from chevah.utils.json_file import JSONFile
+from chevah.utils.json_file import JSONFile, LazyJSONObject
 
 
 class TestJSONFile(EventTestCase):
@@ -104,6 +106,16 @@ class TestJSONFile(EventTestCase):
         self.assertEqual(1, json_file.data['some-good'])
         self.assertEqual(string_value, json_file.data['utf8'])
 
+    def test_load_file_unicode(self):
+        """
+        Non-ASCII data is loaded from a file returning unicode.
+        """
+        json_file = JSONFile(file=StringIO(u'{"a": "mu\u021b\u0103"}'))
+
+        json_file.load()
+
+        self.assertEqual({u'a': u'mu\u021b\u0103'}, json_file.data)
+
     def test_load_file_empty(self):
         """
         The parsed data will be available for read/write if it is valid.
@@ -114,6 +126,257 @@ class TestJSONFile(EventTestCase):
 
         self.assertEqual(0, len(json_file.data))
 
+    def test_load_path_empty(self):
+        """
+        An empty file from path is loaded as empty data.
+        """
+        test_segments = manufacture.fs.createFileInTemp(content=u'')
+        try:
+            path = manufacture.fs.getRealPathFromSegments(test_segments)
+            json_file = JSONFile(path=path)
+
+            json_file.load()
+
+            self.assertEqual({}, json_file.data)
+        finally:
+            manufacture.fs.deleteFile(test_segments, ignore_errors=True)
+
+    def test_load_path_good_format(self):
+        """
+        Data is loaded from a memory mapped file.
+        """
+        test_segments = manufacture.fs.createFileInTemp(
+            content=u'{"some-good": 1, "utf8": "mu\u021b\u0103"}')
+        try:
+            path = manufacture.fs.getRealPathFromSegments(test_segments)
+            json_file = JSONFile(path=path)
+
+            json_file.load()
+
+            self.assertEqual(
+                {u'some-good': 1, u'utf8': u'mu\u021b\u0103'},
+                json_file.data)
+        finally:
+            manufacture.fs.deleteFile(test_segments, ignore_errors=True)
+
+    def test_load_lazy(self):
+        """
+        When loaded in lazy mode, values are only deserialized when first
+        accessed.
+        """
+        content = '{ "events": {"100": [1, "}"]}, "other": "value"}'
+        json_file = JSONFile(file=StringIO(content))
+
+        json_file.load(lazy=True)
+
+        self.assertIsInstance(LazyJSONObject, json_file.data)
+        self.assertEqual(2, len(json_file.data))
+        self.assertContains(u'events', json_file.data)
+        self.assertEqual({}, json_file.data._values)
+        self.assertEqual({u'100': [1, u'}']}, json_file.data['events'])
+        self.assertEqual([u'events'], json_file.data._values.keys())
+        self.assertEqual(
+            {u'events': {u'100': [1, u'}']}, u'other': u'value'},
+            json_file.data.materialize())
+
+    def test_load_lazy_bad_format(self):
+        """
+        In lazy mode, an UtilsError is raised when a value is first
+        accessed if it has a bad format.
+        """
+        content = '{ "good": 1, "bad": {some-bad: "JSON"}}'
+        json_file = JSONFile(file=StringIO(content))
+        json_file.load(lazy=True)
+
+        self.assertEqual(1, json_file.data['good'])
+        with self.assertRaises(UtilsError) as context:
+            json_file.data['bad']
+
+        self.assertExceptionID(u'1028', context.exception)
+
+    def test_load_comments(self):
+        """
+        Lines starting with "# " are ignored, including indented ones.
+        """
+        content = (
+            '# Some comment with "{".\n'
+            '{\n'
+            '    # "ignored": 1,\n'
+            '    "some": {\n'
+            '\t# Tab indented.\n'
+            '        "other": "# not a comment"\n'
+            '        }\n'
+            '}\n'
+            )
+        json_file = JSONFile(file=StringIO(content))
+
+        json_file.load()
+
+        self.assertEqual(
+            {u'some': {u'other': u'# not a comment'}}, json_file.data)
+
+    def test_load_comments_bad_format_line(self):
+        """
+        Errors for files with comments report the line from the original
+        file.
+        """
+        content = (
+            '{\n'
+            '    # Some comment.\n'
+            '    "some": {\n'
+            '        # Other comment.\n'
+            '        "other": 1,\n'
+            '        }\n'
+            '}\n'
+            )
+        json_file = JSONFile(file=StringIO(content))
+
+        with self.assertRaises(UtilsError) as context:
+            json_file.load()
+
+        self.assertExceptionID(u'1028', context.exception)
+        self.assertExceptionData(
+            {
+                u'path': None,
+                u'details': self.Contains(u'line 6 column 9'),
+            },
+            context.exception,
+            )
+
+    def test_load_lazy_comments_bad_format_line(self):
+        """
+        In lazy mode, errors report the line from the original file and
+        not the one from the value.
+        """
+        content = (
+            '{\n'
+            '    # Some comment.\n'
+            '    "some": {\n'
+            '        # Other comment.\n'
+            '        "other": 1,\n'
+            '        }\n'
+            '}\n'
+            )
+        json_file = JSONFile(file=StringIO(content))
+        json_file.load(lazy=True)
+
+        with self.assertRaises(UtilsError) as context:
+            json_file.data['some']
+
+        self.assertExceptionID(u'1028', context.exception)
+        self.assertExceptionData(
+            {
+                u'path': None,
+                u'details': self.Contains(u'line 6 column 9'),
+            },
+            context.exception,
+            )
+
+    def test_serialize(self):
+        """
+        Data is serialized with sorted keys.
+        """
+        json_file = manufacture.makeJSONFile(content='{"b": 1, "a": [2]}')
+
+        result = json_file.serialize()
+
+        self.assertEqual(
+            '{\n    "a": [\n        2\n    ],\n    "b": 1\n}', result)
+
+    def test_save_file(self):
+        """
+        Data is written into the file object, replacing previous content.
+        """
+        json_file = manufacture.makeJSONFile(content='{"a": 1, "b": 2}')
+        json_file.data['a'] = 3
+
+        json_file.save()
+
+        self.assertEqual({u'a': 3, u'b': 2}, self.loadJSON(
+            json_file.file.getvalue()))
+
+    def test_save_not_changed(self):
+        """
+        The file is not written when data was not changed since last save.
+        """
+        json_file = manufacture.makeJSONFile(content='{"a": 1}')
+        json_file.save()
+        json_file.file.write('garbage')
+
+        json_file.save()
+
+        self.assertEndsWith('garbage', json_file.file.getvalue())
+
+    def test_save_not_changed_after_load(self):
+        """
+        The file is not written when data was not changed since load and
+        the loaded content is the serialized data.
+        """
+        json_file = manufacture.makeJSONFile(content='{\n    "a": 1\n}')
+        json_file.file.write('garbage')
+
+        json_file.save()
+
+        self.assertEndsWith('garbage', json_file.file.getvalue())
+
+    def test_save_after_lazy_load(self):
+        """
+        In lazy mode, the content is not checked at load, and the file is
+        written at first save.
+        """
+        json_file = JSONFile(file=StringIO('{\n    "a": 1\n}'))
+        json_file.load(lazy=True)
+        json_file.file.write('garbage')
+
+        json_file.save()
+
+        self.assertEqual('{\n    "a": 1\n}', json_file.file.getvalue())
+
+    def test_save_path(self):
+        """
+        System test for saving data to a file from path.
+        """
+        test_segments = manufacture.fs.createFileInTemp(
+            content=u'# Comment.\n{"a": 1}')
+        try:
+            path = manufacture.fs.getRealPathFromSegments(test_segments)
+            json_file = JSONFile(path=path)
+            json_file.load(lazy=True)
+            json_file.data['b'] = u'mu\u021b\u0103'
+
+            json_file.save(fsync=True)
+
+            json_file = JSONFile(path=path)
+            json_file.load()
+            self.assertEqual(
+                {u'a': 1, u'b': u'mu\u021b\u0103'}, json_file.data)
+        finally:
+            manufacture.fs.deleteFile(test_segments, ignore_errors=True)
+
+    def test_saveLater(self):
+        """
+        Multiple calls to saveLater are coalesced into a single save.
+        """
+        clock = Clock()
+        json_file = JSONFile(file=StringIO('{}'), reactor=clock)
+        json_file.load()
+        results = []
+
+        json_file.data['a'] = 1
+        json_file.saveLater(delay=0.1).addCallback(results.append)
+        json_file.data['b'] = 2
+        json_file.saveLater(delay=0.1).addCallback(results.append)
+
+        self.assertEqual(1, len(clock.getDelayedCalls()))
+        self.assertEqual('{}', json_file.file.getvalue())
+
+        clock.advance(0.1)
+
+        self.assertEqual([None, None], results)
+        self.assertEqual(
+            {u'a': 1, u'b': 2},
+            self.loadJSON(json_file.file.getvalue()))
+
     def test_getValueOrNone_none(self):
         """
         getValueOrNone will return `None` for disabled values.
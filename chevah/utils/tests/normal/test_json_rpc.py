@@ -9,7 +9,10 @@ from twisted.web import server
 import json
 
 from chevah.utils import json_rpc
+from chevah.utils.event import EventsMetrics
+from chevah.utils.instrumentation import instrumentation
 from chevah.utils.json_rpc import JSONRPCResource, JSONRPCError
+from chevah.utils.logger import LogEntry, RingBufferHandler
 from chevah.utils.testing import manufacture, UtilsTestCase
 
 
@@ -450,6 +453,153 @@ class TestJSONRPC(UtilsTestCase):
         self.assertEqual(1, response['id'])
 
 
+class TestJSONRPCLogEntries(UtilsTestCase):
+    """
+    Tests for getting recent log entries.
+    """
+
+    def test_get_log_entries_no_buffer(self):
+        """
+        An error is raised when no log buffer is used.
+        """
+        resource = ImplementedJSONRPCResource()
+
+        with self.assertRaises(JSONRPCError) as context:
+            resource.jsonrpc_get_log_entries(None)
+
+        self.assertEqual(-32601, context.exception.value['code'])
+
+    def test_get_log_entries(self):
+        """
+        The filtered entries from the log buffer are returned.
+        """
+        resource = ImplementedJSONRPCResource()
+        resource.log_buffer = RingBufferHandler(capacity=10)
+        for message_id in [100, 200, 300]:
+            resource.log_buffer.handle(LogEntry(message_id, u'text'))
+
+        result = resource.jsonrpc_get_log_entries(None, min_id=200, limit=1)
+
+        self.assertEqual(1, len(result))
+        self.assertEqual(300, result[0][1])
+
+
+class TestJSONRPCInstrumentation(UtilsTestCase):
+    """
+    Tests for the instrumentation methods.
+    """
+
+    def tearDown(self):
+        instrumentation.disable()
+        instrumentation.reset()
+        super(TestJSONRPCInstrumentation, self).tearDown()
+
+    def test_set_instrumentation_not_enabled(self):
+        """
+        An error is raised when instrumentation is not enabled for the
+        resource.
+        """
+        resource = ImplementedJSONRPCResource()
+
+        with self.assertRaises(JSONRPCError) as context:
+            resource.jsonrpc_set_instrumentation(None, True)
+
+        self.assertEqual(-32601, context.exception.value['code'])
+        self.assertFalse(instrumentation.enabled)
+
+    def test_set_instrumentation(self):
+        """
+        Instrumentation can be enabled and disabled.
+        """
+        resource = ImplementedJSONRPCResource()
+        resource.instrumentation_enabled = True
+
+        self.assertTrue(resource.jsonrpc_set_instrumentation(None, True))
+        self.assertTrue(instrumentation.enabled)
+        self.assertFalse(resource.jsonrpc_set_instrumentation(None, False))
+        self.assertFalse(instrumentation.enabled)
+
+    def test_get_instrumentation_not_enabled(self):
+        """
+        An error is raised when instrumentation is not enabled for the
+        resource.
+        """
+        resource = ImplementedJSONRPCResource()
+
+        with self.assertRaises(JSONRPCError) as context:
+            resource.jsonrpc_get_instrumentation(None)
+
+        self.assertEqual(-32601, context.exception.value['code'])
+
+    def test_get_instrumentation(self):
+        """
+        The statistics for each instrumented call are returned.
+        """
+        resource = ImplementedJSONRPCResource()
+        resource.instrumentation_enabled = True
+        instrumentation.stop(instrumentation.start(u'some call'))
+
+        result = resource.jsonrpc_get_instrumentation(None)
+
+        self.assertEqual([u'some call'], [item['name'] for item in result])
+
+    def test_dump_instrumentation_no_path(self):
+        """
+        An error is raised when no dump path is configured.
+        """
+        resource = ImplementedJSONRPCResource()
+
+        with self.assertRaises(JSONRPCError) as context:
+            resource.jsonrpc_dump_instrumentation(None)
+
+        self.assertEqual(-32601, context.exception.value['code'])
+
+    def test_dump_instrumentation(self):
+        """
+        Statistics are dumped to the configured path.
+        """
+        resource = ImplementedJSONRPCResource()
+        path, segments = manufacture.fs.makePathInTemp()
+        resource.instrumentation_path = path
+        try:
+            result = resource.jsonrpc_dump_instrumentation(
+                None, format=u'collapsed')
+
+            self.assertEqual(path, result)
+            self.assertTrue(manufacture.fs.exists(segments))
+        finally:
+            manufacture.fs.deleteFile(segments, ignore_errors=True)
+
+
+class TestJSONRPCEventsMetrics(UtilsTestCase):
+    """
+    Tests for getting the events metrics.
+    """
+
+    def test_get_events_metrics_not_enabled(self):
+        """
+        An error is raised when no events metrics are used.
+        """
+        resource = ImplementedJSONRPCResource()
+
+        with self.assertRaises(JSONRPCError) as context:
+            resource.jsonrpc_get_events_metrics(None)
+
+        self.assertEqual(-32601, context.exception.value['code'])
+
+    def test_get_events_metrics(self):
+        """
+        The statistics from the events metrics are returned.
+        """
+        resource = ImplementedJSONRPCResource()
+        resource.events_metrics = EventsMetrics()
+        resource.events_metrics.record(u'100')
+
+        result = resource.jsonrpc_get_events_metrics(None)
+
+        self.assertEqual(1, result['events'][u'100']['count'])
+
+
 class TestHelpers(UtilsTestCase):
     """
     Test JSON RPC helper methods.
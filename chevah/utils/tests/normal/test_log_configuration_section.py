@@ -136,6 +136,53 @@ class TestLogConfigurationSection(UtilsTestCase):
         signal = callback.call_args[0][0]
         self.assertEqual(True, signal.current_value)
 
+    def test_file_format(self):
+        """
+        Log format is text by default and can be updated at runtime.
+        """
+        callback = self.Mock()
+        section = self._getSection('[log]\n')
+        section.subscribe('file_format', callback)
+        self.assertEqual(u'text', section.file_format)
+        self.assertEqual(u'text', section.syslog_format)
+
+        section.file_format = u'JSON'
+
+        self.assertEqual(u'json', section.file_format)
+        self.assertEqual(1, callback.call_count)
+
+    def test_syslog_format_bad_value(self):
+        """
+        An error is raised for unknown formats.
+        """
+        section = self._getSection(
+            '[log]\n'
+            'log_syslog_format: xml\n'
+            )
+
+        with self.assertRaises(UtilsError) as context:
+            section.syslog_format
+
+        self.assertEqual(u'1041', context.exception.event_id)
+
+        with self.assertRaises(UtilsError):
+            section.file_format = u'xml'
+
+    def test_file_rotate_compress(self):
+        """
+        Compression of rotated files is disabled by default and can be
+        updated at runtime.
+        """
+        callback = self.Mock()
+        section = self._getSection('[log]\n')
+        section.subscribe('file_rotate_compress', callback)
+        self.assertFalse(section.file_rotate_compress)
+
+        section.file_rotate_compress = True
+
+        self.assertTrue(section.file_rotate_compress)
+        self.assertEqual(1, callback.call_count)
+
     def test_file_rotate_count_disabled(self):
         """
         Check reading log_file_rotate_external.
@@ -642,6 +689,72 @@ class TestLogConfigurationSection(UtilsTestCase):
         section.enabled_groups = [u'new', u'LiSt']
         self.assertEqual([u'new', u'list'], section.enabled_groups)
 
+    def test_sampled_groups_default(self):
+        """
+        By default, no group is sampled.
+        """
+        section = self._getSection('[log]\n')
+
+        self.assertEqual({}, section.sampled_groups)
+
+    def test_sampled_groups(self):
+        """
+        The rate and key are returned for each group, using the count
+        as the default key.
+
+        Values are case insensitive.
+        """
+        content = (
+            '[log]\n'
+            'log_sampled_groups: Informational:10, operational:100:Peer,\n'
+            )
+
+        section = self._getSection(content)
+
+        self.assertEqual({
+            u'informational': (10, u'count'),
+            u'operational': (100, u'peer'),
+            },
+            section.sampled_groups)
+
+    def test_sampled_groups_bad_value(self):
+        """
+        An error is raised for values with a bad format, rate or key.
+        """
+        for value in [u'informational', u'informational:x', u'debug:0',
+                u'debug:10:path', u'debug:10:peer:other']:
+            section = self._getSection(
+                '[log]\nlog_sampled_groups: %s\n' % (value))
+
+            with self.assertRaises(UtilsError) as context:
+                section.sampled_groups
+
+            self.assertEqual(u'1042', context.exception.event_id)
+
+    def test_sampled_groups_update(self):
+        """
+        Sampling can be updated at runtime using a dictionary and bad
+        values are not stored.
+        """
+        callback = self.Mock()
+        section = self._getSection('[log]\n')
+        section.subscribe('sampled_groups', callback)
+
+        section.sampled_groups = {u'Debug': (5, u'avatar')}
+
+        self.assertEqual({u'debug': (5, u'avatar')}, section.sampled_groups)
+        self.assertEqual(1, callback.call_count)
+
+        with self.assertRaises(UtilsError):
+            section.sampled_groups = {u'debug': (0, u'count')}
+
+        self.assertEqual({u'debug': (5, u'avatar')}, section.sampled_groups)
+        self.assertEqual(1, callback.call_count)
+
+        section.sampled_groups = {}
+
+        self.assertEqual({}, section.sampled_groups)
+
     def test_windows_eventlog_disabled(self):
         """
         None is returned when windows_eventlog is disabled.
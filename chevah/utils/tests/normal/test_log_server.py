@@ -0,0 +1,179 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+"""
+Tests for sending log entries to a log server.
+"""
+from __future__ import with_statement
+
+import socket
+import struct
+
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+
+from chevah.utils.log_server import (
+    deserialize_log_entry,
+    LogClientHandler,
+    LogServerFactory,
+    serialize_log_entry,
+    )
+from chevah.utils.logger import LogEntry
+from chevah.utils.testing import manufacture, UtilsTestCase
+
+
+class TestSerialization(UtilsTestCase):
+    """
+    Tests for log entries serialization.
+    """
+
+    def test_roundtrip(self):
+        """
+        The entry is recreated with avatar name, peer address and data.
+        """
+        avatar = manufacture.makeFilesystemApplicationAvatar()
+        peer = IPv4Address('TCP', '10.0.0.1', 1234)
+        entry = LogEntry(
+            100, u'some text', avatar=avatar, peer=peer,
+            data={'key': u'value'}, timestamp=1.5)
+
+        result = deserialize_log_entry(serialize_log_entry(entry))
+
+        self.assertEqual(100, result.message_id)
+        self.assertEqual(u'some text', result.text)
+        self.assertEqual(1.5, result.timestamp)
+        self.assertEqual(avatar.name, result.avatar_hr)
+        self.assertEqual(u'10.0.0.1:1234', result.peer_hr)
+        self.assertEqual({u'key': u'value'}, result.data)
+
+    def test_no_avatar_or_peer(self):
+        """
+        Entries without avatar and peer are supported.
+        """
+        entry = LogEntry(100, u'some text')
+
+        result = deserialize_log_entry(serialize_log_entry(entry))
+
+        self.assertIsNone(result.avatar)
+        self.assertIsNone(result.peer)
+
+
+class TestLogClientHandler(UtilsTestCase):
+    """
+    Tests for LogClientHandler.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Unix sockets are not available on Windows.
+        """
+        if cls.os_name == 'nt':
+            raise cls.skipTest()
+
+    def setUp(self):
+        super(TestLogClientHandler, self).setUp()
+        self.path, self.segments = manufacture.fs.makePathInTemp()
+
+    def tearDown(self):
+        manufacture.fs.deleteFile(self.segments, ignore_errors=True)
+        super(TestLogClientHandler, self).tearDown()
+
+    def readEntries(self, connection):
+        """
+        Return the entries received on `connection`.
+        """
+        content = connection.recv(100000)
+        result = []
+        while content:
+            size = struct.unpack('!I', content[:4])[0]
+            result.append(deserialize_log_entry(content[4:4 + size]))
+            content = content[4 + size:]
+        return result
+
+    def test_buffer_no_server(self):
+        """
+        When the server is not available, the newest entries are kept.
+        """
+        handler = LogClientHandler(
+            self.path, buffer_size=2, retry_interval=0)
+
+        for index in range(3):
+            handler.handle(LogEntry(index, u'text'))
+
+        self.assertEqual(2, handler.buffered)
+        self.assertEqual(1, handler.dropped)
+        handler.close()
+
+    def test_send_buffered(self):
+        """
+        Buffered entries are sent after the server becomes available.
+        """
+        handler = LogClientHandler(self.path, retry_interval=0)
+        handler.handle(LogEntry(100, u'first'))
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(self.path)
+            server.listen(1)
+
+            handler.handle(LogEntry(101, u'second'))
+            connection, peer = server.accept()
+
+            entries = self.readEntries(connection)
+            connection.close()
+        finally:
+            handler.close()
+            server.close()
+
+        self.assertEqual(0, handler.buffered)
+        self.assertEqual(
+            [u'first', u'second'], [entry.text for entry in entries])
+
+
+class TestLogServerFactory(UtilsTestCase):
+    """
+    Tests for LogServerFactory.
+    """
+
+    def setUp(self):
+        super(TestLogServerFactory, self).setUp()
+        self.clock = Clock()
+        self.logger = self.Mock()
+        self.factory = LogServerFactory(
+            logger=self.logger, batch_size=3, batch_interval=1,
+            reactor=self.clock)
+
+    def test_stringReceived(self):
+        """
+        Received entries are handled after the batch interval.
+        """
+        self.factory.start()
+        protocol = self.factory.buildProtocol(None)
+
+        protocol.stringReceived(serialize_log_entry(LogEntry(100, u'text')))
+
+        self.assertFalse(self.logger.handle.called)
+        self.clock.advance(1)
+        entry = self.logger.handle.call_args[0][0]
+        self.assertEqual(100, entry.message_id)
+        self.factory.stop()
+
+    def test_stringReceived_bad_entry(self):
+        """
+        Invalid entries are counted and ignored.
+        """
+        protocol = self.factory.buildProtocol(None)
+
+        protocol.stringReceived('bad entry')
+
+        self.assertEqual(1, self.factory.bad_entries)
+        self.factory.flush()
+        self.assertFalse(self.logger.handle.called)
+
+    def test_addEntry_batch_size(self):
+        """
+        Entries are handled right away when the batch is full.
+        """
+        for index in range(3):
+            self.factory.addEntry(LogEntry(index, u'text'))
+
+        self.assertEqual(3, self.logger.handle.call_count)
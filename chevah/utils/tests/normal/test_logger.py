@@ -11,15 +11,29 @@ from logging import (
 from logging.handlers import (
     RotatingFileHandler,
     SysLogHandler,
-    TimedRotatingFileHandler,
     )
 from StringIO import StringIO
-from time import time
+from time import localtime, mktime, strftime, time
+import gzip
+import json
+import os
 import random
+import threading
+
+from twisted.internet.task import Clock
 
 from chevah.utils.constants import LOG_SECTION_DEFAULTS
 from chevah.utils.logger import (
+    ArchiveCompressor,
+    CompressedRotatingFileHandler,
+    CompressedScheduledTimedRotatingFileHandler,
+    format_log_entry,
+    format_log_entry_json,
     LogEntry,
+    QueuedHandler,
+    RingBufferHandler,
+    ScheduledTimedRotatingFileHandler,
+    SizeAndTimeRotatingFileHandler,
     StdOutHandler,
     WatchedFileHandler,
     WindowsEventLogHandler,
@@ -122,6 +136,602 @@ class TestLogEntry(UtilsTestCase):
         self.assertEqual(expected_peer_string, entry.peer_hr)
 
 
+class TestFormatLogEntry(UtilsTestCase):
+    """
+    Tests for log entries formatters.
+    """
+
+    def test_format_log_entry(self):
+        """
+        The text format contains the id, time, service, avatar, peer and
+        text separated by spaces.
+        """
+        entry = LogEntry(100, u'some text')
+
+        result = format_log_entry(entry)
+
+        self.assertEqual(
+            u'100 %s None None None some text' % (entry.timestamp_hr),
+            result)
+
+    def test_format_log_entry_json(self):
+        """
+        The JSON format is a single line containing the data.
+        """
+        peer = manufacture.makeIPv4Address()
+        entry = LogEntry(
+            100, u'some "text"\nnew line', peer=peer,
+            data={'key': u'value', 'object': peer},
+            timestamp=1.25,
+            )
+
+        result = format_log_entry_json(entry)
+
+        self.assertFalse(u'\n' in result)
+        self.assertEqual(
+            {
+                u'message_id': 100,
+                u'timestamp': u'1970-01-01T00:00:01.250Z',
+                u'service': u'None',
+                u'avatar': u'None',
+                u'peer': entry.peer_hr,
+                u'text': u'some "text"\nnew line',
+                u'data': {u'key': u'value', u'object': unicode(peer)},
+            },
+            json.loads(result),
+            )
+
+    def test_format_log_entry_json_bytes(self):
+        """
+        Byte strings are decoded as UTF-8 and invalid bytes are replaced.
+        """
+        entry = LogEntry(
+            100, 'caf\xc3\xa9', data={'key': 'x\xff', u'other': u'\u021b'})
+
+        result = format_log_entry_json(entry)
+
+        data = json.loads(result)
+        self.assertEqual(u'caf\xe9', data['text'])
+        self.assertEqual(
+            {u'key': u'x\ufffd', u'other': u'\u021b'}, data['data'])
+
+
+class FailingHandler(InMemoryHandler):
+    """
+    Handler which fails to emit the records.
+    """
+
+    def emit(self, record):
+        try:
+            raise IOError('Device not available.')
+        except:
+            self.handleError(record)
+
+    def handle(self, record):
+        self.emit(record)
+
+
+class TestQueuedHandler(UtilsTestCase):
+    """
+    Tests for QueuedHandler.
+    """
+
+    def test_emit(self):
+        """
+        Entries are sent to the handler from a separate thread.
+        """
+        target = InMemoryHandler()
+        handler = QueuedHandler(target)
+        entry = LogEntry(100, u'text')
+
+        handler.handle(entry)
+        handler.join()
+        handler.close()
+
+        self.assertEqual([entry], target.history)
+        stats = handler.getStats()
+        self.assertEqual(target.name, stats['name'])
+        self.assertEqual(1, stats['handled'])
+        self.assertEqual(0, stats['dropped'])
+        self.assertEqual(0, stats['errors'])
+        self.assertFalse(stats['disabled'])
+
+    def test_emit_queue_full(self):
+        """
+        Entries are dropped when the queue is full.
+        """
+        target = InMemoryHandler()
+        handler = QueuedHandler(target, queue_size=1)
+        blocked = threading.Event()
+        released = threading.Event()
+
+        def block(record):
+            blocked.set()
+            released.wait()
+
+        target.handle = block
+        handler.handle(LogEntry(100, u'text'))
+        blocked.wait()
+
+        for index in range(3):
+            handler.handle(LogEntry(index, u'text'))
+        released.set()
+        handler.join()
+        handler.close()
+
+        self.assertEqual(2, handler.dropped)
+        self.assertEqual(2, handler.handled)
+
+    def test_circuit_breaking(self):
+        """
+        After consecutive failures the handler is disabled and the
+        entries are dropped.
+        """
+        handler = QueuedHandler(
+            FailingHandler(), failure_threshold=2, recovery_time=60)
+
+        for index in range(4):
+            handler.handle(LogEntry(index, u'text'))
+        handler.join()
+        handler.close()
+
+        stats = handler.getStats()
+        self.assertEqual(2, stats['errors'])
+        self.assertEqual(2, stats['dropped'])
+        self.assertEqual(u'Device not available.', stats['last_error'])
+        self.assertTrue(stats['disabled'])
+
+    def test_error_non_ascii(self):
+        """
+        Errors with non-ASCII bytes in their message are recorded and
+        the entries are still handled after that.
+        """
+        target = FailingHandler()
+        handler = QueuedHandler(target, failure_threshold=10)
+
+        def emit(record):
+            try:
+                raise IOError('Device \xff not available.')
+            except:
+                target.handleError(record)
+
+        target.emit = emit
+        handler.handle(LogEntry(100, u'text'))
+        handler.join()
+        target.emit = target.history.append
+        handler.handle(LogEntry(101, u'text'))
+        handler.join()
+        handler.close()
+
+        self.assertEqual(1, handler.errors)
+        self.assertEqual(1, handler.handled)
+        self.assertEqual(u'Device \ufffd not available.', handler.last_error)
+        self.assertEqual(101, target.history[0].message_id)
+
+    def test_circuit_recovery(self):
+        """
+        After the recovery time the handler is tried again.
+        """
+        target = FailingHandler()
+        handler = QueuedHandler(target, failure_threshold=1, recovery_time=0)
+
+        handler.handle(LogEntry(100, u'text'))
+        handler.join()
+        self.assertEqual(1, handler.errors)
+
+        handler.handle(LogEntry(101, u'text'))
+        handler.join()
+        handler.close()
+
+        self.assertEqual(2, handler.errors)
+        self.assertEqual(0, handler.dropped)
+
+
+class TestRingBufferHandler(UtilsTestCase):
+    """
+    Tests for RingBufferHandler.
+    """
+
+    def addEntry(self, handler, message_id, text=None, avatar=None,
+            peer=None, timestamp=None):
+        """
+        Emit a new entry.
+        """
+        if text is None:
+            text = manufacture.getUniqueString()
+        entry = LogEntry(
+            message_id, text, avatar=avatar, peer=peer, timestamp=timestamp)
+        handler.handle(entry)
+        return entry
+
+    def test_init(self):
+        """
+        The buffer is initially empty.
+        """
+        handler = RingBufferHandler(capacity=3)
+
+        self.assertEqual(0, len(handler))
+        self.assertEqual([], handler.query())
+        self.assertEqual(u'Memory buffer for 3 entries', handler.name)
+
+    def test_emit(self):
+        """
+        Entries are stored as tuples with human readable avatar and peer.
+        """
+        handler = RingBufferHandler(capacity=3)
+        avatar = manufacture.makeFilesystemApplicationAvatar()
+        peer = manufacture.makeIPv4Address()
+
+        entry = self.addEntry(
+            handler, 100, text=u'some text', avatar=avatar, peer=peer)
+
+        self.assertEqual(
+            [(entry.timestamp, 100, avatar.name, entry.peer_hr,
+                u'some text')],
+            handler.query(),
+            )
+
+    def test_emit_full(self):
+        """
+        When full, the oldest entries are overwritten.
+        """
+        handler = RingBufferHandler(capacity=3)
+
+        for message_id in range(5):
+            self.addEntry(handler, message_id)
+
+        self.assertEqual(3, len(handler))
+        self.assertEqual(
+            [2, 3, 4], [entry[1] for entry in handler.query()])
+
+    def test_query_filters(self):
+        """
+        Entries can be filtered by id range, peer, avatar and time.
+        """
+        handler = RingBufferHandler(capacity=10)
+        avatar = manufacture.makeFilesystemApplicationAvatar()
+        peer = manufacture.makeIPv4Address()
+        self.addEntry(handler, 100, timestamp=1)
+        self.addEntry(handler, 200, timestamp=2, peer=peer)
+        self.addEntry(handler, 300, timestamp=3, avatar=avatar)
+        self.addEntry(handler, 400, timestamp=4)
+
+        def ids(**kwargs):
+            return [entry[1] for entry in handler.query(**kwargs)]
+
+        self.assertEqual([200, 300], ids(min_id=150, max_id=350))
+        self.assertEqual([200], ids(peer=peer.host))
+        self.assertEqual([200], ids(peer=u'%s:%s' % (peer.host, peer.port)))
+        self.assertEqual([300], ids(avatar=avatar.name))
+        self.assertEqual([200, 300], ids(start=2, end=3))
+        self.assertEqual([300, 400], ids(limit=2))
+
+    def test_clear(self):
+        """
+        All entries are removed.
+        """
+        handler = RingBufferHandler(capacity=3)
+        self.addEntry(handler, 100)
+
+        handler.clear()
+
+        self.assertEqual(0, len(handler))
+        self.assertEqual([], handler.query())
+
+
+class TestCompressedRotatingFileHandler(UtilsTestCase):
+    """
+    Tests for rotating handlers keeping compressed archives.
+    """
+
+    def setUp(self):
+        super(TestCompressedRotatingFileHandler, self).setUp()
+        self.path, self.segments = manufacture.fs.makePathInTemp()
+        self.compressor = ArchiveCompressor()
+        self.handler = None
+
+    def tearDown(self):
+        if self.handler:
+            self.compressor.wait()
+            self.handler.close()
+            for path in self.handler.getArchives():
+                os.remove(path)
+        manufacture.fs.deleteFile(self.segments, ignore_errors=True)
+        super(TestCompressedRotatingFileHandler, self).tearDown()
+
+    def emit(self, text):
+        """
+        Emit a log entry with `text`.
+        """
+        self.handler.handle(LogEntry(100, text))
+
+    def test_doRollover_compress(self):
+        """
+        On rollover the file is renamed and later compressed.
+        """
+        self.handler = CompressedRotatingFileHandler(
+            self.path, maxBytes=1000, backupCount=2,
+            compressor=self.compressor)
+        self.emit(u'first line')
+
+        self.handler.doRollover()
+        self.emit(u'second line')
+        self.compressor.wait()
+
+        archives = self.handler.getArchives()
+        self.assertEqual(1, len(archives))
+        self.assertEqual(u'first line\n', gzip.open(archives[0]).read())
+        self.assertFalse(os.path.exists(archives[0][:-3]))
+        self.assertEqual(u'second line\n', open(self.path).read())
+
+    def test_backupCount(self):
+        """
+        Only the newest `backupCount` compressed archives are kept.
+        """
+        self.handler = CompressedRotatingFileHandler(
+            self.path, maxBytes=20, backupCount=2,
+            compressor=self.compressor)
+
+        for index in range(5):
+            self.emit(u'line number %d' % (index))
+        self.compressor.wait()
+
+        archives = self.handler.getArchives()
+        self.assertEqual(2, len(archives))
+        self.assertEqual(u'line number 3\n', gzip.open(archives[1]).read())
+
+
+class TestScheduledTimedRotatingFileHandler(UtilsTestCase):
+    """
+    Tests for ScheduledTimedRotatingFileHandler.
+    """
+
+    def setUp(self):
+        super(TestScheduledTimedRotatingFileHandler, self).setUp()
+        self.path, self.segments = manufacture.fs.makePathInTemp()
+        self.clock = Clock()
+        self.handler = None
+
+    def tearDown(self):
+        if self.handler:
+            self.handler.close()
+            folder, name = os.path.split(self.path)
+            for member in os.listdir(folder):
+                if member.startswith(name + '.'):
+                    os.remove(os.path.join(folder, member))
+        manufacture.fs.deleteFile(self.segments, ignore_errors=True)
+        super(TestScheduledTimedRotatingFileHandler, self).tearDown()
+
+    def makeHandler(self, when='s', interval=10, **kwargs):
+        """
+        Create a handler using the test clock.
+        """
+        self.handler = ScheduledTimedRotatingFileHandler(
+            self.path, when=when, interval=interval, backupCount=2,
+            reactor=self.clock, **kwargs)
+        return self.handler
+
+    def emit(self, text):
+        """
+        Emit a log entry with `text`.
+        """
+        self.handler.handle(LogEntry(100, text))
+
+    def local(self, year, month, day, hour=0, minute=0):
+        """
+        Return the timestamp for the local date.
+        """
+        return mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+
+    def test_timer(self):
+        """
+        The timer only marks the rotation as pending and the file is
+        rotated by the next entry.
+        """
+        self.makeHandler()
+        self.emit(u'first line')
+
+        self.clock.advance(10)
+
+        self.assertTrue(self.handler.rollover_pending)
+        self.assertEqual(20, self.handler.rolloverAt)
+        self.assertEqual(u'first line\n', open(self.path).read())
+
+        self.emit(u'second line')
+
+        self.assertFalse(self.handler.rollover_pending)
+        archive = '%s.%s' % (
+            self.path, strftime(self.handler.suffix, localtime(0)))
+        self.assertEqual(u'first line\n', open(archive).read())
+        self.assertEqual(u'second line\n', open(self.path).read())
+
+    def test_timer_idle(self):
+        """
+        After being idle for multiple intervals, the file is rotated once
+        and the next rotation time is not drifting.
+        """
+        self.makeHandler()
+        self.emit(u'first line')
+
+        self.clock.pump([10, 10, 10])
+        self.clock.advance(5)
+        self.emit(u'second line')
+
+        self.assertEqual(40, self.handler.rolloverAt)
+        self.assertEqual(2, len([
+            member for member in os.listdir(os.path.dirname(self.path))
+            if member.startswith(os.path.basename(self.path))]))
+
+    def test_close(self):
+        """
+        Closing the handler stops the timer.
+        """
+        self.makeHandler()
+
+        self.handler.close()
+
+        self.assertEqual([], self.clock.getDelayedCalls())
+        self.handler = None
+
+    def test_computeRollover_midnight(self):
+        """
+        The first rotation is at the next midnight and the next rotations
+        are `interval` midnights later, also over DST changes.
+        """
+        handler = self.makeHandler(when='midnight', interval=2)
+        now = self.local(2013, 10, 2, 15, 30)
+
+        first = handler._computeFirstRollover(now)
+
+        self.assertEqual(self.local(2013, 10, 3), first)
+        rollover_at = first
+        for index in range(200):
+            rollover_at = handler._computeNextRollover(
+                rollover_at, rollover_at)
+            self.assertEqual((0, 0, 0), localtime(rollover_at)[3:6])
+        self.assertEqual(self.local(2014, 11, 7), rollover_at)
+
+    def test_computeRollover_weekday(self):
+        """
+        Weekly rotation is done at the start of the week day, each
+        `interval` weeks.
+        """
+        handler = self.makeHandler(when='w0', interval=2)
+        # 2 October 2013 is a Wednesday.
+        now = self.local(2013, 10, 2, 15, 30)
+
+        first = handler._computeFirstRollover(now)
+
+        self.assertEqual(self.local(2013, 10, 7), first)
+        self.assertEqual(
+            self.local(2013, 10, 21),
+            handler._computeNextRollover(first, first + 1))
+        # On the same week day, the rotation is done next week.
+        self.assertEqual(
+            first,
+            handler._computeFirstRollover(self.local(2013, 9, 30, 1, 0)))
+
+    def test_compressed(self):
+        """
+        The compressed handler compresses the rotated files.
+        """
+        compressor = ArchiveCompressor()
+        self.handler = CompressedScheduledTimedRotatingFileHandler(
+            self.path, when='s', interval=1, reactor=self.clock,
+            compressor=compressor)
+        self.emit(u'first line')
+        self.clock.advance(1)
+
+        self.emit(u'second line')
+        compressor.wait()
+
+        archives = self.handler.getArchives()
+        self.assertEqual(1, len(archives))
+        self.assertEqual(u'first line\n', gzip.open(archives[0]).read())
+
+
+class TestSizeAndTimeRotatingFileHandler(UtilsTestCase):
+    """
+    Tests for SizeAndTimeRotatingFileHandler.
+    """
+
+    def setUp(self):
+        super(TestSizeAndTimeRotatingFileHandler, self).setUp()
+        self.path, self.segments = manufacture.fs.makePathInTemp()
+        self.clock = Clock()
+        self.compressor = ArchiveCompressor()
+        self.handler = None
+
+    def tearDown(self):
+        if self.handler:
+            self.handler.wait()
+            self.compressor.wait()
+            self.handler.close()
+            for path in self.handler.getArchives():
+                os.remove(path)
+        manufacture.fs.deleteFile(self.segments, ignore_errors=True)
+        super(TestSizeAndTimeRotatingFileHandler, self).tearDown()
+
+    def makeHandler(self, **kwargs):
+        """
+        Create a handler rotated each hour or at 30 bytes.
+        """
+        self.handler = SizeAndTimeRotatingFileHandler(
+            self.path, when='h', interval=1, maxBytes=30, backupCount=2,
+            reactor=self.clock, compressor=self.compressor, **kwargs)
+        return self.handler
+
+    def emit(self, text):
+        """
+        Emit a log entry with `text`, one second later.
+        """
+        self.clock.advance(1)
+        self.handler.handle(LogEntry(100, text))
+        self.handler.wait()
+
+    def test_rotate_at_size(self):
+        """
+        The file is rotated before it would get larger than `maxBytes`
+        and only `backupCount` archives are kept.
+        """
+        self.makeHandler()
+
+        for index in range(7):
+            self.emit(u'line number %d' % (index))
+
+        archives = self.handler.getArchives()
+        self.assertEqual(2, len(archives))
+        self.assertEqual(
+            u'line number 2\nline number 3\n', open(archives[0]).read())
+        self.assertEqual(u'line number 6\n', open(self.path).read())
+
+    def test_rotate_at_time(self):
+        """
+        The file is rotated at time intervals, even when not reaching
+        `maxBytes`.
+        """
+        self.makeHandler()
+        self.emit(u'first')
+
+        self.clock.advance(3600)
+        self.emit(u'second')
+
+        archives = self.handler.getArchives()
+        self.assertEqual(1, len(archives))
+        self.assertEqual(u'first\n', open(archives[0]).read())
+        self.assertEqual(u'second\n', open(self.path).read())
+
+    def test_rotate_compress(self):
+        """
+        Archives are compressed when `compress` is True.
+        """
+        self.makeHandler(compress=True)
+
+        for index in range(3):
+            self.emit(u'line number %d' % (index))
+        self.compressor.wait()
+
+        archives = self.handler.getArchives()
+        self.assertEqual(1, len(archives))
+        self.assertEqual(
+            u'line number 0\nline number 1\n', gzip.open(archives[0]).read())
+
+    def test_next_file(self):
+        """
+        The next file is opened in background and removed on close.
+        """
+        if self.os_name == 'nt':
+            raise self.skipTest()
+        self.makeHandler()
+        self.handler.wait()
+
+        self.assertTrue(os.path.exists(self.path + '.next'))
+
+        self.handler.close()
+
+        self.assertFalse(os.path.exists(self.path + '.next'))
+
+
 class TestLogger(LoggerTestCase):
     """
     Basic tests for log handlers management.
@@ -398,6 +1008,32 @@ class TestLogger(LoggerTestCase):
         finally:
             manufacture.fs.deleteFile(segments)
 
+    def test_configure_log_file_rotate_compress(self):
+        """
+        When compression is enabled, the handler keeps compressed archives.
+        """
+        file_name, segments = manufacture.fs.makePathInTemp()
+        content = (
+            u'[log]\n'
+            u'log_file: %s\n'
+            u'log_file_rotate_at_size: 100\n'
+            u'log_file_rotate_count: 10\n'
+            u'log_file_rotate_compress: Yes\n'
+             ) % (file_name)
+
+        configuration = self.getConfiguration(content=content)
+        logger = manufacture.makeLogger()
+
+        try:
+            logger.configure(configuration)
+
+            handler = logger._active_handlers['file']
+            self.assertIsInstance(CompressedRotatingFileHandler, handler)
+            self.assertEqual(10, handler.backupCount)
+            logger.removeAllHandlers()
+        finally:
+            manufacture.fs.deleteFile(segments)
+
     def test_configure_log_file_rotate_each(self):
         """
         Check file rotation archive keeping.
@@ -417,7 +1053,7 @@ class TestLogger(LoggerTestCase):
             logger.configure(configuration)
 
             handler = logger._active_handlers['file']
-            self.assertIsInstance(TimedRotatingFileHandler, handler)
+            self.assertIsInstance(ScheduledTimedRotatingFileHandler, handler)
             self.assertEqual(3, handler.backupCount)
             self.assertEqual(u'H', handler.when)
             self.assertEqual(2 * 60 * 60, handler.interval)
@@ -430,6 +1066,34 @@ class TestLogger(LoggerTestCase):
         finally:
             manufacture.fs.deleteFile(segments)
 
+    def test_configure_log_file_rotate_each_and_size(self):
+        """
+        When both time and size rotation are configured, the file is
+        rotated by whichever comes first.
+        """
+        file_name, segments = manufacture.fs.makePathInTemp()
+        content = (
+            u'[log]\n'
+            u'log_file: %s\n'
+            u'log_file_rotate_each: 2 hours\n'
+            u'log_file_rotate_at_size: 100\n'
+            u'log_file_rotate_count: 3\n'
+             ) % (file_name)
+
+        configuration = self.getConfiguration(content=content)
+        logger = manufacture.makeLogger()
+        try:
+            logger.configure(configuration)
+
+            handler = logger._active_handlers['file']
+            self.assertIsInstance(SizeAndTimeRotatingFileHandler, handler)
+            self.assertEqual(100, handler.maxBytes)
+            self.assertEqual(2 * 60 * 60, handler.interval)
+            self.assertFalse(handler.compress)
+            logger.removeAllHandlers()
+        finally:
+            manufacture.fs.deleteFile(segments)
+
     def test_addFile_file_rotate_each_zero(self):
         """
         It is not enabled when interval is zero.
@@ -463,6 +1127,58 @@ class TestLogger(LoggerTestCase):
         signal = callback.call_args[0][0]
         self.assertEqual(log_handler.name, signal.name)
 
+    def test_addHandler_json_format(self):
+        """
+        When `patch_format` is enabled, the formatter for `log_format` is
+        used.
+        """
+        log_handler = InMemoryHandler()
+
+        self.logger.addHandler(
+            log_handler, patch_format=True, log_format=u'json')
+
+        self.assertEqual(format_log_entry_json, log_handler.format)
+
+    def test_log_json_bytes(self):
+        """
+        Entries having non-ASCII byte strings are written in JSON format.
+        """
+        log_output = StringIO()
+        log_handler = StreamHandler(log_output)
+        self.logger.addHandler(
+            log_handler, patch_format=True, log_format=u'json')
+
+        self.logger.log(100, u'some text', data={'key': 'caf\xc3\xa9'})
+
+        line = log_output.getvalue()
+        self.assertEqual(1, len(line.splitlines()))
+        self.assertEqual(
+            {u'key': u'caf\xe9'}, json.loads(line)['data'])
+
+    def test_enableHandlerQueues(self):
+        """
+        After enabling queues, each new handler uses its own queue and
+        its statistics are available.
+        """
+        log_handler = InMemoryHandler()
+        self.logger.enableHandlerQueues(queue_size=10)
+        self.logger.addHandler(log_handler)
+
+        self.logger.log(100, u'some text')
+        queued_handler = self.logger.getHandlers()[0]
+        queued_handler.join()
+
+        self.assertIsInstance(QueuedHandler, queued_handler)
+        self.assertEqual(u'some text', log_handler.history[0].text)
+        stats = self.logger.getHandlerStats()
+        self.assertEqual(1, len(stats))
+        self.assertEqual(1, stats[0]['handled'])
+
+        self.logger.removeHandler(log_handler)
+
+        self.assertIsEmpty(self.logger.getHandlers())
+        self.assertEqual([], self.logger.getHandlerStats())
+
     def test_addHandler_without_name(self):
         """
         It adds the handler and does not sends a notification.
@@ -0,0 +1,43 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+'''Unit tests for the Prometheus resource.'''
+
+from chevah.utils.event import EventsMetrics
+from chevah.utils.prometheus import CONTENT_TYPE, EventsMetricsResource
+from chevah.utils.testing import UtilsTestCase
+
+
+class TestEventsMetricsResource(UtilsTestCase):
+    '''Tests for EventsMetricsResource.'''
+
+    def test_render_GET_empty(self):
+        """
+        Without events, only the metrics descriptions are rendered.
+        """
+        resource = EventsMetricsResource(EventsMetrics())
+        request = self.Mock()
+
+        result = resource.render_GET(request)
+
+        self.assertEqual(8, len(result.splitlines()))
+        self.assertTrue(result.startswith(
+            '# HELP chevah_events_total Number of emitted events.\n'))
+        request.setHeader.assert_any_call('content-type', CONTENT_TYPE)
+
+    def test_render_GET(self):
+        """
+        The counters and rates are rendered for each event id and
+        group, with escaped label values.
+        """
+        metrics = EventsMetrics()
+        metrics.record(u'100')
+        metrics.record(u'100')
+        metrics.record(u'some "id"')
+        resource = EventsMetricsResource(metrics, prefix=u'server')
+
+        lines = resource.render_GET(self.Mock()).splitlines()
+
+        self.assertTrue('server_events_total{id="100"} 2' in lines)
+        self.assertTrue('server_events_total{id="some \\"id\\""} 1' in lines)
+        self.assertTrue(
+            'server_events_rate{id="100",window="15m"} 0.0' in lines)
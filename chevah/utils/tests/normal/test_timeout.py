@@ -0,0 +1,167 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+"""
+Tests for idle timeouts using a timing wheel.
+"""
+from __future__ import with_statement
+
+from twisted.internet.task import Clock
+
+from chevah.utils.interfaces import IIdleTimeoutProtocol
+from chevah.utils.testing import UtilsTestCase
+from chevah.utils.timeout import TimingWheel, TimingWheelTimeoutMixin
+
+
+class DummyTimeoutProtocol(TimingWheelTimeoutMixin):
+    """
+    A protocol recording the time when it timed out.
+    """
+
+    def __init__(self, timing_wheel):
+        self.timing_wheel = timing_wheel
+        self.timed_out = []
+
+    def timeoutConnection(self):
+        self.timed_out.append(self.timing_wheel.now)
+
+
+class TestTimingWheel(UtilsTestCase):
+    """
+    Tests for TimingWheel and TimingWheelTimeoutMixin.
+    """
+
+    def setUp(self):
+        super(TestTimingWheel, self).setUp()
+        self.clock = Clock()
+        self.wheel = TimingWheel(resolution=1, slots=8, reactor=self.clock)
+        self.wheel.start()
+
+    def tearDown(self):
+        self.wheel.stop()
+        super(TestTimingWheel, self).tearDown()
+
+    def advance(self, seconds):
+        """
+        Advance the clock one second at a time.
+        """
+        for second in range(seconds):
+            self.clock.advance(1)
+
+    def test_interface(self):
+        """
+        The mixin provides IIdleTimeoutProtocol.
+        """
+        protocol = DummyTimeoutProtocol(self.wheel)
+
+        self.assertProvides(IIdleTimeoutProtocol, protocol)
+
+    def test_start_stop(self):
+        """
+        The wheel is checked periodically only when started.
+        """
+        self.assertTrue(self.wheel.running)
+
+        self.wheel.stop()
+
+        self.assertFalse(self.wheel.running)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_setTimeout(self):
+        """
+        The connection times out after the period, and the previous
+        period is returned.
+        """
+        protocol = DummyTimeoutProtocol(self.wheel)
+
+        result = protocol.setTimeout(3)
+
+        self.assertIsNone(result)
+        self.assertEqual(1, len(self.wheel))
+        self.advance(2)
+        self.assertEqual([], protocol.timed_out)
+        self.advance(1)
+        self.assertEqual([3], protocol.timed_out)
+        self.assertEqual(0, len(self.wheel))
+        self.assertEqual(3, protocol.setTimeout(None))
+
+    def test_setTimeout_none(self):
+        """
+        The timeout is cancelled when the period is None.
+        """
+        protocol = DummyTimeoutProtocol(self.wheel)
+        protocol.setTimeout(3)
+
+        protocol.setTimeout(None)
+        self.advance(5)
+
+        self.assertEqual([], protocol.timed_out)
+        self.assertEqual(0, len(self.wheel))
+
+    def test_resetTimeout(self):
+        """
+        Resetting the timeout delays the time out.
+        """
+        protocol = DummyTimeoutProtocol(self.wheel)
+        protocol.setTimeout(3)
+        self.advance(2)
+
+        protocol.resetTimeout()
+        self.advance(2)
+
+        self.assertEqual([], protocol.timed_out)
+        self.advance(1)
+        self.assertEqual([5], protocol.timed_out)
+
+    def test_resetTimeout_not_started(self):
+        """
+        Resetting the timeout does nothing when no timeout was set.
+        """
+        protocol = DummyTimeoutProtocol(self.wheel)
+
+        protocol.resetTimeout()
+        self.advance(5)
+
+        self.assertEqual(0, len(self.wheel))
+        self.assertEqual([], protocol.timed_out)
+
+    def test_timeout_longer_than_wheel(self):
+        """
+        Timeouts longer than a full rotation of the wheel are supported.
+        """
+        protocol = DummyTimeoutProtocol(self.wheel)
+        protocol.setTimeout(20)
+
+        self.advance(19)
+        self.assertEqual([], protocol.timed_out)
+        self.advance(1)
+
+        self.assertEqual([20], protocol.timed_out)
+
+    def test_tick_missed(self):
+        """
+        When ticks are missed, all due connections are timed out on the
+        next tick.
+        """
+        first = DummyTimeoutProtocol(self.wheel)
+        second = DummyTimeoutProtocol(self.wheel)
+        first.setTimeout(2)
+        second.setTimeout(30)
+
+        self.clock.advance(12)
+
+        self.assertEqual(1, len(first.timed_out))
+        self.assertEqual([], second.timed_out)
+        self.assertEqual(1, len(self.wheel))
+
+    def test_timeoutConnection_default(self):
+        """
+        By default the transport is closed on timeout.
+        """
+        protocol = TimingWheelTimeoutMixin()
+        protocol.timing_wheel = self.wheel
+        protocol.transport = self.Mock()
+        protocol.setTimeout(1)
+
+        self.advance(1)
+
+        protocol.transport.loseConnection.assert_called_once_with()
@@ -0,0 +1,223 @@
+# Copyright (c) 2013 Adi Roiban.
+# See LICENSE for details.
+"""
+Idle timeouts for a large number of connections.
+
+Instead of using a delayed call for each connection, all connections are
+kept in a hashed timing wheel which is checked periodically.
+"""
+from __future__ import with_statement
+
+from twisted.internet import task
+from twisted.python import log
+from zope.interface import implements
+
+from chevah.utils.interfaces import IIdleTimeoutProtocol
+
+
+class TimingWheel(object):
+    """
+    A hashed timing wheel for idle timeouts.
+
+    The wheel has `slots` buckets, each covering `resolution` seconds.
+    Protocols are placed in the bucket of their deadline. On each tick
+    the expired buckets are checked and the protocols which were active
+    in the meantime are moved to the bucket of their new deadline.
+
+    Timeouts are triggered with a precision of `resolution` seconds.
+    """
+
+    def __init__(self, resolution=1, slots=60, reactor=None):
+        self._resolution = resolution
+        self._slots = [set() for index in range(slots)]
+        self._reactor = reactor
+        self._loop = None
+        self._tick_index = None
+        self.now = None
+
+    def __len__(self):
+        return sum([len(bucket) for bucket in self._slots])
+
+    @property
+    def running(self):
+        """
+        True when the wheel is checked periodically.
+        """
+        return self._loop is not None
+
+    def start(self):
+        """
+        Start checking the wheel each `resolution` seconds.
+        """
+        if self.running:
+            return
+        reactor = self._getReactor()
+        self.now = reactor.seconds()
+        self._tick_index = self._getIndex(self.now)
+        self._loop = task.LoopingCall(self.tick)
+        self._loop.clock = reactor
+        self._loop.start(self._resolution, now=False)
+
+    def stop(self):
+        """
+        Stop checking the wheel.
+
+        Protocols are kept in the wheel.
+        """
+        if not self.running:
+            return
+        self._loop.stop()
+        self._loop = None
+
+    def add(self, protocol):
+        """
+        Add `protocol` to the wheel, using its current deadline.
+        """
+        self.remove(protocol)
+        self._insert(protocol, protocol._timeout_deadline)
+
+    def remove(self, protocol):
+        """
+        Remove `protocol` from the wheel.
+        """
+        slot = protocol._timeout_slot
+        if slot is None:
+            return
+        self._slots[slot].discard(protocol)
+        protocol._timeout_slot = None
+
+    def tick(self):
+        """
+        Time out the protocols from the buckets which are due.
+        """
+        self.now = self._getReactor().seconds()
+        current_index = self._getIndex(self.now)
+        if self._tick_index is None:
+            self._tick_index = current_index - 1
+
+        # When more ticks were missed than the number of slots, each
+        # bucket is only checked once.
+        first_index = max(
+            self._tick_index + 1, current_index - len(self._slots) + 1)
+        self._tick_index = current_index
+
+        for index in range(first_index, current_index + 1):
+            slot = index % len(self._slots)
+            bucket = self._slots[slot]
+            if not bucket:
+                continue
+            self._slots[slot] = set()
+            for protocol in bucket:
+                protocol._timeout_slot = None
+                deadline = protocol._timeout_deadline
+                if deadline is None:
+                    continue
+                if deadline > self.now:
+                    self._insert(protocol, deadline)
+                    continue
+                self._expire(protocol)
+
+    def _insert(self, protocol, deadline):
+        """
+        Place `protocol` in the bucket for `deadline`.
+        """
+        index = self._getIndex(deadline)
+        if self._tick_index is not None and index <= self._tick_index:
+            # Deadline was rounded into the current tick.
+            index = self._tick_index + 1
+        slot = index % len(self._slots)
+        self._slots[slot].add(protocol)
+        protocol._timeout_slot = slot
+
+    def _expire(self, protocol):
+        """
+        Called when `protocol` was idle for too long.
+        """
+        protocol._timeout_deadline = None
+        try:
+            protocol.timeoutConnection()
+        except:
+            log.err(None, 'Failed to time out connection.')
+
+    def _getIndex(self, seconds):
+        """
+        Return the tick index for `seconds`.
+        """
+        return int(seconds // self._resolution)
+
+    def _getReactor(self):
+        """
+        Return the reactor used for the periodic checks.
+        """
+        if self._reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+        return self._reactor
+
+
+class TimingWheelTimeoutMixin(object):
+    """
+    An IIdleTimeoutProtocol using a shared `TimingWheel`.
+
+    Resetting the timeout only updates the deadline. The connection is
+    checked when the wheel reaches the bucket of its previous deadline.
+
+    `timing_wheel` should be set to a started wheel before calling
+    `setTimeout`.
+    """
+
+    implements(IIdleTimeoutProtocol)
+
+    timeOut = None
+    timing_wheel = None
+
+    _timeout_deadline = None
+    _timeout_slot = None
+
+    def callLater(self, period, func):
+        """
+        See: IIdleTimeoutProtocol.
+        """
+        return self.timing_wheel._getReactor().callLater(period, func)
+
+    def resetTimeout(self):
+        """
+        See: IIdleTimeoutProtocol.
+        """
+        if self._timeout_deadline is not None:
+            self._timeout_deadline = self._getNow() + self.timeOut
+
+    def setTimeout(self, period):
+        """
+        See: IIdleTimeoutProtocol.
+
+        Returns the previous timeout period.
+        """
+        previous = self.timeOut
+        self.timeOut = period
+
+        if period is None:
+            self._timeout_deadline = None
+            self.timing_wheel.remove(self)
+        else:
+            self._timeout_deadline = self._getNow() + period
+            self.timing_wheel.add(self)
+
+        return previous
+
+    def timeoutConnection(self):
+        """
+        See: IIdleTimeoutProtocol.
+
+        By default the connection is closed.
+        """
+        self.transport.loseConnection()
+
+    def _getNow(self):
+        """
+        Return the current time as known by the wheel.
+        """
+        now = self.timing_wheel.now
+        if now is None:
+            now = self.timing_wheel._getReactor().seconds()
+        return now
@@ -199,3 +199,16 @@ def test_os_independent(args):
     """
     Run OS dependent tests.
     """
+
+
+@task
+@needs('build')
+@consume_args
+def benchmark(args):
+    """
+    Run the benchmarks and compare them with the baseline.
+    """
+    from chevah.utils.tests.benchmark.runner import main
+    exit_code = main(['benchmark'] + args)
+    if exit_code:
+        sys.exit(exit_code)